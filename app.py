@@ -1,17 +1,32 @@
-from typing import Any, List
+from typing import Any, Callable, List, Optional
+import multiprocessing
 import threading
 import queue
 import websocket
 import time
 import signal
+import logging
+import math
 import bson
 import os
 from dotenv import load_dotenv
-from arbitrage.events import Event
-from arbitrage.naming import get_item_name, get_world_name, worlds
-from arbitrage.universalis import ListingEvent, MarketBoardCurrentData, SaleEvent, get_market_board, get_market_board_current_data, parse_listing_event, parse_sale_event
-from arbitrage.helpers import dispatch_discord_notification
-from arbitrage.db import DbParameters, initialize_database, db_insert_row, db_flush_rows
+from arbitrage.events import Event, EventQueue, ShardedQueue
+from arbitrage.catalog import catalog, world_catalog
+from arbitrage.naming import get_item_name, get_world_name, select_worlds, worlds
+from arbitrage.universalis import ListingEvent, MarketBoardCurrentData, SaleEvent, get_market_board_current_data, get_marketable_items, listing_from_event_line, parse_listing_event, parse_sale_event, peek_event_header
+from arbitrage.helpers import RefreshQueueStats, TokenBucket, refresh_failures
+from arbitrage.matrix import ArbitrageMatrix, WorldSettings, parse_world_settings
+from arbitrage.notifications import DiscordDispatcher
+from arbitrage.store import HQ, NQ, MarketBoardStore
+from arbitrage.snapshot import MarketBoardSnapshot, load_market_board, open_market_board
+from arbitrage.db import DbParameters, DbWriter, SalesHistory, initialize_database
+from arbitrage.journal import MarketBoardJournal
+from arbitrage.replay import FrameRecorder, replay_frames
+from arbitrage.warm_start import WarmStart
+from arbitrage.metrics import Counter, Gauge, Histogram, start_metrics_server
+from arbitrage import metrics
+from arbitrage.log import Lazy, configure_logging, get_logger, stop_logging
+from arbitrage import universalis
 
 
 load_dotenv()
@@ -22,7 +37,30 @@ WEBSOCKET_ADDR = os.getenv("UNIVERSALIS_WEBSOCKET_ADDR")
 SELL_TAX = float(os.getenv("SELL_TAX", 0.05))
 BUY_TAX = float(os.getenv("BUY_TAX", 0.05))
 ARBITRAGE_PROFIT_THRESHOLD = int(os.getenv("ARBITRAGE_PROFIT_THRESHOLD", 100_000))
+ARBITRAGE_SELL_WORLDS = [int(world_id) for world_id in os.getenv("ARBITRAGE_SELL_WORLDS", str(HOME_WORLD)).split(",") if world_id]
+ARBITRAGE_MAX_SELL_DAYS = float(os.getenv("ARBITRAGE_MAX_SELL_DAYS", 0))
+ARBITRAGE_WORLD_SETTINGS = parse_world_settings(os.getenv("ARBITRAGE_WORLD_SETTINGS", ""), WorldSettings(SELL_TAX, BUY_TAX, ARBITRAGE_PROFIT_THRESHOLD))
 MARKET_BOARD_DATA_EXPIRES_AFTER_HOURS = int(os.getenv("MARKET_BOARD_DATA_EXPIRES_AFTER_HOURS", 4))
+MARKET_BOARD_INDEX_WORKERS = int(os.getenv("MARKET_BOARD_INDEX_WORKERS", 8))
+MARKET_BOARD_WARM_START = os.getenv("MARKET_BOARD_WARM_START", "1") == "1"
+MARKET_BOARD_JOURNAL_FLUSH_SECONDS = float(os.getenv("MARKET_BOARD_JOURNAL_FLUSH_SECONDS", 1))
+MARKET_BOARD_COMPACT_MINUTES = float(os.getenv("MARKET_BOARD_COMPACT_MINUTES", 10))
+MARKET_BOARD_REFRESH_REQUESTS_PER_MINUTE = int(os.getenv("MARKET_BOARD_REFRESH_REQUESTS_PER_MINUTE", 60))
+MARKET_BOARD_REFRESH_ORDER = os.getenv("MARKET_BOARD_REFRESH_ORDER", "oldest")
+HTTP_SCRAPER_COALESCE_SECONDS = float(os.getenv("HTTP_SCRAPER_COALESCE_SECONDS", 5))
+# Delay before the items of a failed refresh are requested again, doubled after every failure.
+HTTP_SCRAPER_RETRY_SECONDS = 5
+HTTP_SCRAPER_MAX_RETRY_SECONDS = 5 * 60
+REFRESH_ITEM_ON_HOME_WORLD_SALE = os.getenv("REFRESH_ITEM_ON_HOME_WORLD_SALE", "0") == "1"
+ARBITRAGER_SHARDS = int(os.getenv("ARBITRAGER_SHARDS", 1))
+TRACKED_WORLDS = os.getenv("TRACKED_WORLDS", ",".join(map(str, worlds.keys())))
+WEBSOCKET_CONNECTIONS = int(os.getenv("WEBSOCKET_CONNECTIONS", 1))
+ARBITRAGER_QUEUE_SIZE = int(os.getenv("ARBITRAGER_QUEUE_SIZE", 100_000))
+ARBITRAGER_MAX_EVENT_AGE_SECONDS = float(os.getenv("ARBITRAGER_MAX_EVENT_AGE_SECONDS", 10))
+UNIVERSALIS_API_ADDR = os.getenv("UNIVERSALIS_API_ADDR")
+WEBSOCKET_RECORD_FILE = os.getenv("WEBSOCKET_RECORD_FILE")
+WEBSOCKET_REPLAY_FILE = os.getenv("WEBSOCKET_REPLAY_FILE")
+WEBSOCKET_REPLAY_SPEED = float(os.getenv("WEBSOCKET_REPLAY_SPEED", 1))
 DB_PARAMS = DbParameters(
     os.getenv("DB_HOST", ""),
     int(os.getenv("DB_PORT", 5432)),
@@ -31,44 +69,202 @@ DB_PARAMS = DbParameters(
     os.getenv("DB_NAME", "")
 )
 DB_USE_TIMESCALE = os.getenv("DB_TIMESCALE", "0") == "1"
+DISCORD_WEBHOOK = os.getenv("DISCORD_WEBHOOK")
+DISCORD_BATCH_SECONDS = float(os.getenv("DISCORD_BATCH_SECONDS", 1))
+DISCORD_DEDUPLICATION_SECONDS = float(os.getenv("DISCORD_DEDUPLICATION_SECONDS", 600))
+DB_FLUSH_ROWS = int(os.getenv("DB_FLUSH_ROWS", 1_000))
+DB_FLUSH_INTERVAL_SECONDS = float(os.getenv("DB_FLUSH_INTERVAL_SECONDS", 5))
+DB_MAX_BUFFERED_ROWS = int(os.getenv("DB_MAX_BUFFERED_ROWS", 100_000))
+SALES_HISTORY_DAYS = int(os.getenv("SALES_HISTORY_DAYS", 7))
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+LOG_FILE = os.getenv("LOG_FILE")
 
 
-if not all([HOME_WORLD, WEBSOCKET_ADDR, SELL_TAX, BUY_TAX, ARBITRAGE_PROFIT_THRESHOLD, MARKET_BOARD_DATA_EXPIRES_AFTER_HOURS]):
-    print("ERROR: .env not defined properly.")
+log = get_logger("app")
+sale_log = get_logger("sale")
+listing_log = get_logger("listing")
+arbitrage_log = get_logger("arbitrage")
+market_board_log = get_logger("market_board")
+websocket_log = get_logger("websocket")
+http_scraper_log = get_logger("http_scraper")
+
+
+if UNIVERSALIS_API_ADDR:
+    universalis.api_address = UNIVERSALIS_API_ADDR
+
+
+if not all([HOME_WORLD, WEBSOCKET_ADDR or WEBSOCKET_REPLAY_FILE, SELL_TAX, BUY_TAX, ARBITRAGE_PROFIT_THRESHOLD, MARKET_BOARD_DATA_EXPIRES_AFTER_HOURS]):
+    log.error(".env not defined properly.")
     quit()
 
 
+websocket_decode_seconds = Histogram("websocket_decode_seconds", "Time to decode and parse one websocket message.")
+websocket_events = Counter("websocket_events_total", "Websocket events received, by event and world.", ["event", "world"])
+websocket_frames_skipped = Counter("websocket_frames_skipped_total", "Websocket events dropped before decoding, by event.", ["event"])
+queue_wait_seconds = Histogram("arbitrager_queue_wait_seconds", "Time between receiving an event and the arbitrager taking it from its queue.", ["event"])
+handle_seconds = Histogram("arbitrager_handle_seconds", "Time the arbitrager spends handling one event.", ["event"])
+evaluate_seconds = Histogram("arbitrage_evaluate_seconds", "Time to evaluate the listings of one event against every sell world.")
+decision_seconds = Histogram("arbitrage_decision_seconds", "Time between receiving a listing and the arbitrage decision, including the queue wait.")
+opportunities = Counter("arbitrage_opportunities_total", "Arbitrage opportunities found, by sell world.", ["sell_world"])
+
+
+def setup_logging():
+    configure_logging(LOG_LEVEL, LOG_LEVELS, LOG_SAMPLING, LOG_FILE)
+
+
+def load_catalogs():
+    catalog.load()
+    world_catalog.load()
+    select_worlds(TRACKED_WORLDS)
+    # Sell worlds that are not tracked still need their prices, so they are included in the market data.
+    universalis.market_scopes = world_catalog.scopes(set(worlds) | set(ARBITRAGE_SELL_WORLDS) | {HOME_WORLD})
+    log.info("Tracking {} world(s), market data is requested for {}.", len(worlds), ", ".join(universalis.market_scopes))
+
+
 def http_scraper(http_scraper_queue, arbitrager_queue, stop_event):
-    print("Started http_scraper.")
+    http_scraper_log.info("Started http_scraper.")
+    stats = RefreshQueueStats()
+    pending = {}
+    window_started_at = 0.0
+    retry_seconds = HTTP_SCRAPER_RETRY_SECONDS
+    retry_at = 0.0
     while not stop_event.is_set():
+        if time.monotonic() < retry_at:
+            timeout = min(1.0, retry_at - time.monotonic())
+        elif len(pending) >= 100:
+            timeout = 0
+        else:
+            timeout = max(0.0, window_started_at + HTTP_SCRAPER_COALESCE_SECONDS - time.monotonic()) if pending else 1
         try:
-            event: Event = http_scraper_queue.get(timeout=1)
+            event: Event = http_scraper_queue.get(timeout=timeout)
             if event.type == Event.UpdateItem:
-                item_code = event.args["item_code"]
-                updated_item = get_market_board_current_data([item_code])
-                arbitrager_queue.put(Event.update_market_board(updated_item))
+                stats.record_requested()
+                if not pending:
+                    window_started_at = time.monotonic()
+                # Keep the oldest request time of an item, so the latency includes the time spent waiting.
+                pending.setdefault(event.args["item_code"], event.args.get("queued_at", time.time()))
         except queue.Empty:
+            pass
+        window_elapsed = time.monotonic() - window_started_at >= HTTP_SCRAPER_COALESCE_SECONDS
+        if not pending or time.monotonic() < retry_at or (len(pending) < 100 and not window_elapsed):
+            continue
+        item_codes = list(pending)[:100]
+        queued_at = [pending.pop(item_code) for item_code in item_codes]
+        window_started_at = time.monotonic()
+        try:
+            updated_items = get_market_board_current_data(item_codes)
+        except Exception as err:
+            # The items are marked as refresh requested and would not be refreshed for hours, so they are put back in
+            # front of the others with their original request time.
+            http_scraper_log.error("Updating {} items failed, retrying in {:.0f}s: {}", len(item_codes), retry_seconds, err)
+            refresh_failures.inc()
+            pending = {**dict(zip(item_codes, queued_at)), **pending}
+            retry_at = time.monotonic() + retry_seconds
+            retry_seconds = min(2 * retry_seconds, HTTP_SCRAPER_MAX_RETRY_SECONDS)
             continue
-    print("Stopped http_scraper.")
+        retry_seconds = HTTP_SCRAPER_RETRY_SECONDS
+        stats.record_request(len(item_codes), queued_at)
+        arbitrager_queue.put(Event.update_market_board(updated_items))
+        stats.report_every(60)
+    http_scraper_log.info("Stopped http_scraper.")
+
+
+def market_board_refresher(market_board: MarketBoardStore, market_board_ready, arbitrager_queue, stop_event):
+    while not market_board_ready.wait(timeout=1):
+        if stop_event.is_set():
+            return
+    market_board_log.info("Started market_board_refresher.")
+    max_age_in_seconds = MARKET_BOARD_DATA_EXPIRES_AFTER_HOURS * 60 * 60
+    request_budget = TokenBucket(MARKET_BOARD_REFRESH_REQUESTS_PER_MINUTE / 60, capacity=1)
+    while not stop_event.is_set():
+        item_ids = market_board.stale_items(max_age_in_seconds, 100, MARKET_BOARD_REFRESH_ORDER)
+        if not item_ids:
+            stop_event.wait(60)
+            continue
+        request_budget.acquire()
+        market_board.mark_refresh_requested(item_ids)
+        try:
+            updated_items = get_market_board_current_data(item_ids)
+        except Exception as err:
+            market_board_log.error("Refreshing {} stale items failed: {}", len(item_ids), err)
+            market_board.clear_refresh_requested(item_ids)
+            continue
+        arbitrager_queue.put(Event.update_market_board(updated_items))
+    market_board_log.info("Stopped market_board_refresher.")
+
+
+WEBSOCKET_EVENTS = {
+    "sales/add": (Event.Sale, parse_sale_event),
+    "listings/add": (Event.Listing, parse_listing_event),
+    "listings/remove": (Event.ListingRemoved, parse_listing_event),
+}
+
+
+class FrameFilter:
+    """Decides from the `event`, `item` and `world` of a websocket message whether it is worth decoding."""
+    def __init__(self, market_board: MarketBoardStore, market_board_ready, keep_sales: bool):
+        self.market_board = market_board
+        self.market_board_ready = market_board_ready
+        self.keep_sales = keep_sales
+
+    def __call__(self, event_type: str, item_id: int, world_id: int) -> bool:
+        if event_type == "sales/add" and (self.keep_sales or (REFRESH_ITEM_ON_HOME_WORLD_SALE and world_id == HOME_WORLD)):
+            return True
+        # The arbitrager only keeps listings and sale statistics of items that are on the market board, while the
+        # market board is still loading it is not known yet which items these are.
+        return not self.market_board_ready.is_set() or item_id in self.market_board.item_rows
 
 
-def websocket_client(arbitrager_queue, stop_event):
+def handle_websocket_message(encoded_message: bytes, arbitrager_queue, accept: Callable[[str, int, int], bool] = None):
+    received_at = time.perf_counter()
+    # Only the header is read first, so frames that are dropped are never fully decoded.
+    header = peek_event_header(encoded_message) if accept is not None else None
+    message = None
+    if header is None:
+        message = bson.decode(encoded_message)
+        header = message.get("event"), message.get("item"), message.get("world")
+    event_type, item_id, world_id = header
+    if event_type not in WEBSOCKET_EVENTS:
+        return
+    websocket_events.inc(event_type, world_id)
+    if accept is not None and not accept(event_type, item_id, world_id):
+        websocket_frames_skipped.inc(event_type)
+        return
+    if message is None:
+        message = bson.decode(encoded_message)
+    type, parse = WEBSOCKET_EVENTS[event_type]
+    event = Event(type, parse(message), received_at)
+    websocket_decode_seconds.observe(time.perf_counter() - received_at)
+    arbitrager_queue.put(event)
+
+
+def replay_client(arbitrager_queue, stop_event, accept: Callable[[str, int, int], bool] = None):
+    """Stand-in for `websocket_client` that plays back a recording made with `WEBSOCKET_RECORD_FILE`."""
+    websocket_log.info("Replaying {} at {}x speed.", WEBSOCKET_REPLAY_FILE, WEBSOCKET_REPLAY_SPEED)
+    frame_count = replay_frames(WEBSOCKET_REPLAY_FILE, lambda frame: handle_websocket_message(frame, arbitrager_queue, accept), stop_event, WEBSOCKET_REPLAY_SPEED)
+    websocket_log.info("Replayed {:,} frames.", frame_count)
+
+
+def websocket_connection(connection_index: int, world_ids: List[int], arbitrager_queue, stop_event, accept: Callable[[str, int, int], bool] = None, recorder: FrameRecorder = None):
+    """One websocket connection that subscribes to the channels of `world_ids`, its frames are decoded on its own thread."""
     def on_open(ws):
-        for world_id in worlds.keys():
+        for world_id in world_ids:
             ws.send(bson.encode({"event": "subscribe", "channel": "sales/add{world=" + str(world_id) + "}"}))
             ws.send(bson.encode({"event": "subscribe", "channel": "listings/add{world=" + str(world_id) + "}"}))
+            ws.send(bson.encode({"event": "subscribe", "channel": "listings/remove{world=" + str(world_id) + "}"}))
     def on_message(ws, encoded_message):
-        message = bson.decode(encoded_message)
-        if message["event"] == "sales/add":
-            arbitrager_queue.put(Event.sale(parse_sale_event(message)))
-        elif message["event"] == "listings/add":
-            arbitrager_queue.put(Event.listing(parse_listing_event(message)))
+        if recorder is not None:
+            recorder.record(encoded_message)
+        handle_websocket_message(encoded_message, arbitrager_queue, accept)
     def on_close(ws, close_status_code, close_msg):
-        print(f"WebSocket closed. Code: {close_status_code}, Message: {close_msg}")
+        websocket_log.warning("WebSocket {} closed. Code: {}, Message: {}", connection_index, close_status_code, close_msg)
     def on_error(ws, error):
-        print(f"WebSocket error: {error}")
+        websocket_log.error("WebSocket {} error: {}", connection_index, error)
 
-    print("Starting websocket_client.")
+    websocket_log.info("Starting websocket connection {} for {} world(s).", connection_index, len(world_ids))
 
     while not stop_event.is_set():
         ws = websocket.WebSocketApp(
@@ -89,95 +285,326 @@ def websocket_client(arbitrager_queue, stop_event):
             time.sleep(0.2)
 
         if stop_event.is_set():
-            print("Stop event set, closing websocket client.")
+            websocket_log.info("Stop event set, closing websocket connection {}.", connection_index)
             try:
                 ws.close()
             except Exception:
                 pass
             break
 
-        print("Websocket disconnected, attempting to reconnect in 5 seconds...")
+        websocket_log.warning("Websocket {} disconnected, attempting to reconnect in 5 seconds...", connection_index)
         try:
             ws.close()
         except Exception:
             pass
         time.sleep(5)  # Wait before reconnecting
 
-    print("Stopped websocket_client.")
 
+def websocket_client(arbitrager_queue, stop_event, accept: Callable[[str, int, int], bool] = None):
+    """Spreads the subscriptions of the tracked worlds over `WEBSOCKET_CONNECTIONS` connections, which all feed `arbitrager_queue`."""
+    if WEBSOCKET_REPLAY_FILE:
+        replay_client(arbitrager_queue, stop_event, accept)
+        return
+    recorder = FrameRecorder(WEBSOCKET_RECORD_FILE) if WEBSOCKET_RECORD_FILE else None
+    world_ids = list(worlds.keys())
+    connection_count = max(1, min(WEBSOCKET_CONNECTIONS, len(world_ids)))
+    connections = [
+        threading.Thread(target=websocket_connection, args=(connection_index, world_ids[connection_index::connection_count], arbitrager_queue, stop_event, accept, recorder))
+        for connection_index in range(connection_count)
+    ]
+
+    websocket_log.info("Starting websocket_client with {} connection(s) for {} world(s).", connection_count, len(world_ids))
+    for connection in connections:
+        connection.start()
+    for connection in connections:
+        connection.join()
+
+    if recorder is not None:
+        recorder.close()
+        websocket_log.info("Recorded {:,} frames to {}.", recorder.frame_count, WEBSOCKET_RECORD_FILE)
+    websocket_log.info("Stopped websocket_client.")
 
-def arbitrager(arbitrager_queue, http_scraper_queue, stop_event):
+
+def run_arbitrager(market_board: MarketBoardStore, snapshot: MarketBoardSnapshot, arbitrager_queue, http_scraper_queue, db_writer: DbWriter, notify: Callable[[Any, str], Any], stop_event, on_handled: Callable[[Event], Any] = None, sales_history: SalesHistory = None, warm_start: WarmStart = None, journal: MarketBoardJournal = None):
+    arbitrage_matrix = ArbitrageMatrix(market_board, ARBITRAGE_SELL_WORLDS, WorldSettings(SELL_TAX, BUY_TAX, ARBITRAGE_PROFIT_THRESHOLD), ARBITRAGE_WORLD_SETTINGS)
+    def on_update_market_board(items: List[MarketBoardCurrentData]):
+        # The lowest prices are read here, the log writer thread must not read the items while listings change them.
+        log_prices = market_board_log.isEnabledFor(logging.DEBUG)
+        for item in items:
+            if log_prices:
+                market_board_log.debug("Updated market board for {}, lowest price on {} for low quality is {:,} gil, and high quality is {:,} gil.", Lazy(get_item_name, item.item_id), Lazy(get_world_name, HOME_WORLD), item.min_listing_on_world(HOME_WORLD, False), item.min_listing_on_world(HOME_WORLD, True))
+            market_board[item.item_id] = item
+        if journal is not None:
+            journal.record_items(items)
+        else:
+            snapshot.write_items(items)
+    sale_statistics = market_board.sale_statistics
+    def expected_sell_days(item_id: int, world_id: int, hq: bool, quantity: int) -> float:
+        velocity = sale_statistics.velocity(item_id, world_id, hq)
+        if velocity == 0 and world_id in market_board.world_columns:
+            # No sales were seen yet, fall back to the velocity of the history that was fetched over HTTP.
+            velocity = float(market_board.sale_velocity[market_board.item_rows[item_id], market_board.world_columns[world_id], HQ if hq else NQ])
+        return quantity / velocity if velocity > 0 else math.inf
+    def on_sale(sale_event: SaleEvent):
+        for sale in sale_event.sales:
+            sale_statistics.record(sale_event.item_code, sale_event.world_id, sale.hq, sale.price_per_unit, sale.quantity, sale.timestamp)
+            if db_writer is not None:
+                db_writer.insert_row(sale.timestamp, sale_event.world_id, sale_event.item_code, sale.price_per_unit, sale.quantity, sale.hq)
+            sale_log.info("{} ({}) purchased {:,} × {}{} for {:,} gil each, totaling {:,} gil.", sale.buyer_name, Lazy(get_world_name, sale_event.world_id), sale.quantity, Lazy(get_item_name, sale_event.item_code), " (high-quality)" if sale.hq else "", sale.price_per_unit, sale.total)
+        if REFRESH_ITEM_ON_HOME_WORLD_SALE and sale_event.world_id == HOME_WORLD:
+            http_scraper_queue.put(Event.update_item({ "item_code": sale_event.item_code, "queued_at": time.time() }))
+    def on_listing(listing_event: ListingEvent, evaluate: bool = True):
+        if listing_event.item_code not in market_board:
+            listing_log.error("{} ({}) not in market board.", Lazy(get_item_name, listing_event.item_code), listing_event.item_code)
+            return
+        item = market_board[listing_event.item_code]
+        for listing in listing_event.listings:
+            listing_log.info("{} ({}) listed {:,} × {}{} for {:,} gil each, totaling {:,} gil.", listing.retainerName, Lazy(get_world_name, listing_event.world_id), listing.quantity, Lazy(get_item_name, listing_event.item_code), " (high-quality)" if listing.hq else "", listing.price_per_unit, listing.total)
+        found_opportunities = []
+        if evaluate:
+            started_at = time.perf_counter()
+            found_opportunities = arbitrage_matrix.evaluate(item, listing_event.world_id, listing_event.listings)
+            evaluate_seconds.observe(time.perf_counter() - started_at)
+        for opportunity in found_opportunities:
+            listing = opportunity.listing
+            sell_days = expected_sell_days(listing_event.item_code, opportunity.sell_world_id, listing.hq, opportunity.sellable_quantity)
+            if ARBITRAGE_MAX_SELL_DAYS and sell_days > ARBITRAGE_MAX_SELL_DAYS:
+                continue
+            opportunities.inc(opportunity.sell_world_id)
+            is_hq = " (high-quality)" if listing.hq else ""
+            # Prefer the sales seen on the sell world, then its sales history, over the averages taken when the item
+            # was indexed. The sales history is read in the background, until it is the averages are used.
+            average_price = sale_statistics.price(listing_event.item_code, opportunity.sell_world_id, listing.hq)
+            if not average_price and sales_history is not None:
+                summary = sales_history.summary(listing_event.item_code, opportunity.sell_world_id, listing.hq, SALES_HISTORY_DAYS)
+                if summary is not None:
+                    average_price = summary.average_price
+            if not average_price:
+                average_price = item.hq_average_price if listing.hq else item.nq_average_price
+            # Items that were never sold have no average price to compare with.
+            versus_average_price = f" ({(opportunity.sell_price / average_price - 1) * 100:,.1f}%)" if average_price else ""
+            sold_quantity = f"{opportunity.sellable_quantity} of them " if opportunity.sellable_quantity < listing.quantity else ""
+            notification_msg = f"{listing.quantity} × **[{get_item_name(listing_event.item_code)}{is_hq}](https://universalis.app/market/{listing_event.item_code})** can be bought on **{get_world_name(listing_event.world_id)}** from {listing.retainerName} for {listing.price_per_unit:,.0f} gil each and {sold_quantity}sold on {get_world_name(opportunity.sell_world_id)} for {opportunity.sell_price:,.0f} gil each on average{versus_average_price}, resulting in **{opportunity.profit:,.0f} gil** profit."
+            if math.isfinite(sell_days):
+                notification_msg += f" At the recent pace this sells in {sell_days:,.1f} days."
+            arbitrage_log.info("{}", notification_msg)
+            if notify is not None:
+                notify((listing_event.item_code, listing_event.world_id, listing.retainerName, listing.price_per_unit, opportunity.sell_world_id), notification_msg)
+        # Apply the listings after evaluating them, so a listing is never compared against itself.
+        books = set()
+        for line in listing_event.listings:
+            listing = listing_from_event_line(listing_event.world_id, line)
+            replaced = item.apply_listing_added(listing)
+            books.add((listing.world_id, listing.hq))
+            if replaced is not None:
+                books.add((replaced.world_id, replaced.hq))
+            if journal is not None:
+                journal.record_listing_added(listing_event.item_code, listing)
+        market_board.refresh_min_prices(listing_event.item_code, books)
+    def on_listing_removed(listing_event: ListingEvent):
+        if listing_event.item_code not in market_board:
+            return
+        item = market_board[listing_event.item_code]
+        books = set()
+        for line in listing_event.listings:
+            listing = listing_from_event_line(listing_event.world_id, line)
+            removed = item.apply_listing_removed(listing)
+            if removed is not None:
+                books.add((removed.world_id, removed.hq))
+                if journal is not None:
+                    journal.record_listing_removed(listing_event.item_code, listing)
+        if books:
+            market_board.refresh_min_prices(listing_event.item_code, books)
+    def handle_event(event: Event):
+        # Listings of items that are still being indexed are handled once the item is on the market board.
+        if warm_start is not None and event.type in (Event.Listing, Event.ListingRemoved) and event.args.item_code not in market_board and warm_start.park(event):
+            return
+        events = {
+            Event.UpdateMarketBoard: on_update_market_board,
+            # Stale listings still update the market board, but the opportunity is most likely gone.
+            Event.Listing: lambda listing_event: on_listing(listing_event, evaluate=not event.stale),
+            Event.ListingRemoved: on_listing_removed,
+            Event.Sale: on_sale
+        }
+        if event.type not in events:
+            log.warning("Unhandled event type '{}' with args '{}'.", event.type, event.args)
+            return
+        events[event.type](event.args)
+    log.info("Starting arbitrager.")
+    while not stop_event.is_set():
+        indexing = warm_start is not None and not warm_start.complete
+        if indexing:
+            warm_start.apply_batches(on_update_market_board, handle_event)
+        elif journal is not None:
+            journal.maybe_compact(market_board)
+        try:
+            event: Event = arbitrager_queue.get(timeout=0.1 if indexing else 1)
+            started_at = time.perf_counter()
+            queue_wait_seconds.observe(started_at - event.received_at, event.type)
+            handle_event(event)
+            handled_at = time.perf_counter()
+            handle_seconds.observe(handled_at - started_at, event.type)
+            if event.type == Event.Listing:
+                decision_seconds.observe(handled_at - event.received_at)
+            if on_handled is not None:
+                on_handled(event)
+        except queue.Empty:
+            continue
+    if sales_history is not None:
+        sales_history.close()
+    log.info("Stopped arbitrager.")
+
+
+def create_sales_history() -> Optional[SalesHistory]:
+    if DB_PARAMS.is_valid() and SALES_HISTORY_DAYS > 0:
+        return SalesHistory(DB_PARAMS).start()
+    return None
+
+
+def create_journal(snapshot: MarketBoardSnapshot, shard=None) -> MarketBoardJournal:
+    return MarketBoardJournal(snapshot.filename, shard, flush_interval=MARKET_BOARD_JOURNAL_FLUSH_SECONDS, compact_interval=MARKET_BOARD_COMPACT_MINUTES * 60, changed=snapshot.replayed_item_ids).start()
+
+
+def arbitrager(market_board: MarketBoardStore, market_board_ready, arbitrager_queue, http_scraper_queue, db_writer: DbWriter, discord_dispatcher: DiscordDispatcher, stop_event):
+    journal = None
     try:
-        market_board = get_market_board(stop_event, MARKET_BOARD_DATA_EXPIRES_AFTER_HOURS)
-        def on_update_market_board(items: List[MarketBoardCurrentData]):
-            for item in items:
-                nq_lowest_listing_price = item.min_listing_on_world(HOME_WORLD, False)
-                hq_lowest_listing_price = item.min_listing_on_world(HOME_WORLD, True)
-                print(f"Updated market board for {get_item_name(item.item_id)}, lowest price on {get_world_name(HOME_WORLD)} for low quality is {nq_lowest_listing_price:,} gil, and high quality is {hq_lowest_listing_price:,} gil.")
-                market_board[item.item_id] = item
-        def on_sale(sale_event: SaleEvent):
-            for sale in sale_event.sales:
-                is_hq = " (high-quality)" if sale.hq else ""
-                if DB_PARAMS.is_valid():
-                    db_insert_row(sale.timestamp, sale_event.world_id, sale_event.item_code, sale.price_per_unit, sale.quantity, sale.hq, DB_PARAMS)
-                print(f"{sale.buyer_name} ({get_world_name(sale_event.world_id)}) purchased {sale.quantity:,} × {get_item_name(sale_event.item_code)}{is_hq} for {sale.price_per_unit:,} gil each, totaling {sale.total:,} gil.")
-            if sale_event.world_id == HOME_WORLD:
-                http_scraper_queue.put(Event.update_item({ "item_code": sale_event.item_code }))
-        def on_listing(listing_event: ListingEvent):
-            if listing_event.item_code not in market_board:
-                print(f"ERROR: {get_item_name(listing_event.item_code)} ({listing_event.item_code}) not in market board.")
+        warm_start = None
+        if MARKET_BOARD_WARM_START:
+            snapshot = open_market_board(market_board)
+            if snapshot.is_empty():
+                def on_indexed():
+                    # The indexed items are all in the journal, compacting it saves the whole market board.
+                    journal.compact(market_board)
+                    market_board_ready.set()
+                log.info("Market board is not cached and is indexed in the background using {} worker(s), events are handled in the meantime.", MARKET_BOARD_INDEX_WORKERS)
+                # Items that were indexed before the index was interrupted are loaded from the journal already.
+                item_ids = [item_id for item_id in get_marketable_items() if item_id not in market_board]
+                warm_start = WarmStart(item_ids, MARKET_BOARD_INDEX_WORKERS, ARBITRAGER_MAX_EVENT_AGE_SECONDS, on_indexed).start(stop_event)
+            else:
+                market_board_ready.set()
+        else:
+            snapshot = load_market_board(market_board, stop_event, MARKET_BOARD_INDEX_WORKERS)
+            if snapshot is None:
                 return
-            item = market_board[listing_event.item_code]
-            for listing in listing_event.listings:
-                is_hq = " (high-quality)" if listing.hq else ""
-                print(f"{listing.retainerName} ({get_world_name(listing_event.world_id)}) listed {listing.quantity:,} × {get_item_name(listing_event.item_code)}{is_hq} for {listing.price_per_unit:,} gil each, totaling {listing.total:,} gil.")
-                lowest_listing_price = item.min_listing_on_world(HOME_WORLD, listing.hq)
-                arbitrage_profit = (1 - SELL_TAX) * lowest_listing_price * listing.quantity - (1 + BUY_TAX) * listing.price_per_unit * listing.quantity
-                if arbitrage_profit >= ARBITRAGE_PROFIT_THRESHOLD:
-                    average_price = item.hq_average_price if listing.hq else item.nq_average_price
-                    listing_price_vs_average_price_percentage = lowest_listing_price / average_price
-                    notification_msg = f"{listing.quantity} × **[{get_item_name(listing_event.item_code)}{is_hq}](https://universalis.app/market/{listing_event.item_code})** can be bought on **{get_world_name(listing_event.world_id)}** from {listing.retainerName} for {listing.price_per_unit:,.0f} gil each and sold on {get_world_name(HOME_WORLD)} for {lowest_listing_price:,.0f} gil each ({(listing_price_vs_average_price_percentage-1)*100:,.1f}%), resulting in **{arbitrage_profit:,.0f} gil** profit."
-                    print(f"ARBITRAGE: {notification_msg}")
-                    dispatch_discord_notification(notification_msg, os.getenv("DISCORD_WEBHOOK"))
-        def handle_event(event: Event):
-            events = {
-                Event.UpdateMarketBoard: on_update_market_board,
-                Event.Listing: on_listing,
-                Event.Sale: on_sale
-            }
-            if event.type not in events:
-                print(f"Unhandled event type '{event.type}' with args '{event.args}'.")
-                return
-            events[event.type](event.args)
-        print("Starting arbitrager.")
-        while not stop_event.is_set():
-            try:
-                event: Event = arbitrager_queue.get(timeout=1)
-                handle_event(event)
-            except queue.Empty:
-                continue
-        print("Stopped arbitrager.")
+            market_board_ready.set()
+        notify = discord_dispatcher.notify if discord_dispatcher is not None else None
+        journal = create_journal(snapshot)
+        run_arbitrager(market_board, snapshot, arbitrager_queue, http_scraper_queue, db_writer, notify, stop_event, sales_history=create_sales_history(), warm_start=warm_start, journal=journal)
     except Exception as err:
-        print("ERROR: ", err)
+        log.exception("Arbitrager failed: {}", err)
         stop_event.set()
+    if journal is not None:
+        journal.stop()
+    if market_board_ready.is_set():
+        snapshot.save(market_board)
+
+
+def forward_events(source, target: EventQueue, stop_event):
+    while not stop_event.is_set():
+        try:
+            target.put(source.get(timeout=1))
+        except queue.Empty:
+            continue
+
+
+def arbitrager_shard(shard_index: int, shard_count: int, shard_ready, shard_queue, http_scraper_queue, notification_queue, stop_event, handled_events=None):
+    """
+    Worker process of the sharded mode, it owns the items with `item_id % shard_count == shard_index`. Events are moved
+    from the inter-process `shard_queue` into a local `EventQueue`, so listings are handled first within a shard too.
+    `handled_events` is an optional `multiprocessing.Value` that counts the handled events.
+    """
+    # The log writer thread of the main process does not exist in the forked process.
+    setup_logging()
+    arbitrager_queue = EventQueue(ARBITRAGER_QUEUE_SIZE, ARBITRAGER_MAX_EVENT_AGE_SECONDS)
+    threading.Thread(target=forward_events, args=(shard_queue, arbitrager_queue, stop_event), daemon=True).start()
+    on_handled = None
+    if handled_events is not None:
+        def on_handled(event: Event):
+            with handled_events.get_lock():
+                handled_events.value += 1
+    db_writer = None
     if DB_PARAMS.is_valid():
-        db_flush_rows(DB_PARAMS)
+        db_writer = DbWriter(DB_PARAMS, max_buffered_rows=DB_MAX_BUFFERED_ROWS, flush_rows=DB_FLUSH_ROWS, flush_interval=DB_FLUSH_INTERVAL_SECONDS, update_rollups=not DB_USE_TIMESCALE).start()
+    market_board = MarketBoardStore()
+    snapshot = MarketBoardSnapshot()
+    journal = None
+    if METRICS_PORT:
+        # Every shard has its own metrics, served on the ports after the one of the main process. The values that
+        # were recorded by the main process before it forked, e.g. while indexing, are not counted again.
+        metrics.reset()
+        Gauge("arbitrager_queue_depth", "Events waiting in the queues of this shard.", lambda: shard_queue.qsize() + arbitrager_queue.qsize())
+        Gauge("market_board_items", "Items loaded by this shard.", lambda: len(market_board.loaded))
+        if db_writer is not None:
+            Gauge("db_buffered_rows", "Sales waiting to be written to the database.", db_writer.buffer.qsize)
+        start_metrics_server(METRICS_PORT + 1 + shard_index)
+    try:
+        snapshot.load(market_board, shard=(shard_index, shard_count))
+        shard_ready.set()
+        log.info("Loaded shard {}/{} with {:,} items.", shard_index + 1, shard_count, len(market_board))
+        notify = lambda key, message: notification_queue.put((key, message))
+        journal = create_journal(snapshot, shard=(shard_index, shard_count))
+        run_arbitrager(market_board, snapshot, arbitrager_queue, http_scraper_queue, db_writer, notify, stop_event, on_handled, create_sales_history(), journal=journal)
+    except Exception as err:
+        log.exception("Arbitrager shard {} failed: {}", shard_index, err)
+        stop_event.set()
+    if journal is not None:
+        journal.stop()
+    # The arrays are owned by the main process, a shard only writes back the items it has changed.
+    snapshot.write_items(market_board.loaded.values())
+    snapshot.write_sale_statistics(market_board.sale_statistics)
+    snapshot.close()
+    if db_writer is not None:
+        db_writer.stop()
+    stop_logging()
+
+
+def notification_forwarder(notification_queue, discord_dispatcher: DiscordDispatcher, stop_event):
+    while not stop_event.is_set():
+        try:
+            key, message = notification_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        if discord_dispatcher is not None:
+            discord_dispatcher.notify(key, message)
 
 
 def main():
     stop_event = threading.Event()
     signal.signal(signal.SIGINT, lambda _, __: stop_event.set())
 
+    load_catalogs()
+
+    discord_dispatcher = None
+    if DISCORD_WEBHOOK:
+        discord_dispatcher = DiscordDispatcher(DISCORD_WEBHOOK, DISCORD_BATCH_SECONDS, DISCORD_DEDUPLICATION_SECONDS).start()
+    else:
+        log.warning("Discord notifications are not dispatched, because the `DISCORD_WEBHOOK` environment variable is not defined.")
+
+    db_writer = None
     if DB_PARAMS.is_valid():
         initialize_database(DB_PARAMS, DB_USE_TIMESCALE)
+        db_writer = DbWriter(DB_PARAMS, max_buffered_rows=DB_MAX_BUFFERED_ROWS, flush_rows=DB_FLUSH_ROWS, flush_interval=DB_FLUSH_INTERVAL_SECONDS, update_rollups=not DB_USE_TIMESCALE).start()
 
     http_scraper_queue = queue.Queue()
-    arbitrager_queue = queue.Queue()
+    arbitrager_queue = EventQueue(ARBITRAGER_QUEUE_SIZE, ARBITRAGER_MAX_EVENT_AGE_SECONDS)
+    market_board = MarketBoardStore()
+    market_board_ready = threading.Event()
+    frame_filter = FrameFilter(market_board, market_board_ready, keep_sales=DB_PARAMS.is_valid() or sale_log.isEnabledFor(logging.INFO))
+
+    if METRICS_PORT:
+        Gauge("arbitrager_queue_depth", "Events waiting for the arbitrager.", arbitrager_queue.qsize)
+        Gauge("http_scraper_queue_depth", "Item refresh requests waiting for the HTTP scraper.", http_scraper_queue.qsize)
+        Gauge("market_board_items", "Items in the market board.", lambda: market_board.size)
+        if db_writer is not None:
+            Gauge("db_buffered_rows", "Sales waiting to be written to the database.", db_writer.buffer.qsize)
+        start_metrics_server(METRICS_PORT)
+        log.info("Serving metrics on http://127.0.0.1:{}/metrics.", METRICS_PORT)
 
     threads = [
         threading.Thread(target=http_scraper, args=(http_scraper_queue, arbitrager_queue, stop_event)),
-        threading.Thread(target=websocket_client, args=(arbitrager_queue, stop_event)),
-        threading.Thread(target=arbitrager, args=(arbitrager_queue, http_scraper_queue, stop_event)),
+        threading.Thread(target=websocket_client, args=(arbitrager_queue, stop_event, frame_filter)),
+        threading.Thread(target=arbitrager, args=(market_board, market_board_ready, arbitrager_queue, http_scraper_queue, db_writer, discord_dispatcher, stop_event)),
+        threading.Thread(target=market_board_refresher, args=(market_board, market_board_ready, arbitrager_queue, stop_event)),
     ]
 
     for t in threads:
@@ -192,6 +619,97 @@ def main():
     for t in threads:
         t.join()
 
+    if db_writer is not None:
+        db_writer.stop()
+    if discord_dispatcher is not None:
+        discord_dispatcher.stop()
+
+
+def main_sharded(shard_count: int):
+    """
+    Runs one arbitrager process per shard. The websocket client and the HTTP refresh results are routed to the shard
+    that owns the item, notifications of all shards go through the single Discord dispatcher of the main process.
+    """
+    stop_event = multiprocessing.Event()
+    signal.signal(signal.SIGINT, lambda _, __: stop_event.set())
+
+    load_catalogs()
+
+    if DB_PARAMS.is_valid():
+        initialize_database(DB_PARAMS, DB_USE_TIMESCALE)
+
+    # The main process keeps the arrays of the whole market board, the refresher uses them to find stale items.
+    market_board = MarketBoardStore()
+    market_board_ready = threading.Event()
+    frame_filter = FrameFilter(market_board, market_board_ready, keep_sales=DB_PARAMS.is_valid() or sale_log.isEnabledFor(logging.INFO))
+    snapshot = load_market_board(market_board, stop_event, MARKET_BOARD_INDEX_WORKERS)
+    if snapshot is None:
+        return
+    market_board_ready.set()
+
+    http_scraper_queue = multiprocessing.Queue()
+    notification_queue = multiprocessing.Queue()
+    arbitrager_queue = ShardedQueue([multiprocessing.Queue() for _ in range(shard_count)])
+    shard_ready = [multiprocessing.Event() for _ in range(shard_count)]
+    processes = [
+        multiprocessing.Process(target=arbitrager_shard, args=(shard_index, shard_count, shard_ready[shard_index], arbitrager_queue.queues[shard_index], http_scraper_queue, notification_queue, stop_event))
+        for shard_index in range(shard_count)
+    ]
+    threads = [
+        threading.Thread(target=http_scraper, args=(http_scraper_queue, arbitrager_queue, stop_event)),
+        threading.Thread(target=websocket_client, args=(arbitrager_queue, stop_event, frame_filter)),
+        threading.Thread(target=market_board_refresher, args=(market_board, market_board_ready, arbitrager_queue, stop_event)),
+    ]
+
+    # The shards are forked while this process has no other threads, a lock held by a thread at the moment of the
+    # fork stays locked forever in the child. The log writer thread is stopped until the shards are started.
+    stop_logging()
+    for p in processes:
+        p.start()
+    setup_logging()
+
+    discord_dispatcher = None
+    if DISCORD_WEBHOOK:
+        discord_dispatcher = DiscordDispatcher(DISCORD_WEBHOOK, DISCORD_BATCH_SECONDS, DISCORD_DEDUPLICATION_SECONDS).start()
+    else:
+        log.warning("Discord notifications are not dispatched, because the `DISCORD_WEBHOOK` environment variable is not defined.")
+    threads.append(threading.Thread(target=notification_forwarder, args=(notification_queue, discord_dispatcher, stop_event)))
+    for t in threads:
+        t.start()
+
+    if METRICS_PORT:
+        # Registered after the shards are started, so the forked shards do not inherit these gauges.
+        Gauge("arbitrager_queue_depth", "Events waiting for the arbitrager shards.", arbitrager_queue.qsize)
+        Gauge("http_scraper_queue_depth", "Item refresh requests waiting for the HTTP scraper.", http_scraper_queue.qsize)
+        start_metrics_server(METRICS_PORT)
+        log.info("Serving metrics on http://127.0.0.1:{}/metrics, the metrics of shard n on port {} + n.", METRICS_PORT, METRICS_PORT + 1)
+
+    try:
+        while any(p.is_alive() for p in processes) and not stop_event.is_set():
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    stop_event.set()
+
+    for t in threads:
+        t.join()
+    for p in processes:
+        p.join()
+
+    # Fold the items written by the shards back into the arrays.
+    snapshot.load(market_board)
+    snapshot.save(market_board)
+
+    if discord_dispatcher is not None:
+        discord_dispatcher.stop()
+
 
 if __name__ == "__main__":
-    main()
+    setup_logging()
+    try:
+        if ARBITRAGER_SHARDS > 1:
+            main_sharded(ARBITRAGER_SHARDS)
+        else:
+            main()
+    finally:
+        stop_logging()
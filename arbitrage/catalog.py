@@ -0,0 +1,208 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+import json
+import os
+import threading
+import time
+import requests
+from arbitrage import universalis
+from arbitrage.http_cache import CachedResponse, http_cache
+from arbitrage.log import get_logger
+
+
+ITEMS_URL = "https://raw.githubusercontent.com/ffxiv-teamcraft/ffxiv-teamcraft/master/libs/data/src/lib/json/items.json"
+CATALOG_VERSION = 2
+CACHE_DIRECTORY = ".cache"
+DEFAULT_LANGUAGE = "en"
+# Delay before the item names are downloaded again when there are none, doubled after every failure.
+RETRY_SECONDS = 60
+MAX_RETRY_SECONDS = 60 * 60
+
+log = get_logger("catalog")
+
+
+class ItemCatalog:
+    """
+    Item names from the teamcraft `items.json`, which is kept in the HTTP cache and revalidated after
+    `max_age_in_days`. Every time its content is downloaded, it is split into one compact `{item_id: name}` file per
+    language, so a start only reads the English names. Other languages are read from disk when they are first
+    requested. When the download fails the outdated response is used instead, without one the download is retried
+    in the background, with a growing delay, until it succeeds.
+    """
+    def __init__(self, cache_directory: str = CACHE_DIRECTORY, max_age_in_days: float = 7):
+        self.cache_directory = cache_directory
+        self.max_age_in_seconds = max_age_in_days * 24 * 60 * 60
+        self.names: Dict[int, str] = {}
+        self.translations: Dict[str, Dict[int, str]] = {}
+        self.is_loaded = False
+        self.retry_seconds = RETRY_SECONDS
+        self.retry: Optional[threading.Timer] = None
+
+    def load(self):
+        try:
+            self.names = self.read_names(DEFAULT_LANGUAGE)
+        except (requests.RequestException, ValueError) as err:
+            log.warning("Downloading item names failed and there are no cached item names, retrying in {:.0f}s: {}", self.retry_seconds, err)
+            self.schedule_retry()
+        self.translations = {DEFAULT_LANGUAGE: self.names}
+        self.is_loaded = True
+
+    def schedule_retry(self):
+        self.retry = threading.Timer(self.retry_seconds, self.load)
+        self.retry.daemon = True
+        self.retry.start()
+        self.retry_seconds = min(2 * self.retry_seconds, MAX_RETRY_SECONDS)
+
+    def cache_filename(self, language: str) -> str:
+        return os.path.join(self.cache_directory, f"item_names.v{CATALOG_VERSION}.{language}.json")
+
+    def read_names(self, language: str) -> Dict[int, str]:
+        """
+        The names in `language` from its file. `items.json` is only read from the HTTP cache when it needs to be
+        revalidated, or when it was downloaded after the file was written.
+        """
+        header = http_cache.read_header(ITEMS_URL)
+        cached = self.read_cache(language)
+        if header is None or time.time() - header["fetched_at"] >= self.max_age_in_seconds or cached is None or cached["downloaded_at"] != header["downloaded_at"]:
+            response = http_cache.get(ITEMS_URL, self.max_age_in_seconds, self.fetch_items, "items")
+            if cached is None or cached["downloaded_at"] != response.downloaded_at:
+                self.write_cache(response)
+                cached = self.read_cache(language)
+        return cached["names"] if cached else {}
+
+    def write_cache(self, response: CachedResponse):
+        items = response.json()
+        languages = {language for translations in items.values() for language in translations}
+        os.makedirs(self.cache_directory, exist_ok=True)
+        for language in languages:
+            names = {item_id: translations[language] for item_id, translations in items.items() if translations.get(language)}
+            filename = self.cache_filename(language)
+            with open(f"{filename}.tmp", "w", encoding="utf-8") as f:
+                json.dump({"version": CATALOG_VERSION, "downloaded_at": response.downloaded_at, "names": names}, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(f"{filename}.tmp", filename)
+
+    def read_cache(self, language: str):
+        filename = self.cache_filename(language)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("version") != CATALOG_VERSION:
+            return None
+        cached["names"] = {int(item_id): name for item_id, name in cached["names"].items()}
+        return cached
+
+    @staticmethod
+    def fetch_items(headers):
+        log.info("Downloading item names.")
+        response = universalis.session.get(ITEMS_URL, headers=headers, timeout=60)
+        response.raise_for_status()
+        return response
+
+    def name(self, item_id: int, language: str = DEFAULT_LANGUAGE) -> str:
+        if not self.is_loaded:
+            self.load()
+        names = self.names if language == DEFAULT_LANGUAGE else self.language(language)
+        name = names.get(item_id)
+        return name if name is not None else f"Undefined ({item_id})"
+
+    def language(self, language: str) -> Dict[int, str]:
+        if language not in self.translations:
+            try:
+                self.translations[language] = self.read_names(language)
+            except (requests.RequestException, ValueError) as err:
+                log.warning("Reading the {} item names failed: {}", language, err)
+                return {}
+        return self.translations[language]
+
+    def item_ids(self) -> List[int]:
+        """All item IDs that have an English name, in ascending order."""
+        if not self.is_loaded:
+            self.load()
+        return sorted(self.names)
+
+
+@dataclass
+class DataCenter:
+    name: str
+    region: str
+    world_ids: List[int]
+
+
+# Used when the worlds were never downloaded, these are the worlds the app tracked before they were configurable.
+FALLBACK_WORLDS = {
+    33: "Twintania",
+    36: "Lich",
+    42: "Zodiark",
+    56: "Phoenix",
+    66: "Odin",
+    67: "Shiva",
+    402: "Alpha",
+}
+
+
+class WorldCatalog:
+    """
+    Worlds and data centers from the Universalis `/worlds` and `/data-centers` endpoints, which are kept in the HTTP
+    cache. When they can't be downloaded and were never cached, only `FALLBACK_WORLDS` are known.
+    """
+    def __init__(self):
+        self.names: Dict[int, str] = dict(FALLBACK_WORLDS)
+        self.data_centers: List[DataCenter] = []
+        self.is_loaded = False
+
+    def load(self):
+        try:
+            worlds = universalis.cached_http_get(f"{universalis.api_address}/worlds", "worlds").json()
+            data_centers = universalis.cached_http_get(f"{universalis.api_address}/data-centers", "data-centers").json()
+        except (requests.RequestException, RuntimeError, ValueError) as err:
+            log.warning("Downloading worlds failed and there are no cached worlds, only {} are known: {}", ", ".join(FALLBACK_WORLDS.values()), err)
+        else:
+            self.names = {world["id"]: world["name"] for world in worlds}
+            self.data_centers = [DataCenter(dc["name"], dc["region"], dc["worlds"]) for dc in data_centers]
+        self.is_loaded = True
+
+    def name(self, world_id: int) -> str:
+        name = self.names.get(world_id)
+        return name if name is not None else f"Undefined ({world_id})"
+
+    def resolve(self, selection: str) -> Dict[int, str]:
+        """
+        Resolve a comma separated list of regions, data centers, world names and world IDs (case insensitive), e.g.
+        `Europe`, `Light,Chaos` or `33,Lich`, into the selected worlds.
+        """
+        if not self.is_loaded:
+            self.load()
+        world_ids_by_name = {name.lower(): world_id for world_id, name in self.names.items()}
+        selected = {}
+        for entry in filter(None, (entry.strip() for entry in selection.split(","))):
+            key = entry.lower()
+            data_centers = [dc for dc in self.data_centers if key in (dc.name.lower(), dc.region.lower())]
+            if data_centers:
+                world_ids = [world_id for dc in data_centers for world_id in dc.world_ids]
+            elif entry.isdigit():
+                world_ids = [int(entry)]
+            elif key in world_ids_by_name:
+                world_ids = [world_ids_by_name[key]]
+            else:
+                raise ValueError(f"Unknown region, data center or world '{entry}'.")
+            for world_id in world_ids:
+                selected[world_id] = self.name(world_id)
+        return selected
+
+    def scopes(self, world_ids: Iterable[int]) -> List[str]:
+        """
+        The smallest set of Universalis scopes (one data center, otherwise regions) whose market data covers all of
+        `world_ids`. Without data centers the scope of the fallback worlds is used.
+        """
+        world_ids = set(world_ids)
+        covering = [dc for dc in self.data_centers if world_ids & set(dc.world_ids)]
+        if not covering:
+            return ["europe"]
+        if len(covering) == 1:
+            return [covering[0].name]
+        return sorted({dc.region for dc in covering})
+
+
+catalog = ItemCatalog()
+world_catalog = WorldCatalog()
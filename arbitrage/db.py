@@ -1,14 +1,21 @@
 from dataclasses import dataclass
-from datetime import timezone, datetime
+from datetime import timedelta, timezone, datetime
+from typing import List, Optional
+import io
+import queue
+import threading
+import time
 import psycopg2
+from arbitrage.log import get_logger
+from arbitrage.metrics import Counter, Histogram
 
 
 TABLE_NAME = "ffxiv_market_board_sales"
 
-INSERT_ROW_QUERY = f"""
-INSERT INTO {TABLE_NAME} (time, world_id, item_id, price, quantity, hq)
-VALUES (%s, %s, %s, %s, %s, %s);
-"""
+log = get_logger("database")
+flush_seconds = Histogram("db_flush_seconds", "Time to COPY one batch of sales into the database.")
+rows_written = Counter("db_rows_written_total", "Sales written to the database.")
+rows_dropped = Counter("db_rows_dropped_total", "Sales dropped because the buffer was full or the batch kept failing.")
 
 CREATE_TABLE_QUERY = f"""
 CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
@@ -26,8 +33,83 @@ HYPERTABLE_QUERY = f"""
 SELECT create_hypertable('{TABLE_NAME}', 'time', if_not_exists => TRUE);
 """
 
-BUFFER_SIZE = 100
-row_buffer = []
+# Rollups per (item, world, hq), named after the table they aggregate, e.g. `ffxiv_market_board_sales_hourly`.
+ROLLUPS = {
+    "hour": "hourly",
+    "day": "daily",
+}
+
+ROLLUP_COLUMNS = "bucket, item_id, world_id, hq, open_time, open, high, low, close_time, close, volume, count, turnover"
+
+CREATE_ROLLUP_TABLE_QUERY = """
+CREATE TABLE IF NOT EXISTS {rollup} (
+    bucket TIMESTAMP NOT NULL,
+    item_id INTEGER NOT NULL,
+    world_id SMALLINT NOT NULL,
+    hq BOOLEAN NOT NULL,
+    open_time TIMESTAMP NOT NULL,
+    open INTEGER NOT NULL,
+    high INTEGER NOT NULL,
+    low INTEGER NOT NULL,
+    close_time TIMESTAMP NOT NULL,
+    close INTEGER NOT NULL,
+    volume BIGINT NOT NULL,
+    count BIGINT NOT NULL,
+    turnover BIGINT NOT NULL,
+    PRIMARY KEY (item_id, world_id, hq, bucket)
+);
+"""
+
+# Aggregates the sales in `source` per bucket, `open` and `close` are the prices of the first and the last sale.
+AGGREGATE_QUERY = f"""
+INSERT INTO {{rollup}} AS r ({ROLLUP_COLUMNS})
+SELECT date_trunc('{{resolution}}', time), item_id, world_id, hq,
+    min(time), (array_agg(price ORDER BY time))[1], max(price), min(price),
+    max(time), (array_agg(price ORDER BY time DESC))[1],
+    sum(quantity), count(*), sum(price::BIGINT * quantity)
+FROM {{source}}
+GROUP BY 1, 2, 3, 4
+ON CONFLICT (item_id, world_id, hq, bucket) DO UPDATE SET
+    open = CASE WHEN EXCLUDED.open_time < r.open_time THEN EXCLUDED.open ELSE r.open END,
+    open_time = LEAST(r.open_time, EXCLUDED.open_time),
+    high = GREATEST(r.high, EXCLUDED.high),
+    low = LEAST(r.low, EXCLUDED.low),
+    close = CASE WHEN EXCLUDED.close_time >= r.close_time THEN EXCLUDED.close ELSE r.close END,
+    close_time = GREATEST(r.close_time, EXCLUDED.close_time),
+    volume = r.volume + EXCLUDED.volume,
+    count = r.count + EXCLUDED.count,
+    turnover = r.turnover + EXCLUDED.turnover;
+"""
+
+# With TimescaleDB the rollups are continuous aggregates with the same columns. Real-time aggregation adds the sales
+# that are not materialized yet, the policy materializes everything that was invalidated since its last run.
+CREATE_CONTINUOUS_AGGREGATE_QUERY = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS {rollup}
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT time_bucket(INTERVAL '1 {resolution}', time) AS bucket, item_id, world_id, hq,
+    min(time) AS open_time, first(price, time) AS open, max(price) AS high, min(price) AS low,
+    max(time) AS close_time, last(price, time) AS close,
+    sum(quantity) AS volume, count(*) AS count, sum(price::BIGINT * quantity) AS turnover
+FROM {table_name}
+GROUP BY bucket, item_id, world_id, hq
+WITH NO DATA;
+SELECT add_continuous_aggregate_policy('{rollup}', start_offset => NULL, end_offset => INTERVAL '1 {resolution}', schedule_interval => INTERVAL '{schedule}', if_not_exists => TRUE);
+"""
+
+POLICY_SCHEDULES = {
+    "hour": "15 minutes",
+    "day": "1 hour",
+}
+
+
+# The sales history is read while the app is running, a database that does not respond must not hold it up.
+CONNECT_TIMEOUT_SECONDS = 5
+STATEMENT_TIMEOUT_MILLISECONDS = 2_000
+
+
+def rollup_name(table_name: str, resolution: str) -> str:
+    return f"{table_name}_{ROLLUPS[resolution]}"
+
 
 @dataclass
 class DbParameters:
@@ -54,22 +136,257 @@ def initialize_database(db_params: DbParameters, use_timescale_db=False):
             cur.execute(CREATE_TABLE_QUERY)
             if use_timescale_db:
                 cur.execute(HYPERTABLE_QUERY)
+            create_rollups(cur, TABLE_NAME, use_timescale_db)
 
 
-def db_insert_row(unix_time: int, world_id: int, item_id: int, price: int, quantity: int, hq: bool, db_params: DbParameters):
-    global row_buffer
-    time = datetime.fromtimestamp(unix_time, tz=timezone.utc)
-    row_buffer.append((time, world_id, item_id, price, quantity, hq))
-    if len(row_buffer) >= BUFFER_SIZE:
-        db_flush_rows(db_params)
+def create_rollups(cur, table_name: str = TABLE_NAME, use_timescale_db=False):
+    """Create the hourly and daily rollups of `table_name`, new rollup tables are filled from the existing sales."""
+    for resolution in ROLLUPS:
+        rollup = rollup_name(table_name, resolution)
+        if use_timescale_db:
+            cur.execute(CREATE_CONTINUOUS_AGGREGATE_QUERY.format(rollup=rollup, resolution=resolution, table_name=table_name, schedule=POLICY_SCHEDULES[resolution]))
+            continue
+        cur.execute("SELECT to_regclass(%s)", (rollup,))
+        exists = cur.fetchone()[0] is not None
+        cur.execute(CREATE_ROLLUP_TABLE_QUERY.format(rollup=rollup))
+        if not exists:
+            log.info("Filling {} from {}.", rollup, table_name)
+            cur.execute(AGGREGATE_QUERY.format(rollup=rollup, resolution=resolution, source=table_name))
 
 
-def db_flush_rows(db_params: DbParameters):
-    global row_buffer
-    if not row_buffer:
-        return
-    print("DATABASE: Writing row buffer to database.")
-    with psycopg2.connect(**db_params.as_dict()) as conn:
-        with conn.cursor() as cur:
-            cur.executemany(INSERT_ROW_QUERY, row_buffer)
-    row_buffer.clear()
+class DbWriter:
+    """
+    Writes sale rows to the database from a dedicated thread over one long-lived connection, using `COPY` for bulk
+    ingestion. Rows are flushed when `flush_rows` rows are buffered or `flush_interval` seconds passed. The buffer is
+    bounded, `insert_row` waits up to `put_timeout` seconds for space and drops the row when the buffer stays full.
+    Failed batches are retried on a new connection up to `retries` times before they are dropped.
+
+    With `update_rollups`, a batch is copied into a temporary table first and is added to the table and aggregated
+    into the hourly and daily rollups in the same transaction. This is not needed when the rollups are TimescaleDB
+    continuous aggregates.
+    """
+    def __init__(self, db_params: DbParameters, table_name=TABLE_NAME, max_buffered_rows=100_000, flush_rows=1_000, flush_interval=5.0, put_timeout=0.05, retries=3, update_rollups=True):
+        self.db_params = db_params
+        self.update_rollups = update_rollups
+        copy_table = "sales_batch" if update_rollups else table_name
+        self.copy_query = f"COPY {copy_table} (time, world_id, item_id, price, quantity, hq) FROM STDIN WITH (FORMAT csv)"
+        self.create_batch_query = f"CREATE TEMPORARY TABLE IF NOT EXISTS sales_batch (LIKE {table_name}) ON COMMIT DELETE ROWS"
+        self.apply_batch_queries = [f"INSERT INTO {table_name} SELECT * FROM sales_batch"] + [
+            AGGREGATE_QUERY.format(rollup=rollup_name(table_name, resolution), resolution=resolution, source="sales_batch")
+            for resolution in ROLLUPS
+        ]
+        self.buffer = queue.Queue(maxsize=max_buffered_rows)
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.connection = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.batches_written = 0
+        self.batches_retried = 0
+        self.batches_dropped = 0
+        self.flush_seconds = 0.0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        log.info("{:,} rows written in {:,} batches, {:,} rows dropped, {:,} batches retried, {:,} batches dropped.", self.rows_written, self.batches_written, self.rows_dropped, self.batches_retried, self.batches_dropped)
+
+    def insert_row(self, unix_time: int, world_id: int, item_id: int, price: int, quantity: int, hq: bool) -> bool:
+        try:
+            self.buffer.put((unix_time, world_id, item_id, price, quantity, hq), timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self.rows_dropped += 1
+            rows_dropped.inc()
+            return False
+
+    def run(self):
+        while not (self.stop_event.is_set() and self.buffer.empty()):
+            rows = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.flush_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0 or (self.stop_event.is_set() and self.buffer.empty()):
+                    break
+                try:
+                    rows.append(self.buffer.get(timeout=min(timeout, 0.5)))
+                except queue.Empty:
+                    continue
+            if rows:
+                self.write_batch(rows)
+        if self.connection is not None:
+            self.connection.close()
+
+    def write_batch(self, rows):
+        data = io.StringIO()
+        for unix_time, world_id, item_id, price, quantity, hq in rows:
+            data.write(f"{datetime.fromtimestamp(unix_time, tz=timezone.utc).isoformat()},{world_id},{item_id},{price},{quantity},{hq}\n")
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.batches_retried += 1
+                time.sleep(min(2 ** attempt, 30))
+            try:
+                started_at = time.perf_counter()
+                if self.connection is None or self.connection.closed:
+                    self.connection = psycopg2.connect(**self.db_params.as_dict())
+                data.seek(0)
+                with self.connection.cursor() as cur:
+                    if self.update_rollups:
+                        cur.execute(self.create_batch_query)
+                    cur.copy_expert(self.copy_query, data)
+                    if self.update_rollups:
+                        for query in self.apply_batch_queries:
+                            cur.execute(query)
+                self.connection.commit()
+                elapsed = time.perf_counter() - started_at
+                flush_seconds.observe(elapsed)
+                rows_written.inc(amount=len(rows))
+                self.flush_seconds += elapsed
+                self.rows_written += len(rows)
+                self.batches_written += 1
+                return
+            except psycopg2.Error as err:
+                log.warning("Writing {:,} rows failed (attempt {}): {}", len(rows), attempt + 1, err)
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+        self.batches_dropped += 1
+        self.rows_dropped += len(rows)
+        rows_dropped.inc(amount=len(rows))
+
+
+@dataclass
+class SalesBucket:
+    bucket: datetime
+    item_id: int
+    world_id: int
+    hq: bool
+    open_time: datetime
+    open: int
+    high: int
+    low: int
+    close_time: datetime
+    close: int
+    volume: int
+    count: int
+    turnover: int
+    @property
+    def average_price(self) -> float:
+        return self.turnover / self.volume if self.volume else 0.0
+
+
+@dataclass
+class SalesSummary:
+    average_price: float
+    volume: int
+    count: int
+    velocity: float
+
+
+class SalesHistory:
+    """
+    Reads the sales history of items from the hourly and daily rollups over one long-lived connection. `summary` is
+    called by the arbitrager on every opportunity and never waits for the database: summaries are cached for
+    `cache_seconds`, one that is not cached is read by a background thread and is `None` until it is. An expired
+    summary is returned while it is read again.
+    """
+    def __init__(self, db_params: DbParameters, table_name=TABLE_NAME, cache_seconds=600.0, max_requests=1_000):
+        self.db_params = db_params
+        self.table_name = table_name
+        self.cache_seconds = cache_seconds
+        self.connection = None
+        self.lock = threading.Lock()
+        self.summaries = {}
+        self.requests = queue.Queue(maxsize=max_requests)
+        self.requested = set()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                key = self.requests.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.summaries[key] = (time.monotonic(), self.read_summary(*key))
+            self.requested.discard(key)
+
+    def query(self, query: str, params: tuple) -> list:
+        with self.lock:
+            try:
+                if self.connection is None or self.connection.closed:
+                    self.connection = psycopg2.connect(**self.db_params.as_dict(), connect_timeout=CONNECT_TIMEOUT_SECONDS, options=f"-c statement_timeout={STATEMENT_TIMEOUT_MILLISECONDS}")
+                    self.connection.autocommit = True
+                with self.connection.cursor() as cur:
+                    cur.execute(query, params)
+                    return cur.fetchall()
+            except psycopg2.Error:
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+                raise
+
+    def buckets(self, item_id: int, world_id: int = None, hq: bool = None, resolution: str = "hour", since: datetime = None, until: datetime = None) -> List[SalesBucket]:
+        """The hourly or daily buckets of an item in `[since, until)`, optionally of one world and quality, oldest first."""
+        conditions = ["item_id = %s"]
+        params = [item_id]
+        for condition, value in [("world_id = %s", world_id), ("hq = %s", hq), ("bucket >= %s", since), ("bucket < %s", until)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        query = f"SELECT {ROLLUP_COLUMNS} FROM {rollup_name(self.table_name, resolution)} WHERE {' AND '.join(conditions)} ORDER BY bucket, world_id, hq"
+        return [SalesBucket(*row) for row in self.query(query, tuple(params))]
+
+    def summary(self, item_id: int, world_id: int, hq: bool, days: int = 7) -> Optional[SalesSummary]:
+        """
+        The cached `read_summary` of an item on a world, or `None` when it has not been read yet. A summary that is
+        not cached or has expired is requested from the background thread.
+        """
+        key = (item_id, world_id, hq, days)
+        cached = self.summaries.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.cache_seconds:
+            return cached[1]
+        if key not in self.requested:
+            self.requested.add(key)
+            try:
+                self.requests.put_nowait(key)
+            except queue.Full:
+                self.requested.discard(key)
+        return cached[1] if cached is not None else None
+
+    def read_summary(self, item_id: int, world_id: int, hq: bool, days: int = 7) -> Optional[SalesSummary]:
+        """
+        Average price, volume, number of sales and units sold per day of an item on a world over the last `days`
+        days, or `None` when it has not been sold or the database is unavailable.
+        """
+        since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=days)
+        try:
+            volume, count, turnover = self.query(
+                f"SELECT sum(volume), sum(count), sum(turnover) FROM {rollup_name(self.table_name, 'hour')} WHERE item_id = %s AND world_id = %s AND hq = %s AND bucket >= %s",
+                (item_id, world_id, hq, since)
+            )[0]
+        except psycopg2.Error as err:
+            log.warning("Reading the sales history of {} failed: {}", item_id, err)
+            volume = None
+        return SalesSummary(float(turnover) / float(volume), int(volume), int(count), float(volume) / days) if volume else None
@@ -1,15 +1,27 @@
-from typing import Any
+from collections import defaultdict, deque
+from typing import Any, Dict, List
+import queue
+import threading
+import time
+from arbitrage.metrics import Counter
 
 
 class Event:
     Sale = "arbitrager/sale"
     Listing = "arbitrager/listing"
+    ListingRemoved = "arbitrager/listing-removed"
     UpdateItem = "http-scraper/update-item"
     UpdateMarketBoard = "arbitrager/update-market-board"
 
-    def __init__(self, type: str, args: Any):
+    __slots__ = ("type", "args", "received_at", "stale")
+
+    def __init__(self, type: str, args: Any, received_at: float = None):
         self.type = type
         self.args = args
+        # `time.perf_counter()` at which the data of the event was received, used to measure latency.
+        self.received_at = received_at if received_at is not None else time.perf_counter()
+        # Set by `EventQueue` when the event waited too long, a stale listing is applied but not evaluated.
+        self.stale = False
 
     @staticmethod
     def new(type: str, args: Any):
@@ -21,8 +33,115 @@ class Event:
     def listing(args: Any):
         return Event.new(Event.Listing, args)
     @staticmethod
+    def listing_removed(args: Any):
+        return Event.new(Event.ListingRemoved, args)
+    @staticmethod
     def update_item(args: Any):
         return Event.new(Event.UpdateItem, args)
     @staticmethod
     def update_market_board(args: Any):
-        return Event.new(Event.UpdateMarketBoard, args)
\ No newline at end of file
+        return Event.new(Event.UpdateMarketBoard, args)
+
+
+class ShardedQueue:
+    """
+    Queue-like router that puts every event on the queue of the shard that owns its item (`item_id % shard_count`).
+    Market board updates that span several shards are split into one update per shard.
+    """
+    def __init__(self, queues: List[Any]):
+        self.queues = queues
+
+    def shard_of(self, item_id: int) -> int:
+        return item_id % len(self.queues)
+
+    def put(self, event: Event):
+        if event.type == Event.UpdateMarketBoard:
+            items_per_shard = defaultdict(list)
+            for item in event.args:
+                items_per_shard[self.shard_of(item.item_id)].append(item)
+            for shard, items in items_per_shard.items():
+                self.queues[shard].put(Event.update_market_board(items))
+        else:
+            self.queues[self.shard_of(event.args.item_code)].put(event)
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+
+events_shed = Counter("arbitrager_events_shed_total", "Events dropped because the queue was full, or listings that were not evaluated because they were too old.", ["event", "reason"])
+
+
+class EventQueue:
+    """
+    Bounded queue for the arbitrager that hands out listings first, market board updates second and sales last, in
+    order of arrival within each priority. Listings of an item that is part of a queued market board update are
+    queued behind that update, so the update never replaces listings that arrived after it.
+
+    `put` never blocks: when the queue is full, the oldest sale is dropped, then the oldest listing, or the new event
+    when nothing of the same or a lower priority is queued. Market board updates are never dropped, the items in them
+    are marked as refresh requested and would not be requested again for hours; they are bounded by the rate of the
+    HTTP requests. Listings that waited longer than `max_age_seconds` are marked as stale, the opportunity is most
+    likely gone by then.
+    """
+    PRIORITIES = {
+        Event.Listing: 0,
+        Event.ListingRemoved: 0,
+        Event.UpdateMarketBoard: 1,
+        Event.Sale: 2,
+    }
+    LISTING_PRIORITY = 0
+    UPDATE_PRIORITY = 1
+    LOWEST_PRIORITY = 2
+
+    def __init__(self, maxsize: int = 100_000, max_age_seconds: float = 10.0):
+        self.maxsize = maxsize
+        self.max_age_seconds = max_age_seconds
+        self.queues = [deque() for _ in range(self.LOWEST_PRIORITY + 1)]
+        self.size = 0
+        # Number of queued market board updates that contain an item, by item ID.
+        self.queued_updates: Dict[int, int] = {}
+        self.condition = threading.Condition()
+
+    def put(self, event: Event) -> bool:
+        priority = self.PRIORITIES.get(event.type, self.LOWEST_PRIORITY)
+        with self.condition:
+            if self.size >= self.maxsize:
+                if self.queues[self.LOWEST_PRIORITY]:
+                    events_shed.inc(self.queues[self.LOWEST_PRIORITY].popleft().type, "overflow")
+                    self.size -= 1
+                elif self.queues[self.LISTING_PRIORITY] and priority <= self.UPDATE_PRIORITY:
+                    events_shed.inc(self.queues[self.LISTING_PRIORITY].popleft().type, "overflow")
+                    self.size -= 1
+                elif priority != self.UPDATE_PRIORITY:
+                    events_shed.inc(event.type, "overflow")
+                    return False
+            if priority == self.UPDATE_PRIORITY:
+                for item in event.args:
+                    self.queued_updates[item.item_id] = self.queued_updates.get(item.item_id, 0) + 1
+            elif priority == self.LISTING_PRIORITY and event.args.item_code in self.queued_updates:
+                priority = self.UPDATE_PRIORITY
+            self.queues[priority].append(event)
+            self.size += 1
+            self.condition.notify()
+        return True
+
+    def get(self, timeout: float = None) -> Event:
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.size > 0, timeout):
+                raise queue.Empty
+            event = next(events for events in self.queues if events).popleft()
+            self.size -= 1
+            if event.type == Event.UpdateMarketBoard:
+                for item in event.args:
+                    count = self.queued_updates[item.item_id] - 1
+                    if count:
+                        self.queued_updates[item.item_id] = count
+                    else:
+                        del self.queued_updates[item.item_id]
+        if event.type == Event.Listing and time.perf_counter() - event.received_at > self.max_age_seconds:
+            event.stale = True
+            events_shed.inc(event.type, "stale")
+        return event
+
+    def qsize(self) -> int:
+        return self.size
@@ -1,5 +1,15 @@
-import requests
+from typing import List
+import threading
 import time
+from arbitrage.log import get_logger
+from arbitrage.metrics import Counter, Histogram
+
+
+log = get_logger("http_scraper")
+refreshes_requested = Counter("http_scraper_refreshes_requested_total", "Item refreshes requested from the HTTP scraper.")
+requests_saved = Counter("http_scraper_requests_saved_total", "Item refreshes that did not need a request of their own, because they were fetched together with others.")
+refresh_failures = Counter("http_scraper_refresh_failures_total", "Requests of the HTTP scraper that failed, their items are requested again.")
+refresh_latency = Histogram("http_scraper_refresh_latency_seconds", "Time between requesting the refresh of an item and receiving its market data.", buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
 
 
 def pretty_number(n):
@@ -24,32 +34,70 @@ def batcher(list, n):
         yield batch
 
 
-class RateLimiter:
-    def __init__(self, requests_per_second: int):
-        self.counter = 0
-        self.requests_per_second = requests_per_second
-    def increase(self):
-        self.counter += 1
-        if self.counter >= self.requests_per_second:
-            self.counter = 0
-            time.sleep(1)
-
-
-discord_rate_limiter = RateLimiter(50)
-last_sended_messages_queue = []
-def dispatch_discord_notification(message, webhook_url):
-    global last_sended_messages_queue
-    if message in last_sended_messages_queue:
-        print("Discord notification already send recently, skipping.")
-        return
-    if not webhook_url:
-        print("WARNING: Discord notification is not dispatched, because the `DISCORD_WEBHOOK` environment variable is not defined.")
-        return
-    last_sended_messages_queue.append(message)
-    if len(last_sended_messages_queue) >= 10:
-        _ = last_sended_messages_queue.pop(0)
-    data = {"content": message}
-    response = requests.post(webhook_url, json=data)
-    discord_rate_limiter.increase()
-    if response.status_code != 204:
-        print(f"Failed to send Discord notification: {response.status_code} - {response.text}")
+class TokenBucket:
+    """
+    Thread-safe token bucket that allows `rate` requests per second on average and bursts of up to `capacity`.
+    A single bucket can be shared by all workers that talk to the same API.
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+    def acquire(self, tokens: float = 1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                else:
+                    wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds`, e.g. when the server answered with a `Retry-After` header."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class RefreshQueueStats:
+    """Counters for the coalescing refresh queue of the `http_scraper`."""
+    def __init__(self):
+        self.requested = 0
+        self.refreshed_items = 0
+        self.http_requests = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.reported_at = time.monotonic()
+        self.requested_at_last_request = 0
+    @property
+    def requests_saved(self) -> int:
+        return self.requested - self.http_requests
+    def record_requested(self):
+        self.requested += 1
+        refreshes_requested.inc()
+    def record_request(self, item_count: int, queued_at: List[float]):
+        now = time.time()
+        self.http_requests += 1
+        self.refreshed_items += item_count
+        requests_saved.inc(amount=self.requested - self.requested_at_last_request - 1)
+        self.requested_at_last_request = self.requested
+        for t in queued_at:
+            latency = now - t
+            refresh_latency.observe(latency)
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+    def report_every(self, seconds: float):
+        if time.monotonic() - self.reported_at < seconds:
+            return
+        self.reported_at = time.monotonic()
+        average_latency = self.total_latency / self.refreshed_items if self.refreshed_items else 0
+        log.info("{:,} refreshes requested, {:,} unique items refreshed in {:,} requests ({:,} requests saved), latency avg {:.1f}s, max {:.1f}s.", self.requested, self.refreshed_items, self.http_requests, self.requests_saved, average_latency, self.max_latency)
+
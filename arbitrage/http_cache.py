@@ -0,0 +1,157 @@
+from typing import Any, Callable, Dict, Optional
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from arbitrage.log import get_logger
+from arbitrage.metrics import Counter
+
+
+CACHE_DIRECTORY = os.path.join(".cache", "http")
+HTTP_OK = 200
+HTTP_NOT_MODIFIED = 304
+
+log = get_logger("http_cache")
+cache_requests = Counter("http_cache_requests_total", "Requests through the HTTP cache, by how they were answered.", ["endpoint", "result"])
+
+
+class CachedResponse:
+    """
+    The parts of a `requests.Response` that callers of the cache use. `fetched_at` is when the response was last
+    downloaded or revalidated, `downloaded_at` when its content was last downloaded.
+    """
+    __slots__ = ("url", "status_code", "content", "etag", "last_modified", "fetched_at", "downloaded_at")
+
+    def __init__(self, url: str, status_code: int, content: bytes, etag: Optional[str], last_modified: Optional[str], fetched_at: float, downloaded_at: float = None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.downloaded_at = downloaded_at if downloaded_at is not None else fetched_at
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class InFlight:
+    __slots__ = ("done", "response", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response: Optional[CachedResponse] = None
+        self.error: Optional[BaseException] = None
+
+
+class HttpCache:
+    """
+    Caches GET responses on disk as gzip files, one per URL. A response younger than its `ttl` is returned without
+    a request, an older one is revalidated with `If-None-Match` and `If-Modified-Since`, so an unchanged response
+    costs a `304 Not Modified` instead of the whole body. When the request fails the outdated response is returned.
+    Concurrent callers for the same URL wait for a single fetch.
+    """
+    def __init__(self, cache_directory: str = CACHE_DIRECTORY):
+        self.cache_directory = cache_directory
+        self.lock = threading.Lock()
+        self.in_flight: Dict[str, InFlight] = {}
+
+    def filename(self, url: str) -> str:
+        return os.path.join(self.cache_directory, hashlib.sha256(url.encode()).hexdigest()[:32] + ".gz")
+
+    def read(self, url: str) -> Optional[CachedResponse]:
+        try:
+            with gzip.open(self.filename(url), "rb") as f:
+                header = json.loads(f.readline())
+                content = f.read()
+        except (OSError, EOFError, ValueError):
+            return None
+        if header.get("url") != url:
+            return None
+        return CachedResponse(url, HTTP_OK, content, header.get("etag"), header.get("last_modified"), header["fetched_at"], header.get("downloaded_at"))
+
+    def read_header(self, url: str) -> Optional[Dict[str, Any]]:
+        """The `fetched_at` and `downloaded_at` of the cached response for `url`, without decompressing its content."""
+        try:
+            with gzip.open(self.filename(url), "rb") as f:
+                header = json.loads(f.readline())
+        except (OSError, EOFError, ValueError):
+            return None
+        if header.get("url") != url:
+            return None
+        header.setdefault("downloaded_at", header["fetched_at"])
+        return header
+
+    def write(self, response: CachedResponse):
+        os.makedirs(self.cache_directory, exist_ok=True)
+        filename = self.filename(response.url)
+        header = {"url": response.url, "etag": response.etag, "last_modified": response.last_modified, "fetched_at": response.fetched_at, "downloaded_at": response.downloaded_at}
+        # Level 6 compresses JSON nearly as well as level 9, in a fraction of the time.
+        with gzip.open(f"{filename}.tmp", "wb", compresslevel=6) as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            f.write(response.content)
+        os.replace(f"{filename}.tmp", filename)
+
+    def get(self, url: str, ttl: float, fetch: Callable[[Dict[str, str]], Any], endpoint: str = "other") -> CachedResponse:
+        """
+        Return the response for `url`. `fetch` is called with the conditional request headers and must return a
+        response with status 200 or 304, or raise.
+        """
+        with self.lock:
+            in_flight = self.in_flight.get(url)
+            is_leader = in_flight is None
+            if is_leader:
+                in_flight = self.in_flight[url] = InFlight()
+        if not is_leader:
+            cache_requests.inc(endpoint, "coalesced")
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.response
+        try:
+            in_flight.response = self.fetch(url, ttl, fetch, endpoint)
+            return in_flight.response
+        except BaseException as err:
+            in_flight.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[url]
+            in_flight.done.set()
+
+    def fetch(self, url: str, ttl: float, fetch: Callable[[Dict[str, str]], Any], endpoint: str) -> CachedResponse:
+        cached = self.read(url)
+        if cached is not None and time.time() - cached.fetched_at < ttl:
+            cache_requests.inc(endpoint, "hit")
+            return cached
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+        try:
+            response = fetch(headers)
+        except Exception as err:
+            if cached is None:
+                raise
+            cache_requests.inc(endpoint, "stale")
+            log.warning("Revalidating {} failed, using the response from {:.1f} hours ago: {}", url, (time.time() - cached.fetched_at) / 3600, err)
+            return cached
+        if response.status_code == HTTP_NOT_MODIFIED and cached is not None:
+            cache_requests.inc(endpoint, "revalidated")
+            cached.fetched_at = time.time()
+        else:
+            cache_requests.inc(endpoint, "miss")
+            cached = CachedResponse(url, response.status_code, response.content, response.headers.get("ETag"), response.headers.get("Last-Modified"), time.time())
+        self.write(cached)
+        return cached
+
+
+http_cache = HttpCache()
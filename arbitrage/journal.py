@@ -0,0 +1,140 @@
+from typing import Iterable, Optional, Set, Tuple
+import queue
+import sqlite3
+import threading
+import time
+from arbitrage.log import get_logger
+from arbitrage.metrics import Counter, Histogram
+from arbitrage.snapshot import JOURNAL_ITEM, JOURNAL_LISTING_ADDED, JOURNAL_LISTING_REMOVED, SNAPSHOT_FILENAME, MarketBoardSnapshot, encode_item_fields, encode_listing, item_fields
+from arbitrage.store import MarketBoardStore
+from arbitrage.universalis import Listing, MarketBoardCurrentData
+
+
+# Marks the point in the buffer up to which the journal is compacted, it is never written to the journal itself.
+JOURNAL_COMPACT = -1
+
+log = get_logger("market_board")
+journal_changes = Counter("market_board_journal_changes_total", "Market board changes written to the journal.")
+flush_seconds = Histogram("market_board_journal_flush_seconds", "Time to append one batch of changes to the journal.")
+compact_seconds = Histogram("market_board_journal_compact_seconds", "Time to write the changed items to the snapshot and drop the journal.")
+
+
+class MarketBoardJournal:
+    """
+    Append-only journal of the changes to the market board since it was last saved: replaced items, and added and
+    removed listings. Changes are buffered and written to the `journal` table of the snapshot by a dedicated thread
+    every `flush_interval` seconds or `flush_rows` changes, so the arbitrager never waits for the disk. A crash loses
+    at most the changes of the last `flush_interval` seconds, the rest is replayed when the snapshot is loaded.
+
+    Every `compact_interval` seconds, `maybe_compact` hands the items that changed to the writer, which writes them
+    and the arrays to the snapshot and drops the journal in the same transaction. A shard only compacts its own
+    items, the arrays belong to the main process. Items that were changed by replaying the journal on load are passed
+    as `changed`, so they are part of the first compaction.
+    """
+    def __init__(self, filename: str = SNAPSHOT_FILENAME, shard: Optional[Tuple[int, int]] = None, flush_rows: int = 1_000, flush_interval: float = 1.0, compact_interval: float = 600.0, changed: Iterable[int] = ()):
+        self.filename = filename
+        self.shard = shard
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.buffer = queue.Queue()
+        self.changed: Set[int] = set(changed)
+        self.compacted_at = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.changes_written = 0
+        self.compactions = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        log.info("{:,} market board changes written to the journal, compacted {:,} times.", self.changes_written, self.compactions)
+
+    def record_items(self, items: Iterable[MarketBoardCurrentData]):
+        for item in items:
+            self.buffer.put((item.item_id, JOURNAL_ITEM, item_fields(item)))
+            self.changed.add(item.item_id)
+
+    def record_listing_added(self, item_id: int, listing: Listing):
+        self.buffer.put((item_id, JOURNAL_LISTING_ADDED, listing))
+        self.changed.add(item_id)
+
+    def record_listing_removed(self, item_id: int, listing: Listing):
+        self.buffer.put((item_id, JOURNAL_LISTING_REMOVED, listing))
+        self.changed.add(item_id)
+
+    def compact(self, store: MarketBoardStore):
+        """
+        Take the state of the items that changed since the last compaction, and of the arrays, from the thread that
+        changes `store`. Encoding and writing them is left to the writer.
+        """
+        items = [item_fields(store.loaded[item_id]) for item_id in self.changed if item_id in store.loaded]
+        arrays = world_ids = None
+        if self.shard is None:
+            with store.lock:
+                arrays = store.arrays()
+                world_ids = list(store.world_ids)
+        self.buffer.put((None, JOURNAL_COMPACT, (items, arrays, world_ids)))
+        self.changed = set()
+        self.compacted_at = time.monotonic()
+
+    def maybe_compact(self, store: MarketBoardStore):
+        if time.monotonic() - self.compacted_at >= self.compact_interval:
+            self.compact(store)
+
+    def run(self):
+        snapshot = MarketBoardSnapshot(self.filename)
+        while not (self.stop_event.is_set() and self.buffer.empty()):
+            changes = []
+            compaction = None
+            deadline = time.monotonic() + self.flush_interval
+            while len(changes) < self.flush_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0 or (self.stop_event.is_set() and self.buffer.empty()):
+                    break
+                try:
+                    change = self.buffer.get(timeout=min(timeout, 0.5))
+                except queue.Empty:
+                    continue
+                if change[1] == JOURNAL_COMPACT:
+                    compaction = change[2]
+                    break
+                changes.append(change)
+            # Changes that were recorded before the compaction are part of it, they are written first so they are
+            # dropped with the rest of the journal.
+            if changes:
+                self.write_changes(snapshot, changes)
+            if compaction is not None:
+                self.write_compaction(snapshot, *compaction)
+        snapshot.close()
+
+    def write_changes(self, snapshot: MarketBoardSnapshot, changes):
+        started_at = time.perf_counter()
+        rows = [
+            (item_id, kind, encode_item_fields(change) if kind == JOURNAL_ITEM else encode_listing(change))
+            for item_id, kind, change in changes
+        ]
+        try:
+            snapshot.append_journal(rows)
+        except sqlite3.Error as err:
+            log.error("Writing {:,} market board changes to the journal failed: {}", len(rows), err)
+            return
+        flush_seconds.observe(time.perf_counter() - started_at)
+        journal_changes.inc(amount=len(rows))
+        self.changes_written += len(rows)
+
+    def write_compaction(self, snapshot: MarketBoardSnapshot, items, arrays, world_ids):
+        started_at = time.perf_counter()
+        try:
+            snapshot.compact_journal(items, arrays, world_ids, self.shard)
+        except sqlite3.Error as err:
+            log.error("Compacting the journal into the snapshot failed: {}", err)
+            return
+        elapsed = time.perf_counter() - started_at
+        compact_seconds.observe(elapsed)
+        self.compactions += 1
+        log.debug("Compacted the journal, wrote {:,} changed items in {:.2f}s.", len(items), elapsed)
@@ -0,0 +1,143 @@
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict
+import itertools
+import logging
+import queue
+import sys
+from arbitrage.metrics import Counter
+
+
+ROOT_LOGGER = "arbitrage"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# Sales and listings are logged for every event on every world, they are only useful while debugging.
+DEFAULT_LEVELS = {
+    "sale": logging.WARNING,
+    "listing": logging.WARNING,
+    "arbitrage": logging.INFO,
+}
+
+records_dropped = Counter("log_records_dropped_total", "Log records dropped because the log writer could not keep up.")
+
+
+class Lazy:
+    """Defers `function(*args)` until the message is formatted, so messages that are not logged never pay for it."""
+    __slots__ = ("function", "args")
+
+    def __init__(self, function: Callable, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.function(*self.args))
+
+    def __format__(self, format_spec: str) -> str:
+        return format(self.function(*self.args), format_spec)
+
+
+class Message:
+    """A `str.format` style message that is only formatted when the record is written."""
+    __slots__ = ("format_string", "args")
+
+    def __init__(self, format_string: str, args: tuple):
+        self.format_string = format_string
+        self.args = args
+
+    def __str__(self) -> str:
+        return self.format_string.format(*self.args) if self.args else self.format_string
+
+
+class CategoryLogger(logging.LoggerAdapter):
+    """
+    Logger of one category, e.g. `log.info("Listed {:,} × {}", quantity, Lazy(get_item_name, item_id))`. The level
+    is checked before anything is created and the message is formatted by the log writer thread.
+    """
+    def __init__(self, logger: logging.Logger):
+        super().__init__(logger, {})
+
+    def log(self, level: int, msg: str, *args: Any, exc_info=None, **kwargs):
+        if self.logger.isEnabledFor(level):
+            self.logger._log(level, Message(msg, args), (), exc_info=exc_info, **kwargs)
+
+
+class SamplingFilter(logging.Filter):
+    """Passes one of every `round(1 / rate)` records."""
+    def __init__(self, rate: float):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self.counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.every > 0 and next(self.counter) % self.every == 0
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queues records without formatting them, the `QueueListener` thread formats and writes them. Records are dropped
+    instead of blocking the caller when the queue is full.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Tracebacks refer to the frames of the calling thread, so these are still formatted here.
+        return super().prepare(record) if record.exc_info else record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            records_dropped.inc()
+
+
+def get_logger(category: str) -> CategoryLogger:
+    return CategoryLogger(logging.getLogger(f"{ROOT_LOGGER}.{category}"))
+
+
+def parse_categories(value: str, parse: Callable[[str], Any]) -> Dict[str, Any]:
+    """Parse `category=value` pairs separated by commas, e.g. `sale=INFO,listing=DEBUG`."""
+    categories = {}
+    for entry in filter(None, (entry.strip() for entry in value.split(","))):
+        category, category_value = entry.split("=", 1)
+        categories[category.strip()] = parse(category_value.strip())
+    return categories
+
+
+listener: QueueListener = None
+
+
+def configure_logging(level: str = "INFO", levels: str = "", sampling: str = "", filename: str = None, max_queued_records: int = 10_000):
+    """
+    Write all `arbitrage.*` logs from a background thread to `filename`, or stdout when not given. `levels` overrides
+    the level per category and `sampling` only keeps a fraction of the records of a category, e.g. `sale=0.01`.
+    """
+    global listener
+    stop_logging()
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level.upper())
+    root.propagate = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for category, category_level in {**DEFAULT_LEVELS, **parse_categories(levels, str.upper)}.items():
+        logging.getLogger(f"{ROOT_LOGGER}.{category}").setLevel(category_level)
+    for category, rate in parse_categories(sampling, float).items():
+        logger = logging.getLogger(f"{ROOT_LOGGER}.{category}")
+        for existing in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+            logger.removeFilter(existing)
+        logger.addFilter(SamplingFilter(rate))
+    output = logging.FileHandler(filename, encoding="utf-8") if filename else logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.Queue(maxsize=max_queued_records)
+    root.addHandler(DeferredQueueHandler(records))
+    listener = QueueListener(records, output)
+    listener.start()
+
+
+def stop_logging():
+    """Write the queued records and stop the log writer thread."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+
+for _category, _level in DEFAULT_LEVELS.items():
+    logging.getLogger(f"{ROOT_LOGGER}.{_category}").setLevel(_level)
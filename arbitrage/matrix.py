@@ -0,0 +1,108 @@
+from dataclasses import dataclass
+from typing import Dict, List
+import numpy as np
+from arbitrage.store import HQ, NQ, MarketBoardStore
+from arbitrage.universalis import ListingEventLine, MarketBoardCurrentData
+
+
+@dataclass
+class WorldSettings:
+    sell_tax: float
+    buy_tax: float
+    profit_threshold: float
+
+
+@dataclass
+class Opportunity:
+    item_id: int
+    buy_world_id: int
+    sell_world_id: int
+    listing: ListingEventLine
+    sell_price: float
+    profit: float
+    sellable_quantity: int
+
+
+def parse_world_settings(value: str, default: WorldSettings) -> Dict[int, WorldSettings]:
+    """
+    Parse per-world overrides in the format `world_id:sell_tax:buy_tax:profit_threshold`, separated by commas.
+    Trailing values can be left out, e.g. `36:0.03` only overrides the sell tax of Lich.
+    """
+    settings = {}
+    for entry in filter(None, (entry.strip() for entry in value.split(","))):
+        world_id, *values = entry.split(":")
+        defaults = [default.sell_tax, default.buy_tax, default.profit_threshold]
+        values = [float(v) for v in values] + defaults[len(values):]
+        settings[int(world_id)] = WorldSettings(*values)
+    return settings
+
+
+class ArbitrageMatrix:
+    """
+    Evaluates listings against the order book of the same item and quality on every sell world. The `MarketBoardStore`
+    arrays select the sell worlds that have listings and the profit is computed in one vectorized pass. Every world has
+    its own taxes and profit threshold, the buy tax of the world where the listing is bought and the sell tax of the
+    world where it is sold are applied.
+    """
+    def __init__(self, store: MarketBoardStore, sell_world_ids: List[int], default_settings: WorldSettings, world_settings: Dict[int, WorldSettings] = None):
+        self.store = store
+        self.sell_world_ids = sell_world_ids
+        self.default_settings = default_settings
+        self.world_settings = world_settings or {}
+        self.world_ids = []
+
+    def settings(self, world_id: int) -> WorldSettings:
+        return self.world_settings.get(world_id, self.default_settings)
+
+    def update_world_columns(self):
+        # The store adds world columns when it sees a new world, so the per-world vectors are rebuilt when needed.
+        self.world_ids = list(self.store.world_ids)
+        settings = [self.settings(world_id) for world_id in self.world_ids]
+        self.sell_tax = np.array([s.sell_tax for s in settings])
+        self.profit_threshold = np.array([s.profit_threshold for s in settings])
+        self.is_sell_world = np.isin(self.world_ids, self.sell_world_ids)
+
+    def evaluate(self, item: MarketBoardCurrentData, world_id: int, listings: List[ListingEventLine]) -> List[Opportunity]:
+        """
+        Return every profitable (listing, sell world) pair, ordered by profit from high to low. The quantity of a
+        listing is valued by walking the order book of the sell world from the lowest price up, units beyond the
+        depth of the book are assumed to be unsellable.
+        """
+        store = self.store
+        row = store.item_rows.get(item.item_id)
+        if row is None or not listings:
+            return []
+        if len(self.world_ids) != len(store.world_ids):
+            self.update_world_columns()
+        buy_tax = self.settings(world_id).buy_tax
+        price = np.array([listing.price_per_unit for listing in listings], dtype=np.float64)
+        quantity = np.array([listing.quantity for listing in listings], dtype=np.float64)
+        quality = np.array([HQ if listing.hq else NQ for listing in listings])
+        is_candidate = self.is_sell_world.copy()
+        if world_id in store.world_columns:
+            is_candidate[store.world_columns[world_id]] = False
+        # Only the sell worlds that have listings of the same quality have an order book to walk.
+        has_book = ~np.isnan(store.min_price[row, :, quality]) & is_candidate
+        sell_value = np.zeros(has_book.shape)
+        sellable_quantity = np.zeros(has_book.shape)
+        for listing_index, column in zip(*np.nonzero(has_book)):
+            listing = listings[listing_index]
+            book = item.order_book(self.world_ids[column], listing.hq)
+            if book is not None:
+                sell_value[listing_index, column], sellable_quantity[listing_index, column] = book.value(listing.quantity)
+        profit = (1 - self.sell_tax) * sell_value - (1 + buy_tax) * (price * quantity)[:, None]
+        is_profitable = (profit >= self.profit_threshold) & (sellable_quantity > 0)
+        listing_indices, columns = np.nonzero(is_profitable)
+        order = np.argsort(-profit[listing_indices, columns], kind="stable")
+        return [
+            Opportunity(
+                item.item_id,
+                world_id,
+                self.world_ids[columns[i]],
+                listings[listing_indices[i]],
+                float(sell_value[listing_indices[i], columns[i]] / sellable_quantity[listing_indices[i], columns[i]]),
+                float(profit[listing_indices[i], columns[i]]),
+                int(sellable_quantity[listing_indices[i], columns[i]])
+            )
+            for i in order
+        ]
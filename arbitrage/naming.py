@@ -1,27 +1,22 @@
-import requests
+from typing import Dict
+from arbitrage.catalog import FALLBACK_WORLDS, catalog, world_catalog
+
 
-item_names = {}
 def get_item_name(item_id: int) -> str:
-    global item_names
-    if not item_names:
-        print("Loading item names.")
-        item_names = requests.get("https://raw.githubusercontent.com/ffxiv-teamcraft/ffxiv-teamcraft/master/libs/data/src/lib/json/items.json").json()
-    if item_id in item_names:
-        return item_names[item_id]["en"]
-    if str(item_id) in item_names:
-        return item_names[str(item_id)]["en"]
-    return f"Undefined ({item_id})"
-
-
-worlds = {
-    33: "Twintania",
-    36: "Lich",
-    42: "Zodiark",
-    56: "Phoenix",
-    66: "Odin",
-    67: "Shiva",
-    402: "Alpha",
-}
+    return catalog.name(item_id)
+
+
+# The worlds that are tracked, changed in place by `select_worlds` so every module that imported it sees the selection.
+worlds: Dict[int, str] = dict(FALLBACK_WORLDS)
+
+
+def select_worlds(selection: str) -> Dict[int, str]:
+    """Track the regions, data centers and worlds in `selection`, see `WorldCatalog.resolve`."""
+    selected = world_catalog.resolve(selection)
+    worlds.clear()
+    worlds.update(selected)
+    return worlds
+
+
 def get_world_name(world_id: int) -> str:
-    global worlds
-    return worlds[world_id]
\ No newline at end of file
+    return world_catalog.name(world_id)
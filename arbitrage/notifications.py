@@ -0,0 +1,156 @@
+from collections import OrderedDict
+from typing import Hashable, List
+import queue
+import threading
+import time
+import requests
+from arbitrage.log import get_logger
+from arbitrage.metrics import Counter, Histogram
+
+
+DISCORD_MAX_MESSAGE_LENGTH = 2000
+
+log = get_logger("discord")
+post_seconds = Histogram("discord_post_seconds", "Latency of Discord webhook posts, including rate limit waits.")
+notifications = Counter("discord_notifications_total", "Discord notifications by outcome.", ["outcome"])
+
+
+class DiscordDispatcher:
+    """
+    Sends Discord webhook notifications from a dedicated thread, so the caller never waits on the network.
+
+    Messages that arrive within `batch_seconds` of each other are combined into one webhook message (up to
+    Discord's 2000 character limit). Messages with a key that was seen in the last `deduplication_seconds`
+    are skipped. The rate limit follows the `X-RateLimit-*` headers that Discord sends with every response, a message
+    that is still rate limited after `max_retries` attempts is dropped.
+    """
+    def __init__(self, webhook_url: str, batch_seconds: float = 1.0, deduplication_seconds: float = 600, max_queued_messages: int = 1_000, max_retries: int = 5):
+        self.webhook_url = webhook_url
+        self.batch_seconds = batch_seconds
+        self.deduplication_seconds = deduplication_seconds
+        self.max_retries = max_retries
+        self.messages = queue.Queue(maxsize=max_queued_messages)
+        self.recent_keys = OrderedDict()
+        self.session = requests.Session()
+        self.remaining = 1
+        self.reset_at = 0.0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.sent_requests = 0
+        self.duplicates = 0
+        self.dropped = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def notify(self, key: Hashable, message: str) -> bool:
+        """Queue `message` unless a message with the same `key` was queued recently, never blocks."""
+        now = time.monotonic()
+        while self.recent_keys:
+            oldest_key, expires_at = next(iter(self.recent_keys.items()))
+            if expires_at > now:
+                break
+            del self.recent_keys[oldest_key]
+        if key in self.recent_keys:
+            self.duplicates += 1
+            notifications.inc("duplicate")
+            return False
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+            notifications.inc("dropped")
+            log.warning("Discord notification queue is full, dropping notification.")
+            return False
+        self.recent_keys[key] = now + self.deduplication_seconds
+        notifications.inc("queued")
+        return True
+
+    def run(self):
+        while not (self.stop_event.is_set() and self.messages.empty()):
+            try:
+                batch = [self.messages.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.batch_seconds
+            while not self.stop_event.is_set() and time.monotonic() < deadline:
+                try:
+                    batch.append(self.messages.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            for content in combine_messages(batch):
+                started_at = time.perf_counter()
+                try:
+                    self.post(content)
+                except Exception as err:
+                    # The thread must survive any response, otherwise every later notification is lost.
+                    log.exception("Failed to send Discord notification: {}", err)
+                post_seconds.observe(time.perf_counter() - started_at)
+
+    def post(self, content: str):
+        for attempt in range(self.max_retries + 1):
+            wait = self.reset_at - time.monotonic()
+            if self.remaining <= 0 and wait > 0:
+                time.sleep(wait)
+            try:
+                response = self.session.post(self.webhook_url, json={"content": content}, timeout=10)
+            except requests.RequestException as err:
+                log.error("Failed to send Discord notification: {}", err)
+                return
+            self.sent_requests += 1
+            self.update_rate_limit(response)
+            if response.status_code == 429:
+                self.remaining = 0
+                self.reset_at = time.monotonic() + retry_after(response)
+                continue
+            if response.status_code != 204:
+                log.error("Failed to send Discord notification: {} - {}", response.status_code, response.text)
+            return
+        notifications.inc("rate_limited")
+        log.error("Dropping Discord notification, still rate limited after {} attempts.", self.max_retries + 1)
+
+    def update_rate_limit(self, response: requests.Response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset_after = response.headers.get("X-RateLimit-Reset-After")
+        try:
+            if remaining is not None:
+                self.remaining = int(remaining)
+            if reset_after is not None:
+                self.reset_at = time.monotonic() + float(reset_after)
+        except ValueError:
+            log.warning("Ignoring invalid rate limit headers: {} remaining, reset after {}.", remaining, reset_after)
+
+
+def retry_after(response: requests.Response) -> float:
+    """
+    Seconds to wait after a 429 response, from the `retry_after` of the JSON body, the `Retry-After` header, or 1
+    second when neither can be read, e.g. for an HTML error page of a proxy.
+    """
+    try:
+        return float(response.json()["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        pass
+    try:
+        return float(response.headers["Retry-After"])
+    except (ValueError, KeyError):
+        return 1.0
+
+
+def combine_messages(messages: List[str]) -> List[str]:
+    """Join messages with newlines into as few Discord messages as possible."""
+    combined = []
+    current = ""
+    for message in messages:
+        message = message[:DISCORD_MAX_MESSAGE_LENGTH]
+        if current and len(current) + 1 + len(message) > DISCORD_MAX_MESSAGE_LENGTH:
+            combined.append(current)
+            current = ""
+        current = f"{current}\n{message}" if current else message
+    if current:
+        combined.append(current)
+    return combined
@@ -0,0 +1,63 @@
+from typing import Callable, Iterator, Tuple
+import gzip
+import struct
+import threading
+import time
+
+
+FRAME_HEADER = struct.Struct("<dI")
+
+
+class FrameRecorder:
+    """
+    Appends raw websocket frames with their receive time to a gzip compressed file. Every record is a little-endian
+    `(unix_time: float64, length: uint32)` header followed by the BSON frame itself.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.file = gzip.open(filename, "ab", compresslevel=1)
+        self.lock = threading.Lock()
+        self.frame_count = 0
+
+    def record(self, frame: bytes, received_at: float = None):
+        header = FRAME_HEADER.pack(received_at if received_at is not None else time.time(), len(frame))
+        with self.lock:
+            self.file.write(header)
+            self.file.write(frame)
+            self.frame_count += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_frames(filename: str) -> Iterator[Tuple[float, bytes]]:
+    with gzip.open(filename, "rb") as f:
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            received_at, length = FRAME_HEADER.unpack(header)
+            yield received_at, f.read(length)
+
+
+def replay_frames(filename: str, on_message: Callable[[bytes], None], stop_event, speed: float = 1.0) -> int:
+    """
+    Play the frames of a recording back into `on_message`, keeping the recorded gaps between frames divided by
+    `speed`. A speed of `0` replays the frames as fast as possible. Returns the number of frames replayed.
+    """
+    frame_count = 0
+    first_received_at = None
+    started_at = time.monotonic()
+    for received_at, frame in read_frames(filename):
+        if stop_event.is_set():
+            break
+        if first_received_at is None:
+            first_received_at = received_at
+        if speed > 0:
+            wait = (received_at - first_received_at) / speed - (time.monotonic() - started_at)
+            if wait > 0:
+                time.sleep(wait)
+        on_message(frame)
+        frame_count += 1
+    return frame_count
@@ -0,0 +1,308 @@
+from dataclasses import fields
+from operator import attrgetter
+from typing import Dict, Iterable, Optional, Set, Tuple
+import io
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+import numpy as np
+from arbitrage.log import get_logger
+from arbitrage.stats import RollingStats, SaleStatistics
+from arbitrage.store import ARRAY_NAMES, MarketBoardStore
+from arbitrage.universalis import Listing, MarketBoardCurrentData, RecentHistory, get_marketable_items, index_market_board
+
+
+SNAPSHOT_FILENAME = 'market_board.sqlite'
+LEGACY_PICKLE_FILENAME = 'market_board.pkl'
+
+log = get_logger("market_board")
+
+listing_values = attrgetter(*[f.name for f in fields(Listing)])
+recent_history_values = attrgetter(*[f.name for f in fields(RecentHistory)])
+
+CREATE_TABLES_QUERY = """
+CREATE TABLE IF NOT EXISTS items (
+    item_id INTEGER PRIMARY KEY,
+    last_update INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    payload BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS arrays (
+    name TEXT PRIMARY KEY,
+    saved_at REAL NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sale_statistics (
+    item_id INTEGER PRIMARY KEY,
+    payload BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY,
+    item_id INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    payload BLOB NOT NULL
+);
+"""
+
+# Kinds of changes in the journal, see `MarketBoardJournal`.
+JOURNAL_ITEM = 0
+JOURNAL_LISTING_ADDED = 1
+JOURNAL_LISTING_REMOVED = 2
+
+
+def item_fields(item: MarketBoardCurrentData) -> tuple:
+    """The state of `item` for `encode_item_fields`, cheap enough to take on the arbitrager thread."""
+    return (
+        item.item_id,
+        item.nq_average_price,
+        item.hq_average_price,
+        item.nq_average_sale_velocity,
+        item.hq_average_sale_velocity,
+        list(item.listings),
+        list(item.recent_history),
+        item.last_update,
+    )
+
+
+def encode_item_fields(fields: tuple) -> bytes:
+    _, nq_average_price, hq_average_price, nq_average_sale_velocity, hq_average_sale_velocity, listings, recent_history, last_update = fields
+    return zlib.compress(json.dumps([
+        nq_average_price,
+        hq_average_price,
+        nq_average_sale_velocity,
+        hq_average_sale_velocity,
+        [listing_values(listing) for listing in listings],
+        [recent_history_values(sale) for sale in recent_history],
+        last_update,
+    ], separators=(",", ":")).encode())
+
+
+def encode_item(item: MarketBoardCurrentData) -> bytes:
+    return encode_item_fields(item_fields(item))
+
+
+def decode_item(item_id: int, payload: bytes) -> MarketBoardCurrentData:
+    nq_average_price, hq_average_price, nq_average_sale_velocity, hq_average_sale_velocity, listings, recent_history, last_update = json.loads(zlib.decompress(payload))
+    return MarketBoardCurrentData(
+        item_id,
+        nq_average_price,
+        hq_average_price,
+        nq_average_sale_velocity,
+        hq_average_sale_velocity,
+        [Listing(*listing) for listing in listings],
+        [RecentHistory(*sale) for sale in recent_history],
+        last_update
+    )
+
+
+def encode_listing(listing: Listing) -> bytes:
+    return json.dumps(listing_values(listing), separators=(",", ":")).encode()
+
+
+def decode_listing(payload: bytes) -> Listing:
+    return Listing(*json.loads(payload))
+
+
+def encode_sale_statistics(item: Dict[Tuple[int, bool], RollingStats]) -> bytes:
+    return zlib.compress(json.dumps([
+        [world_id, hq, stats.landmark, stats.volume, stats.turnover, stats.sales, stats.first_sale_at, stats.last_sale_at, list(stats.sketch.items())]
+        for (world_id, hq), stats in item.items()
+    ], separators=(",", ":")).encode())
+
+
+def decode_sale_statistics(payload: bytes) -> Dict[Tuple[int, bool], RollingStats]:
+    return {
+        (world_id, hq): RollingStats(landmark, volume, turnover, sales, first_sale_at, last_sale_at, dict(sketch))
+        for world_id, hq, landmark, volume, turnover, sales, first_sale_at, last_sale_at, sketch in json.loads(zlib.decompress(payload))
+    }
+
+
+def encode_array(array: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_array(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class MarketBoardSnapshot:
+    """
+    SQLite file with one compressed row per item, plus the `MarketBoardStore` arrays stored as `.npy` blobs.
+    Loading only reads the arrays, items are decoded when the arbitrager first accesses them. Single items can
+    be rewritten with `write_items`, they are newer than the arrays and are re-applied to the store on load. The
+    changes in the `journal` table are replayed last.
+    """
+    def __init__(self, filename: str = SNAPSHOT_FILENAME):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(CREATE_TABLES_QUERY)
+        # Items that were changed by the journal on load, they are not saved until the journal is compacted.
+        self.replayed_item_ids: Set[int] = set()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM arrays").fetchone()[0] == 0
+
+    def has_journal(self) -> bool:
+        with self.lock:
+            return self.connection.execute("SELECT EXISTS (SELECT 1 FROM journal)").fetchone()[0] == 1
+
+    def read_item(self, item_id: int) -> Optional[MarketBoardCurrentData]:
+        with self.lock:
+            row = self.connection.execute("SELECT payload FROM items WHERE item_id = ?", (item_id,)).fetchone()
+        return decode_item(item_id, row[0]) if row else None
+
+    def write_items(self, items: Iterable[MarketBoardCurrentData]):
+        now = time.time()
+        rows = [(item.item_id, item.last_update, now, encode_item(item)) for item in items]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO items (item_id, last_update, updated_at, payload) VALUES (?, ?, ?, ?)", rows)
+
+    def append_journal(self, rows: Iterable[Tuple[int, int, bytes]]):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT INTO journal (item_id, kind, payload) VALUES (?, ?, ?)", rows)
+
+    def compact_journal(self, items: Iterable[tuple], arrays: Optional[Dict[str, np.ndarray]], world_ids: Optional[list], shard: Optional[Tuple[int, int]] = None):
+        """
+        Write the `item_fields` of the items that changed, and the arrays when given, and drop the journal of the
+        shard in the same transaction.
+        """
+        shard_index, shard_count = shard or (0, 1)
+        now = time.time()
+        item_rows = [(fields[0], fields[-1], now, encode_item_fields(fields)) for fields in items]
+        array_rows = []
+        if arrays is not None:
+            array_rows = [(name, now, encode_array(array)) for name, array in arrays.items()]
+            array_rows.append(("world_ids", now, encode_array(np.array(world_ids, dtype=np.int64))))
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO items (item_id, last_update, updated_at, payload) VALUES (?, ?, ?, ?)", item_rows)
+            self.connection.executemany("INSERT OR REPLACE INTO arrays (name, saved_at, data) VALUES (?, ?, ?)", array_rows)
+            self.connection.execute("DELETE FROM journal WHERE item_id % ? = ?", (shard_count, shard_index))
+
+    def replay_journal(self, store: MarketBoardStore, shard: Optional[Tuple[int, int]] = None) -> Set[int]:
+        shard_index, shard_count = shard or (0, 1)
+        with self.lock:
+            rows = self.connection.execute("SELECT item_id, kind, payload FROM journal WHERE item_id % ? = ? ORDER BY seq", (shard_count, shard_index)).fetchall()
+        replaced = set()
+        changed = set()
+        for item_id, kind, payload in rows:
+            if kind == JOURNAL_ITEM:
+                store[item_id] = decode_item(item_id, payload)
+                replaced.add(item_id)
+                continue
+            if item_id not in store:
+                continue
+            if kind == JOURNAL_LISTING_ADDED:
+                store[item_id].apply_listing_added(decode_listing(payload))
+            else:
+                store[item_id].apply_listing_removed(decode_listing(payload))
+            changed.add(item_id)
+        for item_id in changed:
+            store.refresh_item(item_id)
+        if rows:
+            log.info("Replayed {:,} market board changes from the journal.", len(rows))
+        return replaced | changed
+
+    def write_sale_statistics(self, sale_statistics: SaleStatistics):
+        rows = [(item_id, encode_sale_statistics(item)) for item_id, item in list(sale_statistics.items.items())]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO sale_statistics (item_id, payload) VALUES (?, ?)", rows)
+
+    def read_sale_statistics(self, sale_statistics: SaleStatistics, shard: Optional[Tuple[int, int]] = None):
+        shard_index, shard_count = shard or (0, 1)
+        with self.lock:
+            rows = self.connection.execute("SELECT item_id, payload FROM sale_statistics WHERE item_id % ? = ?", (shard_count, shard_index)).fetchall()
+        sale_statistics.update_items((item_id, decode_sale_statistics(payload)) for item_id, payload in rows)
+
+    def save(self, store: MarketBoardStore):
+        """
+        Write the arrays of `store`, every item that has been loaded into memory and the sale statistics. The journal
+        is dropped, the changes in it are part of `store`.
+        """
+        with store.lock:
+            arrays = store.arrays()
+            world_ids = list(store.world_ids)
+            items = list(store.loaded.values())
+        self.write_items(items)
+        self.write_sale_statistics(store.sale_statistics)
+        now = time.time()
+        rows = [(name, now, encode_array(array)) for name, array in arrays.items()]
+        rows.append(("world_ids", now, encode_array(np.array(world_ids, dtype=np.int64))))
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO arrays (name, saved_at, data) VALUES (?, ?, ?)", rows)
+            self.connection.execute("DELETE FROM journal")
+
+    def load(self, store: MarketBoardStore, shard: Optional[Tuple[int, int]] = None):
+        """Load the snapshot into `store`, or only the items with `item_id % shard_count == shard_index`."""
+        shard_index, shard_count = shard or (0, 1)
+        with self.lock:
+            rows = self.connection.execute("SELECT name, saved_at, data FROM arrays").fetchall()
+        arrays = {name: decode_array(data) for name, _, data in rows}
+        saved_at = min(saved_at for _, saved_at, _ in rows)
+        in_shard = arrays["item_ids"] % shard_count == shard_index
+        store.load_arrays(arrays.pop("world_ids").tolist(), {name: arrays[name][in_shard] for name in ARRAY_NAMES}, self.read_item)
+        with self.lock:
+            updated_rows = self.connection.execute("SELECT item_id, payload FROM items WHERE updated_at > ? AND item_id % ? = ?", (saved_at, shard_count, shard_index)).fetchall()
+        store.update_items(decode_item(item_id, payload) for item_id, payload in updated_rows)
+        self.replayed_item_ids = self.replay_journal(store, shard)
+        self.read_sale_statistics(store.sale_statistics, shard)
+
+    def load_journal(self, store: MarketBoardStore):
+        """
+        Load a market board that was not indexed completely: the arrays are only written once every item is indexed,
+        until then the indexed items are only in the journal.
+        """
+        self.replayed_item_ids = self.replay_journal(store)
+        self.read_sale_statistics(store.sale_statistics)
+
+
+def migrate_pickle(snapshot: MarketBoardSnapshot, pickle_filename: str = LEGACY_PICKLE_FILENAME):
+    """Convert a `market_board.pkl` written by older versions into `snapshot`."""
+    with open(pickle_filename, 'rb') as f:
+        market_board = pickle.load(f)
+    snapshot.save(MarketBoardStore(market_board))
+
+
+def open_market_board(store: MarketBoardStore) -> MarketBoardSnapshot:
+    """
+    Load the snapshot into `store`, if there is one. A `market_board.pkl` of an older version is migrated first. The
+    snapshot stays empty when the market board was not indexed completely, the items that were are loaded into
+    `store` and only the others still need to be indexed.
+    """
+    # Any cached version is used, no matter how old, stale items are refreshed in the background per item.
+    snapshot = MarketBoardSnapshot()
+    if snapshot.is_empty() and os.path.exists(LEGACY_PICKLE_FILENAME):
+        log.info("Migrating {} to {}.", LEGACY_PICKLE_FILENAME, SNAPSHOT_FILENAME)
+        migrate_pickle(snapshot)
+    if not snapshot.is_empty():
+        snapshot.load(store)
+    elif snapshot.has_journal():
+        snapshot.load_journal(store)
+        log.info("Indexing the market board was interrupted, {:,} items were indexed already.", len(store))
+    return snapshot
+
+
+def load_market_board(store: MarketBoardStore, stop_event, workers: int = 1) -> Optional[MarketBoardSnapshot]:
+    snapshot = open_market_board(store)
+    if not snapshot.is_empty():
+        return snapshot
+    # load market board from Universalis
+    log.info("Market board is not cached and needs to be indexed using {} worker(s), this takes a while.", workers)
+    market_board = index_market_board(stop_event, [item_id for item_id in get_marketable_items() if item_id not in store], workers)
+    if stop_event.is_set():
+        return None
+    store.update_items(market_board.values())
+    snapshot.save(store)
+    return snapshot
@@ -0,0 +1,138 @@
+from typing import Dict, Iterator, Optional, Tuple
+import math
+import time
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+DEFAULT_HALF_LIFE_DAYS = 3.0
+# Prices are put in buckets that are 2% wide, quantiles are returned within 2% of the real value.
+SKETCH_RELATIVE_ACCURACY = 0.02
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+SKETCH_MAX_BUCKETS = 128
+# The weights grow by a factor e every `tau` seconds, they are scaled back before they can overflow.
+MAX_LANDMARK_AGE = 256
+
+
+class RollingStats:
+    """
+    Exponentially decayed statistics of the sales of one item on one world and quality. A sale at `timestamp` is
+    weighted by `exp((timestamp - landmark) / tau)` instead of decaying every older sale, so recording a sale only
+    adds to a few sums and the decay up to now is applied when the statistics are read.
+
+    `sketch` is a histogram of the quantities sold per price bucket, bucket `i` holds the prices in
+    `(gamma^(i-1), gamma^i]`. When it grows beyond `SKETCH_MAX_BUCKETS` the lowest buckets are merged.
+    """
+    __slots__ = ("landmark", "volume", "turnover", "sales", "first_sale_at", "last_sale_at", "sketch")
+
+    def __init__(self, landmark: float, volume: float = 0.0, turnover: float = 0.0, sales: float = 0.0, first_sale_at: int = None, last_sale_at: int = 0, sketch: Dict[int, float] = None):
+        self.landmark = landmark
+        self.volume = volume
+        self.turnover = turnover
+        self.sales = sales
+        self.first_sale_at = first_sale_at if first_sale_at is not None else int(landmark)
+        self.last_sale_at = last_sale_at
+        self.sketch = sketch if sketch is not None else {}
+
+    def add(self, price: int, quantity: int, timestamp: int, tau: float):
+        if (timestamp - self.landmark) / tau > MAX_LANDMARK_AGE:
+            self.move_landmark(timestamp, tau)
+        weight = math.exp((timestamp - self.landmark) / tau)
+        self.volume += quantity * weight
+        self.turnover += price * quantity * weight
+        self.sales += weight
+        self.first_sale_at = min(self.first_sale_at, timestamp)
+        self.last_sale_at = max(self.last_sale_at, timestamp)
+        if price > 0:
+            index = math.ceil(math.log(price) / SKETCH_LOG_GAMMA)
+            self.sketch[index] = self.sketch.get(index, 0.0) + quantity * weight
+            if len(self.sketch) > SKETCH_MAX_BUCKETS:
+                lowest = min(self.sketch)
+                merged = self.sketch.pop(lowest)
+                second_lowest = min(self.sketch)
+                self.sketch[second_lowest] += merged
+
+    def move_landmark(self, landmark: float, tau: float):
+        scale = math.exp((self.landmark - landmark) / tau)
+        self.landmark = landmark
+        self.volume *= scale
+        self.turnover *= scale
+        self.sales *= scale
+        for index in self.sketch:
+            self.sketch[index] *= scale
+
+    def decay(self, now: float, tau: float) -> float:
+        return math.exp((self.landmark - now) / tau)
+
+    def price(self) -> float:
+        """Average price per unit, weighted by quantity and by how recent the sales are."""
+        return self.turnover / self.volume if self.volume else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Price below which the fraction `q` of the recently sold units was sold."""
+        if not self.sketch:
+            return 0.0
+        rank = q * sum(self.sketch.values())
+        cumulative = 0.0
+        for index in sorted(self.sketch):
+            cumulative += self.sketch[index]
+            if cumulative >= rank:
+                break
+        return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+
+
+class SaleStatistics:
+    """
+    Rolling statistics of the sales seen on the websocket, per item, world and quality. Sales lose half of their
+    weight every `half_life_days`. Not thread-safe, it is updated and read by the arbitrager only.
+    """
+    def __init__(self, half_life_days: float = DEFAULT_HALF_LIFE_DAYS):
+        self.tau = half_life_days * SECONDS_PER_DAY / math.log(2)
+        self.items: Dict[int, Dict[Tuple[int, bool], RollingStats]] = {}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def record(self, item_id: int, world_id: int, hq: bool, price: int, quantity: int, timestamp: int):
+        item = self.items.get(item_id)
+        if item is None:
+            item = self.items[item_id] = {}
+        stats = item.get((world_id, hq))
+        if stats is None:
+            stats = item[(world_id, hq)] = RollingStats(timestamp)
+        stats.add(price, quantity, timestamp, self.tau)
+
+    def get(self, item_id: int, world_id: int, hq: bool) -> Optional[RollingStats]:
+        item = self.items.get(item_id)
+        return item.get((world_id, hq)) if item is not None else None
+
+    def price(self, item_id: int, world_id: int, hq: bool) -> float:
+        stats = self.get(item_id, world_id, hq)
+        return stats.price() if stats is not None else 0.0
+
+    def volume(self, item_id: int, world_id: int, hq: bool, now: float = None) -> float:
+        """Units sold, where a sale counts less the longer ago it was."""
+        stats = self.get(item_id, world_id, hq)
+        if stats is None:
+            return 0.0
+        return stats.volume * stats.decay(now if now is not None else time.time(), self.tau)
+
+    def velocity(self, item_id: int, world_id: int, hq: bool, now: float = None) -> float:
+        """
+        Units sold per day. The decayed volume covers `tau` seconds of sales once the sales have been followed for a
+        while, before that it covers less and it is divided by the part of the window that was seen, at least a day.
+        """
+        stats = self.get(item_id, world_id, hq)
+        if stats is None:
+            return 0.0
+        now = now if now is not None else time.time()
+        window = self.tau * (1 - math.exp((stats.first_sale_at - now) / self.tau))
+        return stats.volume * stats.decay(now, self.tau) / max(window / SECONDS_PER_DAY, 1.0)
+
+    def quantile(self, item_id: int, world_id: int, hq: bool, q: float) -> float:
+        stats = self.get(item_id, world_id, hq)
+        return stats.quantile(q) if stats is not None else 0.0
+
+    def update_items(self, items: Iterator[Tuple[int, Dict[Tuple[int, bool], RollingStats]]]):
+        for item_id, item in items:
+            self.items[item_id] = item
@@ -0,0 +1,273 @@
+from collections.abc import MutableMapping
+from dataclasses import dataclass
+from itertools import chain
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import threading
+import time
+import numpy as np
+from arbitrage.naming import worlds
+from arbitrage.stats import SaleStatistics
+from arbitrage.universalis import MarketBoardCurrentData
+
+
+NQ = 0
+HQ = 1
+SECONDS_PER_DAY = 24 * 60 * 60
+ARRAY_NAMES = ["item_ids", "present", "last_update", "min_price", "average_price", "sale_velocity"]
+
+
+@dataclass
+class Spread:
+    item_id: int
+    world_id: int
+    hq: bool
+    buy_price: float
+    sell_price: float
+    spread: float
+
+
+class MarketBoardStore(MutableMapping):
+    """
+    Market board that keeps the per-world statistics of every item in item × world × quality arrays, next to the
+    `MarketBoardCurrentData` objects themselves. It behaves like the `dict[int, MarketBoardCurrentData]` returned
+    by `get_market_board`, but whole-board questions can be answered with vectorized NumPy expressions.
+
+    Missing values (no listings or sales for that world and quality) are stored as NaN.
+
+    A store restored with `load_arrays` only holds the arrays, the `MarketBoardCurrentData` of an item is read
+    through `loader` the first time it is accessed.
+
+    The rolling statistics of the sales seen on the websocket are kept in `sale_statistics`, they are saved with
+    the rest of the store.
+    """
+    def __init__(self, items: Optional[Dict[int, MarketBoardCurrentData]] = None, capacity: int = 1024):
+        self.lock = threading.RLock()
+        self.loaded: Dict[int, MarketBoardCurrentData] = {}
+        self.unloaded: Set[int] = set()
+        self.loader: Optional[Callable[[int], MarketBoardCurrentData]] = None
+        self.item_rows: Dict[int, int] = {}
+        self.world_columns: Dict[int, int] = {}
+        self.world_ids: List[int] = []
+        self.size = 0
+        self.item_ids = np.zeros(capacity, dtype=np.int64)
+        self.present = np.zeros(capacity, dtype=bool)
+        self.last_update = np.zeros(capacity, dtype=np.int64)
+        self.refresh_requested_at = np.zeros(capacity, dtype=np.int64)
+        self.min_price = np.full((capacity, 0, 2), np.nan)
+        self.average_price = np.full((capacity, 0, 2), np.nan)
+        self.sale_velocity = np.full((capacity, 0, 2), np.nan)
+        self.sale_statistics = SaleStatistics()
+        self.add_worlds(worlds.keys())
+        if items:
+            self.update_items(items.values())
+
+    def __getitem__(self, item_id: int) -> MarketBoardCurrentData:
+        item = self.loaded.get(item_id)
+        if item is not None:
+            return item
+        with self.lock:
+            if item_id not in self.unloaded:
+                raise KeyError(item_id)
+            item = self.loader(item_id)
+            self.loaded[item_id] = item
+            self.unloaded.discard(item_id)
+            return item
+
+    def __setitem__(self, item_id: int, item: MarketBoardCurrentData):
+        with self.lock:
+            self.loaded[item_id] = item
+            self.unloaded.discard(item_id)
+            self.refresh_item(item_id)
+
+    def __delitem__(self, item_id: int):
+        with self.lock:
+            if item_id in self.unloaded:
+                self.unloaded.discard(item_id)
+            else:
+                del self.loaded[item_id]
+            # Rows are never reused, so clearing the statistics is enough to hide the item from queries.
+            row = self.item_rows[item_id]
+            self.present[row] = False
+            self.last_update[row] = 0
+            self.min_price[row] = np.nan
+            self.average_price[row] = np.nan
+            self.sale_velocity[row] = np.nan
+
+    def __contains__(self, item_id) -> bool:
+        return item_id in self.loaded or item_id in self.unloaded
+
+    def __iter__(self) -> Iterator[int]:
+        return chain(list(self.loaded), list(self.unloaded))
+
+    def __len__(self) -> int:
+        return len(self.loaded) + len(self.unloaded)
+
+    def load_arrays(self, world_ids: List[int], arrays: Dict[str, np.ndarray], loader: Callable[[int], MarketBoardCurrentData]):
+        """Replace the contents of the store with `arrays` (see `ARRAY_NAMES`), items are loaded lazily."""
+        with self.lock:
+            self.loaded = {}
+            self.loader = loader
+            self.world_ids = list(world_ids)
+            self.world_columns = {world_id: column for column, world_id in enumerate(self.world_ids)}
+            self.item_ids = arrays["item_ids"].astype(np.int64)
+            self.size = len(self.item_ids)
+            self.item_rows = {int(item_id): row for row, item_id in enumerate(self.item_ids)}
+            self.present = arrays["present"].astype(bool)
+            self.last_update = arrays["last_update"].astype(np.int64)
+            self.refresh_requested_at = np.zeros(self.size, dtype=np.int64)
+            self.min_price = arrays["min_price"]
+            self.average_price = arrays["average_price"]
+            self.sale_velocity = arrays["sale_velocity"]
+            self.unloaded = set(self.item_ids[self.present].tolist())
+            self.add_worlds(worlds.keys())
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        with self.lock:
+            return {name: getattr(self, name)[:self.size].copy() for name in ARRAY_NAMES}
+
+    def add_worlds(self, world_ids: Iterable[int]):
+        with self.lock:
+            new_world_ids = [world_id for world_id in world_ids if world_id not in self.world_columns]
+            if not new_world_ids:
+                return
+            for world_id in new_world_ids:
+                self.world_columns[world_id] = len(self.world_ids)
+                self.world_ids.append(world_id)
+            padding = ((0, 0), (0, len(new_world_ids)), (0, 0))
+            self.min_price = np.pad(self.min_price, padding, constant_values=np.nan)
+            self.average_price = np.pad(self.average_price, padding, constant_values=np.nan)
+            self.sale_velocity = np.pad(self.sale_velocity, padding, constant_values=np.nan)
+
+    def update_items(self, items: Iterable[MarketBoardCurrentData]):
+        """Apply the results of `parse_market_board_current_data` in place."""
+        with self.lock:
+            for item in items:
+                self[item.item_id] = item
+
+    def refresh_item(self, item_id: int):
+        """Recompute the statistics of an item, call this after its listings or history changed in place."""
+        with self.lock:
+            item = self[item_id]
+            row = self._row(item_id)
+            self.present[row] = True
+            self.add_worlds({listing.world_id for listing in item.listings} | {sale.world_id for sale in item.recent_history})
+            self.last_update[row] = item.last_update
+            self.min_price[row] = np.nan
+            for (world_id, hq), book in item.order_books.items():
+                self.min_price[row, self.world_columns[world_id], HQ if hq else NQ] = book.min_price()
+            self.average_price[row] = np.nan
+            self.sale_velocity[row] = np.nan
+            if not item.recent_history:
+                return
+            days = max(1.0, (item.last_update - min(sale.timestamp for sale in item.recent_history)) / SECONDS_PER_DAY)
+            totals = np.zeros((len(self.world_ids), 2))
+            quantities = np.zeros((len(self.world_ids), 2))
+            for sale in item.recent_history:
+                column = self.world_columns[sale.world_id]
+                quality = HQ if sale.hq else NQ
+                totals[column, quality] += sale.price_per_unit * sale.quantity
+                quantities[column, quality] += sale.quantity
+            sold = quantities > 0
+            self.average_price[row][sold] = totals[sold] / quantities[sold]
+            self.sale_velocity[row][sold] = quantities[sold] / days
+
+    def refresh_min_prices(self, item_id: int, books: Iterable[Tuple[int, bool]]):
+        """
+        Update the lowest price of an item on the given `(world_id, hq)` order books, after listings were added or
+        removed in place. Listings don't change the sale statistics, so this skips the work of `refresh_item`.
+        """
+        with self.lock:
+            item = self[item_id]
+            row = self._row(item_id)
+            for world_id, hq in books:
+                if world_id not in self.world_columns:
+                    self.add_worlds([world_id])
+                book = item.order_books.get((world_id, hq))
+                self.min_price[row, self.world_columns[world_id], HQ if hq else NQ] = book.min_price() if book is not None else np.nan
+
+    def top_spreads(self, home_world_id: int, n: int = 10, hq: Optional[bool] = None) -> List[Spread]:
+        """
+        Find the `n` largest differences between the lowest price on `home_world_id` and the lowest price on any
+        other world, over every item on the board. Use `hq` to restrict the search to a single quality.
+        """
+        with self.lock:
+            home_column = self.world_columns[home_world_id]
+            qualities = [HQ if hq else NQ] if hq is not None else [NQ, HQ]
+            min_price = self.min_price[:self.size][:, :, qualities]
+            sell_price = min_price[:, home_column:home_column + 1, :]
+            spread = sell_price - min_price
+            spread[:, home_column, :] = np.nan
+            spread = np.nan_to_num(spread, nan=-np.inf).ravel()
+            n = min(n, int(np.isfinite(spread).sum()))
+            if n <= 0:
+                return []
+            top = np.argpartition(spread, -n)[-n:]
+            top = top[np.argsort(spread[top])[::-1]]
+            rows, columns, quality_indices = np.unravel_index(top, (self.size, len(self.world_ids), len(qualities)))
+            return [
+                Spread(
+                    int(self.item_ids[row]),
+                    self.world_ids[column],
+                    qualities[quality_index] == HQ,
+                    float(min_price[row, column, quality_index]),
+                    float(sell_price[row, 0, quality_index]),
+                    float(spread[index])
+                )
+                for row, column, quality_index, index in zip(rows, columns, quality_indices, top)
+            ]
+
+    def stale_items(self, max_age_in_seconds: int, limit: int, order: str = "oldest") -> List[int]:
+        """
+        Return up to `limit` items whose data is older than `max_age_in_seconds`, ignoring items for which a refresh
+        was requested within that time. Items are ordered by age (`oldest`) or by gil traded per day (`value`).
+        """
+        with self.lock:
+            now = int(time.time())
+            present = self.present[:self.size]
+            refreshed_at = np.maximum(self.last_update[:self.size], self.refresh_requested_at[:self.size])
+            rows = np.flatnonzero(present & (now - refreshed_at > max_age_in_seconds))
+            if order == "value":
+                value = np.nansum(self.average_price[rows] * self.sale_velocity[rows], axis=(1, 2))
+                rows = rows[np.argsort(-value, kind="stable")]
+            else:
+                rows = rows[np.argsort(refreshed_at[rows], kind="stable")]
+            return self.item_ids[rows[:limit]].tolist()
+
+    def mark_refresh_requested(self, item_ids: Iterable[int]):
+        with self.lock:
+            now = int(time.time())
+            for item_id in item_ids:
+                if item_id in self.item_rows:
+                    self.refresh_requested_at[self.item_rows[item_id]] = now
+
+    def clear_refresh_requested(self, item_ids: Iterable[int]):
+        """Undo `mark_refresh_requested` for a refresh that failed, so the items are stale again."""
+        with self.lock:
+            for item_id in item_ids:
+                if item_id in self.item_rows:
+                    self.refresh_requested_at[self.item_rows[item_id]] = 0
+
+    def _row(self, item_id: int) -> int:
+        if item_id in self.item_rows:
+            return self.item_rows[item_id]
+        if self.size == len(self.item_ids):
+            self._grow(max(1024, 2 * len(self.item_ids)))
+        row = self.size
+        self.item_rows[item_id] = row
+        self.item_ids[row] = item_id
+        self.size += 1
+        return row
+
+    def _grow(self, capacity: int):
+        def grow(array, fill_value):
+            grown = np.full((capacity,) + array.shape[1:], fill_value, dtype=array.dtype)
+            grown[:len(array)] = array
+            return grown
+        self.item_ids = grow(self.item_ids, 0)
+        self.present = grow(self.present, False)
+        self.last_update = grow(self.last_update, 0)
+        self.refresh_requested_at = grow(self.refresh_requested_at, 0)
+        self.min_price = grow(self.min_price, np.nan)
+        self.average_price = grow(self.average_price, np.nan)
+        self.sale_velocity = grow(self.sale_velocity, np.nan)
+
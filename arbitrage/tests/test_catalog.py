@@ -0,0 +1,93 @@
+import json
+import pytest
+import requests
+from arbitrage import catalog as catalog_module
+from arbitrage.catalog import ItemCatalog
+from arbitrage.http_cache import HttpCache
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, items: dict = None, etag: str = None):
+        self.status_code = status_code
+        self.content = json.dumps(items).encode() if items is not None else b""
+        self.headers = {"ETag": etag} if etag else {}
+
+
+class FakeTeamcraft:
+    """Answers the `items.json` requests of the catalog, and counts how often the names files are written."""
+    def __init__(self, monkeypatch, tmp_path):
+        self.items = {"1": {"en": "Potion", "de": "Trank"}, "2": {"en": "Ether", "fr": "Éther"}}
+        self.etag = '"v1"'
+        self.available = True
+        self.requests = []
+        self.writes = 0
+        monkeypatch.setattr(catalog_module, "http_cache", HttpCache(str(tmp_path / "http")))
+        monkeypatch.setattr(ItemCatalog, "fetch_items", staticmethod(self.fetch_items))
+        write_cache = ItemCatalog.write_cache
+        def counting_write_cache(catalog, response):
+            self.writes += 1
+            write_cache(catalog, response)
+        monkeypatch.setattr(ItemCatalog, "write_cache", counting_write_cache)
+
+    def fetch_items(self, headers):
+        self.requests.append(headers)
+        if not self.available:
+            raise requests.ConnectionError("teamcraft is down")
+        if headers.get("If-None-Match") == self.etag:
+            return FakeResponse(304)
+        return FakeResponse(200, self.items, self.etag)
+
+
+@pytest.fixture
+def teamcraft(monkeypatch, tmp_path):
+    return FakeTeamcraft(monkeypatch, tmp_path)
+
+
+def test_names_are_split_once_per_download(teamcraft, tmp_path):
+    catalog = ItemCatalog(str(tmp_path))
+    catalog.load()
+    assert catalog.names == {1: "Potion", 2: "Ether"}
+    assert catalog.name(1, "de") == "Trank"
+    assert catalog.name(2, "fr") == "Éther"
+    assert catalog.name(2, "de") == "Undefined (2)"
+    assert (teamcraft.requests, teamcraft.writes) == ([{}], 1)
+
+    # A fresh cache is read from the names files, without a request or reading items.json.
+    catalog = ItemCatalog(str(tmp_path))
+    catalog.load()
+    assert catalog.names == {1: "Potion", 2: "Ether"}
+    assert (len(teamcraft.requests), teamcraft.writes) == (1, 1)
+
+
+def test_names_are_rebuilt_when_items_change(teamcraft, tmp_path):
+    ItemCatalog(str(tmp_path)).load()
+    # An unchanged items.json is revalidated, the names files are kept.
+    catalog = ItemCatalog(str(tmp_path), max_age_in_days=0)
+    catalog.load()
+    assert teamcraft.requests[-1] == {"If-None-Match": '"v1"'}
+    assert teamcraft.writes == 1
+
+    teamcraft.items = {"1": {"en": "Hi-Potion"}}
+    teamcraft.etag = '"v2"'
+    catalog = ItemCatalog(str(tmp_path), max_age_in_days=0)
+    catalog.load()
+    assert catalog.names == {1: "Hi-Potion"}
+    assert teamcraft.writes == 2
+
+
+def test_outdated_names_are_used_when_the_download_fails(teamcraft, tmp_path):
+    ItemCatalog(str(tmp_path)).load()
+    teamcraft.available = False
+    catalog = ItemCatalog(str(tmp_path), max_age_in_days=0)
+    catalog.load()
+    assert catalog.names == {1: "Potion", 2: "Ether"}
+    assert catalog.retry is None
+
+
+def test_download_is_retried_without_names(teamcraft, tmp_path):
+    teamcraft.available = False
+    catalog = ItemCatalog(str(tmp_path))
+    catalog.load()
+    catalog.retry.cancel()
+    assert catalog.names == {}
+    assert catalog.retry_seconds == 2 * catalog_module.RETRY_SECONDS
@@ -0,0 +1,60 @@
+import threading
+import time
+from arbitrage.db import DbParameters, SalesHistory, SalesSummary
+
+
+class SlowSalesHistory(SalesHistory):
+    """Sales history of a database that answers once `answer` is set."""
+    def __init__(self, **kwargs):
+        super().__init__(DbParameters("localhost", 5432, "user", "password", "database"), **kwargs)
+        self.answer = threading.Event()
+        self.reads = []
+
+    def read_summary(self, item_id: int, world_id: int, hq: bool, days: int = 7):
+        self.answer.wait()
+        self.reads.append((item_id, world_id, hq, days))
+        return SalesSummary(100.0 + len(self.reads), 10, 2, 10 / days)
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_summary_is_read_in_the_background():
+    sales_history = SlowSalesHistory().start()
+    try:
+        started_at = time.perf_counter()
+        assert sales_history.summary(1, 33, False) is None
+        assert sales_history.summary(1, 33, False) is None
+        assert time.perf_counter() - started_at < 0.1
+        sales_history.answer.set()
+        wait_for(lambda: sales_history.summary(1, 33, False) is not None)
+        # Asking again while it was being read did not read it twice.
+        assert sales_history.reads == [(1, 33, False, 7)]
+    finally:
+        sales_history.close()
+
+
+def test_expired_summary_is_returned_while_it_is_read_again():
+    sales_history = SlowSalesHistory(cache_seconds=0.0).start()
+    try:
+        sales_history.answer.set()
+        wait_for(lambda: sales_history.summary(1, 33, True) is not None)
+        sales_history.answer.clear()
+        assert sales_history.summary(1, 33, True).average_price == 101.0
+        sales_history.answer.set()
+        wait_for(lambda: sales_history.summary(1, 33, True).average_price == 102.0)
+    finally:
+        sales_history.answer.set()
+        sales_history.close()
+
+
+def test_full_request_queue_skips_the_summary():
+    sales_history = SlowSalesHistory(max_requests=1)
+    # Not started, so the requests are not taken from the queue.
+    assert sales_history.summary(1, 33, False) is None
+    assert sales_history.summary(2, 33, False) is None
+    assert sales_history.requested == {(1, 33, False, 7)}
@@ -0,0 +1,58 @@
+from arbitrage.events import Event, EventQueue
+from arbitrage.universalis import ListingEvent, MarketBoardCurrentData, SaleEvent
+
+
+def listing(item_id: int) -> Event:
+    return Event.listing(ListingEvent(item_id, 33, []))
+
+
+def sale(item_id: int) -> Event:
+    return Event.sale(SaleEvent(item_id, 33, []))
+
+
+def update(*item_ids: int) -> Event:
+    return Event.update_market_board([MarketBoardCurrentData(item_id, 0, 0, 0, 0, [], [], 0) for item_id in item_ids])
+
+
+def drain(events: EventQueue):
+    return [events.get(timeout=0) for _ in range(events.qsize())]
+
+
+def test_priorities():
+    events = EventQueue()
+    queued = [sale(1), update(2), listing(3), listing(4)]
+    for event in queued:
+        events.put(event)
+    assert drain(events) == [queued[2], queued[3], queued[1], queued[0]]
+
+
+def test_listing_waits_for_update_of_its_item():
+    events = EventQueue()
+    queued = [update(1, 2), listing(1), listing(3), update(1), listing(1)]
+    for event in queued:
+        events.put(event)
+    assert drain(events) == [queued[2], queued[0], queued[1], queued[3], queued[4]]
+    # Once the updates are handled, the listings of the item go first again.
+    later = [update(5), listing(1)]
+    for event in later:
+        events.put(event)
+    assert drain(events) == [later[1], later[0]]
+
+
+def test_updates_are_never_dropped():
+    events = EventQueue(maxsize=3)
+    queued = [sale(1), listing(2), listing(3), update(4), update(5), update(6)]
+    for event in queued:
+        events.put(event)
+    # The sale is dropped first, then the oldest listings.
+    assert drain(events) == queued[3:]
+
+
+def test_full_queue_drops_sales_then_listings():
+    events = EventQueue(maxsize=2)
+    assert events.put(update(1))
+    assert events.put(update(2))
+    # Nothing of the same or a lower priority is queued.
+    assert not events.put(sale(3))
+    assert not events.put(listing(4))
+    assert events.qsize() == 2
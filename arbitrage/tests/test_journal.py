@@ -0,0 +1,172 @@
+import numpy as np
+import pytest
+from arbitrage.journal import MarketBoardJournal
+from arbitrage.snapshot import SNAPSHOT_FILENAME, MarketBoardSnapshot, open_market_board
+from arbitrage.store import MarketBoardStore
+from arbitrage.universalis import Listing, MarketBoardCurrentData
+
+
+WORLD_ID = 33
+
+
+def listing(listing_id: str, price: int, hq: bool = False) -> Listing:
+    return Listing(1_700_000_000, "Retainer", price, 1, WORLD_ID, price, 0, hq, listing_id)
+
+
+def item(item_id: int, *listings: Listing, last_update: int = 1_700_000_000) -> MarketBoardCurrentData:
+    return MarketBoardCurrentData(item_id, 100.0, 150.0, 1.0, 1.0, list(listings), [], last_update)
+
+
+def listing_ids(store: MarketBoardStore, item_id: int):
+    return sorted(listing.listing_id for listing in store[item_id].listings)
+
+
+def load(filename, shard=None) -> MarketBoardStore:
+    store = MarketBoardStore()
+    snapshot = MarketBoardSnapshot(filename)
+    snapshot.load(store, shard)
+    # Items are read lazily, they are read before the snapshot is closed.
+    for item_id in store:
+        store[item_id]
+    snapshot.close()
+    return store
+
+
+def journal_rows(filename) -> int:
+    snapshot = MarketBoardSnapshot(filename)
+    count = snapshot.connection.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+    snapshot.close()
+    return count
+
+
+@pytest.fixture
+def filename(tmp_path):
+    filename = str(tmp_path / "market_board.sqlite")
+    snapshot = MarketBoardSnapshot(filename)
+    snapshot.save(MarketBoardStore({1: item(1, listing("a", 100)), 2: item(2, listing("b", 200)), 3: item(3, listing("c", 300))}))
+    snapshot.close()
+    return filename
+
+
+def test_replay_in_order_of_arrival(filename):
+    journal = MarketBoardJournal(filename, flush_interval=0.05).start()
+    # The listing added before the item was replaced is not part of the replaced item.
+    journal.record_listing_added(1, listing("x", 90))
+    journal.record_items([item(1, listing("d", 80), last_update=1_700_000_100)])
+    journal.record_listing_added(1, listing("e", 70, hq=True))
+    journal.record_listing_removed(1, listing("d", 80))
+    journal.record_listing_added(2, listing("f", 50))
+    journal.record_listing_removed(2, listing("f", 50))
+    journal.stop()
+
+    store = load(filename)
+    assert listing_ids(store, 1) == ["e"]
+    assert store[1].last_update == 1_700_000_100
+    assert listing_ids(store, 2) == ["b"]
+    assert listing_ids(store, 3) == ["c"]
+    # The lowest prices in the arrays follow the replayed listings.
+    row = store._row(1)
+    assert np.isnan(store.min_price[row, store.world_columns[WORLD_ID], 0])
+    assert store.min_price[row, store.world_columns[WORLD_ID], 1] == 70
+
+
+def test_changes_after_compaction_are_replayed(filename):
+    store = load(filename)
+    journal = MarketBoardJournal(filename, flush_interval=0.05).start()
+    store[1].apply_listing_added(listing("d", 80))
+    journal.record_listing_added(1, listing("d", 80))
+    journal.compact(store)
+    store[1].apply_listing_added(listing("e", 70))
+    journal.record_listing_added(1, listing("e", 70))
+    store[2].apply_listing_removed(listing("b", 200))
+    journal.record_listing_removed(2, listing("b", 200))
+    journal.stop()
+
+    # The change before the compaction is in the snapshot, the ones after it are still in the journal.
+    assert journal_rows(filename) == 2
+    store = load(filename)
+    assert listing_ids(store, 1) == ["a", "d", "e"]
+    assert listing_ids(store, 2) == []
+
+
+def test_replayed_items_are_compacted(filename):
+    journal = MarketBoardJournal(filename, flush_interval=0.05).start()
+    journal.record_listing_added(1, listing("d", 80))
+    journal.stop()
+
+    # A restart replays the journal, the next compaction must keep the replayed change although it drops the journal.
+    store = MarketBoardStore()
+    snapshot = MarketBoardSnapshot(filename)
+    snapshot.load(store)
+    journal = MarketBoardJournal(filename, flush_interval=0.05, changed=snapshot.replayed_item_ids).start()
+    journal.compact(store)
+    journal.stop()
+    snapshot.close()
+
+    assert journal_rows(filename) == 0
+    assert listing_ids(load(filename), 1) == ["a", "d"]
+
+
+def test_shard_compacts_its_own_journal(filename):
+    journal = MarketBoardJournal(filename, flush_interval=0.05).start()
+    journal.record_listing_added(1, listing("d", 80))
+    journal.record_listing_added(2, listing("e", 70))
+    journal.stop()
+
+    shard = (1, 2)
+    store = MarketBoardStore()
+    snapshot = MarketBoardSnapshot(filename)
+    snapshot.load(store, shard)
+    journal = MarketBoardJournal(filename, shard, flush_interval=0.05, changed=snapshot.replayed_item_ids).start()
+    journal.compact(store)
+    journal.stop()
+    snapshot.close()
+
+    # The journal of item 2 belongs to the other shard.
+    assert journal_rows(filename) == 1
+    store = load(filename)
+    assert listing_ids(store, 1) == ["a", "d"]
+    assert listing_ids(store, 2) == ["b", "e"]
+
+
+def test_save_drops_the_journal(filename):
+    journal = MarketBoardJournal(filename, flush_interval=0.05).start()
+    journal.record_listing_added(1, listing("d", 80))
+    journal.stop()
+
+    store = MarketBoardStore()
+    snapshot = MarketBoardSnapshot(filename)
+    snapshot.load(store)
+    snapshot.save(store)
+    snapshot.close()
+
+    assert journal_rows(filename) == 0
+    assert listing_ids(load(filename), 1) == ["a", "d"]
+
+
+def test_interrupted_index_is_resumed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # While the market board is indexed for the first time the indexed items are only in the journal.
+    journal = MarketBoardJournal(SNAPSHOT_FILENAME, flush_interval=0.05).start()
+    journal.record_items([item(1, listing("a", 100)), item(2, listing("b", 200))])
+    journal.record_listing_added(2, listing("c", 150))
+    journal.stop()
+
+    store = MarketBoardStore()
+    snapshot = open_market_board(store)
+    assert snapshot.is_empty()
+    assert sorted(store) == [1, 2]
+    assert listing_ids(store, 2) == ["b", "c"]
+
+    # Once the remaining items are indexed, the compaction writes the replayed items along with them.
+    journal = MarketBoardJournal(SNAPSHOT_FILENAME, flush_interval=0.05, changed=snapshot.replayed_item_ids).start()
+    store[3] = item(3, listing("d", 300))
+    journal.record_items([store[3]])
+    journal.compact(store)
+    journal.stop()
+    snapshot.close()
+
+    assert journal_rows(SNAPSHOT_FILENAME) == 0
+    store = load(SNAPSHOT_FILENAME)
+    assert sorted(store) == [1, 2, 3]
+    assert listing_ids(store, 2) == ["b", "c"]
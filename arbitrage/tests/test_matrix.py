@@ -0,0 +1,93 @@
+import pytest
+from arbitrage.matrix import ArbitrageMatrix, WorldSettings, parse_world_settings
+from arbitrage.store import MarketBoardStore
+from arbitrage.universalis import Listing, ListingEventLine, MarketBoardCurrentData
+
+
+BUY_WORLD = 33
+
+
+def listing(price: int, quantity: int, world_id: int, hq: bool = False) -> Listing:
+    return Listing(1_700_000_000, "Retainer", price, quantity, world_id, price * quantity, 0, hq)
+
+
+def line(price: int, quantity: int, hq: bool = False) -> ListingEventLine:
+    return ListingEventLine(price, quantity, hq, "Buyer", price * quantity, 0)
+
+
+def results(opportunities):
+    return [(o.sell_world_id, o.listing.quantity, o.listing.hq, o.sellable_quantity, pytest.approx(o.sell_price), pytest.approx(o.profit)) for o in opportunities]
+
+
+@pytest.fixture
+def store():
+    return MarketBoardStore({1: MarketBoardCurrentData(1, 0, 0, 0, 0, [
+        listing(1_000, 2, 36), listing(1_200, 3, 36), listing(5_000, 1, 36, hq=True),
+        listing(150, 10, 42),
+        # The world the listing is bought on is not a sell world.
+        listing(9_000, 5, BUY_WORLD),
+    ], [], 0)})
+
+
+def test_depth_walk(store):
+    matrix = ArbitrageMatrix(store, [BUY_WORLD, 36, 42], WorldSettings(0.05, 0.0, 0.0))
+    opportunities = matrix.evaluate(store[1], BUY_WORLD, [line(100, 4), line(100, 10), line(100, 2, hq=True)])
+    assert results(opportunities) == [
+        # One HQ unit is listed on Lich, the second unit is bought but can't be sold.
+        (36, 2, True, 1, 5_000, 0.95 * 5_000 - 2 * 100),
+        # Two units at 1,000 and three at 1,200, the other five units are unsellable.
+        (36, 10, False, 5, 1_120, 0.95 * (2 * 1_000 + 3 * 1_200) - 10 * 100),
+        # Two units at 1,000 and two of the three at 1,200.
+        (36, 4, False, 4, 1_100, 0.95 * (2 * 1_000 + 2 * 1_200) - 4 * 100),
+        (42, 10, False, 10, 150, 0.95 * 10 * 150 - 10 * 100),
+        (42, 4, False, 4, 150, 0.95 * 4 * 150 - 4 * 100),
+    ]
+
+
+def test_no_book_of_the_same_quality(store):
+    matrix = ArbitrageMatrix(store, [42], WorldSettings(0.05, 0.0, 0.0))
+    assert matrix.evaluate(store[1], BUY_WORLD, [line(1, 1, hq=True)]) == []
+
+
+def test_books_follow_listing_changes(store):
+    matrix = ArbitrageMatrix(store, [36], WorldSettings(0.0, 0.0, 0.0))
+    item = store[1]
+    item.apply_listing_removed(listing(1_000, 2, 36))
+    item.apply_listing_added(listing(1_100, 1, 36))
+    store.refresh_item(1)
+    [opportunity] = matrix.evaluate(item, BUY_WORLD, [line(100, 3)])
+    assert opportunity.sellable_quantity == 3
+    assert opportunity.profit == pytest.approx(1_100 + 2 * 1_200 - 3 * 100)
+
+
+DEFAULT_SETTINGS = WorldSettings(0.05, 0.01, 100.0)
+
+
+def test_parse_world_settings():
+    assert parse_world_settings("33:0.05:0.02, 36:0.03:0.02:500,,42:0.1", DEFAULT_SETTINGS) == {
+        33: WorldSettings(0.05, 0.02, 100.0),
+        36: WorldSettings(0.03, 0.02, 500.0),
+        42: WorldSettings(0.1, 0.01, 100.0),
+    }
+    assert parse_world_settings("", DEFAULT_SETTINGS) == {}
+
+
+def test_ranking_with_per_world_settings(store):
+    store[1].apply_listing_added(listing(1_400, 1, 56))
+    store.refresh_item(1)
+    world_settings = parse_world_settings("33:0.05:0.02,36:0.03:0.02:500,42:0.1", DEFAULT_SETTINGS)
+    matrix = ArbitrageMatrix(store, [36, 42, 56], DEFAULT_SETTINGS, world_settings)
+    opportunities = matrix.evaluate(store[1], BUY_WORLD, [line(100, 4), line(130, 4), line(900, 1)])
+    # The buy tax of the buy world, the sell tax and the threshold of the sell world.
+    cost = {100: 1.02 * 4 * 100, 130: 1.02 * 4 * 130, 900: 1.02 * 900}
+    assert [(o.sell_world_id, o.listing.price_per_unit, pytest.approx(o.profit)) for o in opportunities] == [
+        (36, 100, 0.97 * (2 * 1_000 + 2 * 1_200) - cost[100]),
+        (36, 130, 0.97 * (2 * 1_000 + 2 * 1_200) - cost[130]),
+        (56, 100, 0.95 * 1_400 - cost[100]),
+        (56, 130, 0.95 * 1_400 - cost[130]),
+        (56, 900, 0.95 * 1_400 - cost[900]),
+        (42, 100, 0.9 * 4 * 150 - cost[100]),
+    ]
+    # Below the threshold of 500 on world 36, and of 100 on world 42.
+    assert 0 < 0.97 * 1_000 - cost[900] < 500
+    assert 0 < 0.9 * 4 * 150 - cost[130] < 100
@@ -0,0 +1,103 @@
+import math
+import random
+import pytest
+from arbitrage.snapshot import MarketBoardSnapshot
+from arbitrage.stats import MAX_LANDMARK_AGE, SECONDS_PER_DAY, SKETCH_RELATIVE_ACCURACY, RollingStats, SaleStatistics
+from arbitrage.store import MarketBoardStore
+
+
+START = 1_700_000_000
+WORLD_ID = 33
+
+
+def test_decayed_average_and_volume():
+    statistics = SaleStatistics(half_life_days=1.0)
+    statistics.record(1, WORLD_ID, False, 100, 2, START)
+    statistics.record(1, WORLD_ID, False, 200, 1, START + SECONDS_PER_DAY)
+    # The first sale has lost half of its weight when the second one is made.
+    assert statistics.price(1, WORLD_ID, False) == pytest.approx((0.5 * 2 * 100 + 200) / (0.5 * 2 + 1))
+    assert statistics.volume(1, WORLD_ID, False, now=START + SECONDS_PER_DAY) == pytest.approx(2)
+    assert statistics.volume(1, WORLD_ID, False, now=START + 3 * SECONDS_PER_DAY) == pytest.approx(2 / 8 + 1 / 4)
+    assert statistics.price(1, WORLD_ID, True) == statistics.volume(2, WORLD_ID, False) == 0.0
+
+
+def test_velocity_of_a_short_window():
+    statistics = SaleStatistics(half_life_days=1.0)
+    statistics.record(1, WORLD_ID, False, 100, 2, START)
+    statistics.record(1, WORLD_ID, False, 200, 1, START + SECONDS_PER_DAY)
+    tau_days = 1 / math.log(2)
+    # Followed for a day, the seen part of the window is shorter than a day.
+    assert tau_days * (1 - 1 / 2) < 1
+    assert statistics.velocity(1, WORLD_ID, False, now=START + SECONDS_PER_DAY) == pytest.approx(2)
+    # Followed for three days, the volume covers 7/8 of the window.
+    assert statistics.velocity(1, WORLD_ID, False, now=START + 3 * SECONDS_PER_DAY) == pytest.approx((2 / 8 + 1 / 4) / (tau_days * (1 - 1 / 8)))
+
+
+def test_velocity_of_a_steady_rate():
+    statistics = SaleStatistics(half_life_days=3.0)
+    for hour in range(100 * 24):
+        statistics.record(1, WORLD_ID, False, 100, 1, START + hour * 3600)
+    now = START + (100 * 24 - 1) * 3600
+    assert statistics.velocity(1, WORLD_ID, False, now=now) == pytest.approx(24, rel=0.01)
+
+
+def test_landmark_is_moved():
+    statistics = SaleStatistics(half_life_days=0.001)
+    sales = [(100 + i % 7 * 10, 1 + i % 3, START + i * 1_000) for i in range(200)]
+    for price, quantity, timestamp in sales:
+        statistics.record(1, WORLD_ID, False, price, quantity, timestamp)
+    stats = statistics.get(1, WORLD_ID, False)
+    now = sales[-1][2]
+    # The sales span many times `MAX_LANDMARK_AGE * tau`, the weights would overflow without moving the landmark.
+    assert (now - START) / statistics.tau > 2 * MAX_LANDMARK_AGE
+    assert stats.landmark > START
+    assert (stats.first_sale_at, stats.last_sale_at) == (START, now)
+    weights = [quantity * math.exp((timestamp - now) / statistics.tau) for _, quantity, timestamp in sales]
+    assert statistics.volume(1, WORLD_ID, False, now=now) == pytest.approx(sum(weights))
+    assert statistics.price(1, WORLD_ID, False) == pytest.approx(sum(weight * price for weight, (price, _, _) in zip(weights, sales)) / sum(weights))
+
+
+@pytest.mark.parametrize("prices", [
+    list(range(1, 10_001)),
+    [int(random.Random(0).lognormvariate(math.log(50_000), 1.0)) + 1 for _ in range(20_000)],
+])
+def test_sketch_quantiles(prices):
+    stats = RollingStats(START)
+    for price in prices:
+        stats.add(price, 1, START, tau=SECONDS_PER_DAY)
+    prices = sorted(prices)
+    for q in (0.05, 0.25, 0.5, 0.75, 0.9, 0.99, 1.0):
+        expected = prices[math.ceil(q * len(prices)) - 1]
+        assert stats.quantile(q) == pytest.approx(expected, rel=SKETCH_RELATIVE_ACCURACY)
+    assert RollingStats(START).quantile(0.5) == 0.0
+
+
+def test_saved_statistics_are_loaded(tmp_path):
+    store = MarketBoardStore()
+    for item_id in (1, 2):
+        for hour in range(48):
+            store.sale_statistics.record(item_id, WORLD_ID, hour % 2 == 0, 100 * item_id + hour, 1 + hour % 4, START + hour * 3600)
+    filename = str(tmp_path / "market_board.sqlite")
+    snapshot = MarketBoardSnapshot(filename)
+    snapshot.save(store)
+    snapshot.close()
+
+    loaded = MarketBoardStore()
+    snapshot = MarketBoardSnapshot(filename)
+    snapshot.load(loaded)
+    snapshot.close()
+    assert len(loaded.sale_statistics) == 2
+    now = START + 3 * SECONDS_PER_DAY
+    for item_id in (1, 2):
+        for hq in (False, True):
+            saved, read = store.sale_statistics.get(item_id, WORLD_ID, hq), loaded.sale_statistics.get(item_id, WORLD_ID, hq)
+            assert {slot: getattr(read, slot) for slot in RollingStats.__slots__} == {slot: getattr(saved, slot) for slot in RollingStats.__slots__}
+            assert loaded.sale_statistics.velocity(item_id, WORLD_ID, hq, now=now) == store.sale_statistics.velocity(item_id, WORLD_ID, hq, now=now)
+            assert loaded.sale_statistics.quantile(item_id, WORLD_ID, hq, 0.5) == store.sale_statistics.quantile(item_id, WORLD_ID, hq, 0.5)
+
+    # A shard reads the statistics of its own items only.
+    sharded = MarketBoardStore()
+    snapshot = MarketBoardSnapshot(filename)
+    snapshot.read_sale_statistics(sharded.sale_statistics, (1, 2))
+    snapshot.close()
+    assert list(sharded.sale_statistics.items) == [1]
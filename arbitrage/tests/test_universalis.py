@@ -0,0 +1,226 @@
+import datetime
+import random
+import bson
+import pytest
+import requests
+from bson.int64 import Int64
+from arbitrage import universalis
+from arbitrage.helpers import TokenBucket
+from arbitrage.universalis import Listing, MarketBoardCurrentData, OrderBook, http_get, parse_market_board_current_data, peek_event_header
+
+
+LISTING = {"listingID": "5f0c2b", "pricePerUnit": 1_200, "quantity": 3, "hq": True, "retainerName": "Retainer", "lastReviewTime": 1_700_000_000}
+
+
+def decoded_header(frame: bytes):
+    message = bson.decode(frame)
+    return message["event"], message["item"], message["world"]
+
+
+def test_universalis_field_order():
+    frame = bson.encode({"event": "listings/add", "item": 5_057, "world": 33, "listings": [LISTING]})
+    assert peek_event_header(frame) == decoded_header(frame) == ("listings/add", 5_057, 33)
+
+
+@pytest.mark.parametrize("message", [
+    {"item": 5_057, "world": 33, "event": "listings/remove", "listings": [LISTING]},
+    {"listings": [LISTING], "world": 33, "item": 5_057, "event": "listings/add"},
+    {"event": "sales/add", "world": 33, "item": 5_057, "sales": []},
+    {"event": "sales/add", "sales": [{"hq": False, "pricePerUnit": 10}], "item": 5_057, "world": 33},
+])
+def test_reordered_fields(message):
+    frame = bson.encode(message)
+    assert peek_event_header(frame) == decoded_header(frame)
+
+
+@pytest.mark.parametrize("item, world", [
+    (Int64(5_057), 33),
+    (5_057, Int64(33)),
+    (Int64(2 ** 40), Int64(-1)),
+])
+def test_int64_fields(item, world):
+    frame = bson.encode({"event": "listings/add", "item": item, "world": world, "listings": [LISTING]})
+    assert peek_event_header(frame) == decoded_header(frame)
+
+
+@pytest.mark.parametrize("extra", [
+    {"price": 1.5},
+    {"hq": True},
+    {"nothing": None},
+    {"at": datetime.datetime(2024, 1, 1)},
+    {"id": bson.ObjectId()},
+    {"payload": b"\x00\x01\x02"},
+    {"nested": {"item": 1, "world": 2}},
+])
+def test_skipped_element_types(extra):
+    # The fields of a nested document are not the fields of the message.
+    frame = bson.encode({**extra, "event": "sales/add", "item": 5_057, "world": 33, "sales": []})
+    assert peek_event_header(frame) == decoded_header(frame)
+
+
+@pytest.mark.parametrize("element", [
+    {"pattern": bson.Regex("^a")},
+    {"code": bson.Code("return 1")},
+    {"low": bson.MinKey()},
+])
+def test_unexpected_element_types(element):
+    frame = bson.encode({**element, "event": "sales/add", "item": 5_057, "world": 33})
+    assert peek_event_header(frame) is None
+
+
+@pytest.mark.parametrize("message", [
+    {"event": "sales/add", "item": 5_057},
+    {"event": "sales/add", "world": 33},
+    {"item": 5_057, "world": 33},
+    {"event": "sales/add", "item": "5057", "world": 33},
+    {},
+])
+def test_missing_fields(message):
+    assert peek_event_header(bson.encode(message)) is None
+
+
+@pytest.mark.parametrize("message", [
+    {"event": "listings/add", "item": 5_057, "world": 33, "listings": [LISTING]},
+    {"listings": [LISTING], "world": Int64(33), "item": 5_057, "event": "listings/add"},
+])
+def test_truncated_frames(message):
+    frame = bson.encode(message)
+    header = decoded_header(frame)
+    for length in range(len(frame)):
+        # A frame that is cut off after the header may still return it, the rest is left to the decoder.
+        assert peek_event_header(frame[:length]) in (None, header)
+
+
+def test_corrupted_frames():
+    frame = bson.encode({"listings": [LISTING], "world": 33, "item": 5_057, "event": "listings/add"})
+    rng = random.Random(0)
+    for _ in range(5_000):
+        corrupted = bytearray(frame)
+        for _ in range(rng.randint(1, 4)):
+            corrupted[rng.randrange(len(corrupted))] = rng.randrange(256)
+        corrupted = bytes(corrupted)
+        try:
+            expected = decoded_header(corrupted)
+        except Exception:
+            expected = None
+        header = peek_event_header(corrupted)
+        # The header is read without validating the rest of the frame, but never differs from the decoder.
+        assert header is None or expected is None or header == expected
+
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.headers = {}
+        self.text = ""
+
+
+class FakeUniversalis:
+    """Answers the requests of `http_get` with `responses` in turn, exceptions are raised."""
+    def __init__(self, monkeypatch):
+        self.responses = []
+        self.sleeps = []
+        monkeypatch.setattr(universalis.session, "get", self.get)
+        monkeypatch.setattr(universalis, "rate_limiter", TokenBucket(1_000_000))
+        monkeypatch.setattr(universalis.time, "sleep", self.sleeps.append)
+
+    def get(self, address, headers=None, timeout=None):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_network_errors_are_retried(monkeypatch):
+    fake = FakeUniversalis(monkeypatch)
+    ok = FakeResponse(200)
+    fake.responses = [requests.ConnectionError("reset"), requests.Timeout("timed out"), FakeResponse(503), ok]
+    assert http_get("https://universalis.test/api", endpoint="test") is ok
+    assert fake.sleeps == [2, 4, 8]
+
+
+def test_network_errors_are_raised_after_all_attempts(monkeypatch):
+    fake = FakeUniversalis(monkeypatch)
+    fake.responses = [requests.ConnectionError("reset")] * 3
+    with pytest.raises(requests.ConnectionError):
+        http_get("https://universalis.test/api", attempts=3, endpoint="test")
+    assert fake.sleeps == [2, 4]
+
+
+def book(*levels) -> OrderBook:
+    book = OrderBook()
+    for price, quantity in levels:
+        book.add(price, quantity)
+    return book
+
+
+def test_order_book_walk():
+    levels = book((120, 3), (100, 2), (150, 5))
+    assert levels.prices == [100, 120, 150]
+    assert levels.min_price() == 100
+    assert levels.depth() == 10
+    assert levels.value(1) == (100, 1)
+    # Two units at 100 and a part of the three at 120.
+    assert levels.value(4) == (2 * 100 + 2 * 120, 4)
+    assert levels.value(10) == (2 * 100 + 3 * 120 + 5 * 150, 10)
+    # Units beyond the depth of the book are not valued.
+    assert levels.value(12) == (2 * 100 + 3 * 120 + 5 * 150, 10)
+    assert OrderBook().value(3) == (0, 0)
+
+
+def test_order_book_stays_sorted():
+    levels = book((100, 1), (100, 2), (90, 1))
+    levels.add(95, 4)
+    assert not levels.remove(100, 5)
+    assert levels.remove(100, 2)
+    assert (levels.prices, levels.quantities) == ([90, 95, 100], [1, 4, 1])
+
+
+def listing(listing_id: str, price: int, quantity: int = 1, world_id: int = 33, hq: bool = False) -> Listing:
+    return Listing(1_700_000_000, "Retainer", price, quantity, world_id, price * quantity, 0, hq, listing_id)
+
+
+def assert_indexes(item: MarketBoardCurrentData):
+    assert item.listing_positions == {id(listing): index for index, listing in enumerate(item.listings)}
+    assert item.listings_by_id == {listing.listing_id: listing for listing in item.listings if listing.listing_id}
+    expected = MarketBoardCurrentData(item.item_id, 0, 0, 0, 0, list(item.listings), [], 0)
+    assert {key: (book.prices, book.quantities) for key, book in item.order_books.items()} == {key: (book.prices, book.quantities) for key, book in expected.order_books.items()}
+
+
+def test_listing_changes_keep_the_books_and_indexes():
+    item = MarketBoardCurrentData(1, 0, 0, 0, 0, [listing("a", 300), listing("b", 100), listing("c", 200, hq=True), listing("d", 150)], [], 0)
+    assert item.order_book(33, False).prices == [100, 150, 300]
+    assert item.order_book(33, True).prices == [200]
+
+    # The last listing takes the place of the removed one.
+    item.remove_listing(item.listings[0])
+    assert [listing.listing_id for listing in item.listings] == ["d", "b", "c"]
+    assert_indexes(item)
+
+    # Removing the last listing, and by an equal listing instead of the one on the board.
+    item.remove_listing(item.listings[-1])
+    item.remove_listing(listing("d", 150))
+    assert [listing.listing_id for listing in item.listings] == ["b"]
+    assert (33, True) not in item.order_books
+    assert_indexes(item)
+
+    # A listing that is added again replaces the one with its ID.
+    assert item.apply_listing_added(listing("b", 120, quantity=2)).price_per_unit == 100
+    item.apply_listing_added(listing("e", 90, hq=True))
+    item.apply_listing_added(listing("f", 110))
+    assert item.order_book(33, False).prices == [110, 120]
+    assert item.apply_listing_removed(listing("f", 110)) is not None
+    assert item.apply_listing_removed(listing("x", 1)) is None
+    assert_indexes(item)
+
+
+def test_refreshed_item_has_sorted_books():
+    listings = [
+        {"lastReviewTime": 0, "retainerName": "R", "pricePerUnit": price, "quantity": 1, "worldID": world_id, "total": price, "tax": 0, "hq": hq, "listingID": str(i)}
+        for i, (price, world_id, hq) in enumerate([(500, 33, False), (100, 33, False), (300, 36, True), (200, 33, False), (250, 36, True)])
+    ]
+    item = parse_market_board_current_data({"itemID": 1, "averagePriceNQ": 0, "averagePriceHQ": 0, "nqSaleVelocity": 0, "hqSaleVelocity": 0, "listings": listings, "recentHistory": []})
+    assert item.order_book(33, False).prices == [100, 200, 500]
+    assert item.order_book(36, True).prices == [250, 300]
+    assert item.order_book(36, False) is None
+    assert_indexes(item)
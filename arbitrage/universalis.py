@@ -1,19 +1,84 @@
-from dataclasses import dataclass
-from typing import List
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from operator import attrgetter
+from typing import Callable, Dict, List, Optional, Tuple
 import requests
-import pandas as pd
+import struct
+import threading
 import time
-import pickle
-import os
-from arbitrage.helpers import RateLimiter, batcher
-
-
-rate_limiter = RateLimiter(25)
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
+from arbitrage.helpers import TokenBucket
+from arbitrage.http_cache import HTTP_NOT_MODIFIED, HTTP_OK, CachedResponse, http_cache
+from arbitrage.log import get_logger
+from arbitrage.metrics import Counter, Histogram
+
+
+api_address = "https://universalis.app/api/v2"
+# Regions, data centers or worlds whose market data is requested, several scopes are requested one by one and merged.
+market_scopes = ["europe"]
+rate_limiter = TokenBucket(25)
+# Reference data that rarely changes is cached on disk, and revalidated once it is older than its TTL.
+CACHE_TTL_SECONDS = {
+    "marketable": 24 * 60 * 60,
+    "worlds": 7 * 24 * 60 * 60,
+    "data-centers": 7 * 24 * 60 * 60,
+}
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+log = get_logger("universalis")
+request_seconds = Histogram("universalis_request_seconds", "Latency of Universalis HTTP requests.", ["endpoint"])
+request_retries = Counter("universalis_request_retries_total", "Universalis HTTP requests that were retried, by status code or exception.", ["endpoint", "status"])
+request_failures = Counter("universalis_request_failures_total", "Universalis HTTP requests that failed after all attempts.", ["endpoint"])
+
+
+def http_get(address: str, attempts: int = 7, backoff_seconds: float = 2, endpoint: str = "other", headers: Dict[str, str] = None) -> requests.Response:
+    """
+    GET `address` through the shared keep-alive session, every attempt takes a token from the shared rate limiter.
+    When Universalis answers with a `Retry-After` header, all workers are paused for that long before retrying,
+    otherwise the delay between attempts doubles, also when the request fails with a connection error or timeout.
+    `304 Not Modified` counts as success for conditional requests.
+    """
+    for attempt in range(attempts):
+        rate_limiter.acquire()
+        started_at = time.perf_counter()
+        try:
+            response = session.get(address, headers=headers, timeout=30)
+        except requests.RequestException as err:
+            response, error, status = None, err, type(err).__name__
+        else:
+            error, status = None, response.status_code
+        request_seconds.observe(time.perf_counter() - started_at, endpoint)
+        if response is not None and response.status_code in (HTTP_OK, HTTP_NOT_MODIFIED):
+            return response
+        if attempt == attempts - 1:
+            break
+        request_retries.inc(endpoint, status)
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            rate_limiter.pause(int(retry_after))
+        else:
+            time.sleep(backoff_seconds)
+            backoff_seconds *= 2
+    request_failures.inc(endpoint)
+    if error is not None:
+        log.error("GET {} failed after {} attempts: {}", address, attempts, error)
+        raise error
+    log.error("GET {} failed after {} attempts with status code {}: {}", address, attempts, response.status_code, response.text[:200])
+    raise RuntimeError(f"GET {address} failed with status code {response.status_code}.")
+
+
+def cached_http_get(address: str, endpoint: str) -> CachedResponse:
+    """GET `address` through the on-disk cache, with the TTL of `endpoint` from `CACHE_TTL_SECONDS`."""
+    return http_cache.get(address, CACHE_TTL_SECONDS[endpoint], lambda headers: http_get(address, endpoint=endpoint, headers=headers), endpoint)
 
 
 def get_marketable_items() -> List[int]:
-    rate_limiter.increase()
-    return requests.get("https://universalis.app/api/v2/marketable").json()
+    return cached_http_get(f"{api_address}/marketable", "marketable").json()
 
 
 @dataclass 
@@ -26,6 +91,7 @@ class Listing:
     total: int
     tax: int
     hq: bool
+    listing_id: str = ""
 
 
 def parse_listing(obj: dict) -> Listing:
@@ -37,7 +103,8 @@ def parse_listing(obj: dict) -> Listing:
         obj["worldID"],
         obj["total"],
         obj["tax"],
-        obj["hq"]
+        obj["hq"],
+        obj.get("listingID", "")
     )
 
 
@@ -52,7 +119,7 @@ class RecentHistory:
     timestamp: int
 
 
-@dataclass
+@dataclass(slots=True)
 class SaleEventLine:
     hq: bool
     price_per_unit: int
@@ -73,7 +140,7 @@ def parse_sale_event_line(obj: dict) -> SaleEventLine:
     )
 
 
-@dataclass
+@dataclass(slots=True)
 class SaleEvent:
     item_code: int
     world_id: int
@@ -88,7 +155,7 @@ def parse_sale_event(obj: dict) -> SaleEvent:
     )
 
 
-@dataclass 
+@dataclass(slots=True)
 class ListingEventLine:
     price_per_unit: int
     quantity: int
@@ -96,6 +163,8 @@ class ListingEventLine:
     retainerName: str
     total: int
     tax: int
+    listing_id: str = ""
+    last_review_time: int = 0
 
 
 def parse_listing_event_line(obj: dict) -> ListingEventLine:
@@ -105,11 +174,27 @@ def parse_listing_event_line(obj: dict) -> ListingEventLine:
         obj["hq"],
         obj["retainerName"],
         obj["total"],
-        obj["tax"]
+        obj["tax"],
+        obj.get("listingID", ""),
+        obj.get("lastReviewTime", 0)
     )
 
 
-@dataclass 
+def listing_from_event_line(world_id: int, line: ListingEventLine) -> Listing:
+    return Listing(
+        line.last_review_time,
+        line.retainerName,
+        line.price_per_unit,
+        line.quantity,
+        world_id,
+        line.total,
+        line.tax,
+        line.hq,
+        line.listing_id
+    )
+
+
+@dataclass(slots=True)
 class ListingEvent:
     item_code: int
     world_id: int
@@ -124,6 +209,81 @@ def parse_listing_event(obj: dict):
     )
 
 
+BSON_STRING = 0x02
+BSON_DOCUMENT = 0x03
+BSON_ARRAY = 0x04
+BSON_BINARY = 0x05
+BSON_INT32 = 0x10
+BSON_INT64 = 0x12
+# Elements with a fixed size: double, ObjectId, bool, datetime, null, timestamp and decimal128.
+BSON_FIXED_SIZES = {0x01: 8, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x11: 8, 0x13: 16}
+unpack_int32 = struct.Struct("<i").unpack_from
+unpack_int64 = struct.Struct("<q").unpack_from
+# Universalis sends `event`, `item` and `world` first, in that order, with `item` and `world` as int32.
+EVENT_ELEMENT = b"\x02event\x00"
+ITEM_AND_WORLD_ELEMENTS = struct.Struct("<6si7si")
+
+
+def peek_event_header(frame: bytes) -> Optional[Tuple[str, int, int]]:
+    """
+    Read the `event`, `item` and `world` fields of a BSON encoded websocket message without decoding the rest of it,
+    the `sales` and `listings` arrays are skipped by their length. Returns None when a field is missing or the frame
+    contains an element type that is not expected in Universalis messages.
+    """
+    try:
+        if frame.startswith(EVENT_ELEMENT, 4):
+            length = unpack_int32(frame, 11)[0]
+            item_name, item, world_name, world = ITEM_AND_WORLD_ELEMENTS.unpack_from(frame, 15 + length)
+            if length > 0 and frame[14 + length] == 0 and item_name == b"\x10item\x00" and world_name == b"\x10world\x00":
+                return frame[15:14 + length].decode(), item, world
+    except (struct.error, UnicodeDecodeError):
+        return None
+    event = item = world = None
+    position = 4
+    end = len(frame) - 1
+    try:
+        while position < end and (event is None or item is None or world is None):
+            element_type = frame[position]
+            name_end = frame.index(b"\x00", position + 1)
+            name = frame[position + 1:name_end]
+            position = name_end + 1
+            if element_type == BSON_STRING:
+                length = unpack_int32(frame, position)[0]
+                # A string is null terminated, a frame that is cut off in the middle of it is rejected.
+                if length < 1 or position + 4 + length > len(frame) or frame[position + 3 + length] != 0:
+                    return None
+                if name == b"event":
+                    event = frame[position + 4:position + 3 + length].decode()
+                position += 4 + length
+            elif element_type == BSON_INT32 or element_type == BSON_INT64:
+                value = unpack_int32(frame, position)[0] if element_type == BSON_INT32 else unpack_int64(frame, position)[0]
+                if name == b"item":
+                    item = value
+                elif name == b"world":
+                    world = value
+                position += 4 if element_type == BSON_INT32 else 8
+            elif element_type == BSON_DOCUMENT or element_type == BSON_ARRAY:
+                length = unpack_int32(frame, position)[0]
+                # The smallest document is its length and the terminating null, anything shorter never advances.
+                if length < 5:
+                    return None
+                position += length
+            elif element_type == BSON_BINARY:
+                length = unpack_int32(frame, position)[0]
+                if length < 0:
+                    return None
+                position += 5 + length
+            elif element_type in BSON_FIXED_SIZES:
+                position += BSON_FIXED_SIZES[element_type]
+            else:
+                return None
+    except (ValueError, struct.error, UnicodeDecodeError):
+        return None
+    if event is None or item is None or world is None:
+        return None
+    return event, item, world
+
+
 def parse_recent_history(obj: dict) -> RecentHistory:
     return RecentHistory(
         obj["hq"],
@@ -136,6 +296,57 @@ def parse_recent_history(obj: dict) -> RecentHistory:
     )
 
 
+class OrderBook:
+    """
+    The listings of one item on one world and quality, as prices and quantities sorted by price. Listings are
+    inserted and removed with a binary search, so the book never has to be re-sorted.
+    """
+    __slots__ = ("prices", "quantities")
+
+    def __init__(self):
+        self.prices: List[int] = []
+        self.quantities: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    def add(self, price: int, quantity: int):
+        index = bisect_right(self.prices, price)
+        self.prices.insert(index, price)
+        self.quantities.insert(index, quantity)
+
+    def remove(self, price: int, quantity: int) -> bool:
+        index = bisect_left(self.prices, price)
+        while index < len(self.prices) and self.prices[index] == price:
+            if self.quantities[index] == quantity:
+                del self.prices[index]
+                del self.quantities[index]
+                return True
+            index += 1
+        return False
+
+    def min_price(self) -> int:
+        return self.prices[0] if self.prices else 0
+
+    def depth(self) -> int:
+        return sum(self.quantities)
+
+    def value(self, quantity: int) -> Tuple[int, int]:
+        """
+        Walk the book from the lowest price up and return the total price of the `quantity` cheapest units, together
+        with the number of units that are listed, which is less than `quantity` when the book is too thin.
+        """
+        total = 0
+        remaining = quantity
+        for price, available in zip(self.prices, self.quantities):
+            taken = available if available < remaining else remaining
+            total += taken * price
+            remaining -= taken
+            if remaining == 0:
+                break
+        return total, quantity - remaining
+
+
 @dataclass
 class MarketBoardCurrentData:
     item_id: int
@@ -146,28 +357,103 @@ class MarketBoardCurrentData:
     listings: List[Listing]
     recent_history: List[RecentHistory]
     last_update: int
+    order_books: Dict[Tuple[int, bool], OrderBook] = field(default_factory=dict, repr=False, compare=False)
+    # Listings by listing ID, and the position of every listing object in `listings`, so a listing is found and
+    # removed without scanning the list.
+    listings_by_id: Dict[str, Listing] = field(default_factory=dict, repr=False, compare=False)
+    listing_positions: Dict[int, int] = field(default_factory=dict, repr=False, compare=False)
+    def __post_init__(self):
+        self.rebuild_indexes()
+    def __getstate__(self):
+        # The order books and indexes are derived from the listings, so they are rebuilt instead of pickled.
+        state = dict(self.__dict__)
+        del state["order_books"]
+        state.pop("listings_by_id", None)
+        state.pop("listing_positions", None)
+        return state
+    def __setstate__(self, state):
+        # Pickles written by older versions carry a `min_price_index` instead of the order books.
+        state.pop("min_price_index", None)
+        self.__dict__.update(state)
+        self.rebuild_indexes()
+    def rebuild_indexes(self):
+        self.rebuild_order_books()
+        self.listings_by_id = {listing.listing_id: listing for listing in self.listings if listing.listing_id}
+        self.listing_positions = {id(listing): index for index, listing in enumerate(self.listings)}
+    def rebuild_order_books(self):
+        books: Dict[Tuple[int, bool], OrderBook] = {}
+        for listing in sorted(self.listings, key=attrgetter("price_per_unit")):
+            book = books.get((listing.world_id, listing.hq))
+            if book is None:
+                book = books[(listing.world_id, listing.hq)] = OrderBook()
+            book.prices.append(listing.price_per_unit)
+            book.quantities.append(listing.quantity)
+        self.order_books = books
+    def order_book(self, world_id: int, hq: bool) -> Optional[OrderBook]:
+        return self.order_books.get((world_id, hq))
+    def add_listing(self, listing: Listing):
+        self.listing_positions[id(listing)] = len(self.listings)
+        self.listings.append(listing)
+        if listing.listing_id:
+            self.listings_by_id[listing.listing_id] = listing
+        key = (listing.world_id, listing.hq)
+        book = self.order_books.get(key)
+        if book is None:
+            book = self.order_books[key] = OrderBook()
+        book.add(listing.price_per_unit, listing.quantity)
+    def remove_listing(self, listing: Listing):
+        index = self.listing_positions.pop(id(listing), None)
+        if index is None:
+            # An equal listing instead of the one on the board.
+            index = self.listings.index(listing)
+            listing = self.listings[index]
+            del self.listing_positions[id(listing)]
+        # The last listing takes the place of the removed one, the order of `listings` has no meaning.
+        last = self.listings.pop()
+        if last is not listing:
+            self.listings[index] = last
+            self.listing_positions[id(last)] = index
+        if listing.listing_id and self.listings_by_id.get(listing.listing_id) is listing:
+            del self.listings_by_id[listing.listing_id]
+        key = (listing.world_id, listing.hq)
+        book = self.order_books.get(key)
+        if book is not None and book.remove(listing.price_per_unit, listing.quantity) and not book:
+            del self.order_books[key]
+    def find_listing(self, listing: Listing) -> Optional[Listing]:
+        """Find the listing on the board that `listing` refers to, by listing ID when known, otherwise by its contents."""
+        if listing.listing_id:
+            existing = self.listings_by_id.get(listing.listing_id)
+            if existing is not None or len(self.listings_by_id) == len(self.listings):
+                return existing
+        # Listings without an ID, e.g. from old snapshots, can only be found by their contents.
+        for candidate in self.listings:
+            if listing.listing_id and candidate.listing_id:
+                if candidate.listing_id == listing.listing_id:
+                    return candidate
+            elif (candidate.world_id, candidate.hq, candidate.retainer_name, candidate.price_per_unit, candidate.quantity) == (listing.world_id, listing.hq, listing.retainer_name, listing.price_per_unit, listing.quantity):
+                return candidate
+        return None
+    def apply_listing_added(self, listing: Listing) -> Optional[Listing]:
+        """Add `listing`, replacing the listing it refers to, which is returned."""
+        existing = self.find_listing(listing)
+        if existing is not None:
+            self.remove_listing(existing)
+        self.add_listing(listing)
+        return existing
+    def apply_listing_removed(self, listing: Listing) -> Optional[Listing]:
+        """Remove the listing that `listing` refers to and return it, if it is on the board."""
+        existing = self.find_listing(listing)
+        if existing is not None:
+            self.remove_listing(existing)
+        return existing
     def min_listings(self) -> List[tuple[int, bool, int]]:
-        listings = [
-            {
-                "world_id": listing.world_id, 
-                "price_per_unit": listing.price_per_unit, 
-                "hq": listing.hq
-            } 
-            for listing 
-            in self.listings
-        ]
-        if not listings:
-            return []
-        df = pd.DataFrame(listings)
-        df = df[["world_id", "price_per_unit", "hq"]].groupby(["world_id", "hq"]).min().sort_values("price_per_unit")
-        tuples = list(df.itertuples(index=True, name=None))
-        return [(world_id, hq, price_per_unit) for (world_id, hq), price_per_unit in tuples]
+        return sorted(
+            ((world_id, hq, book.min_price()) for (world_id, hq), book in self.order_books.items()),
+            key=lambda listing: listing[2]
+        )
     def min_listing_on_world(self, world_id, hq) -> int:
-        listings = self.min_listings()
-        for listing_world_id, listing_hq, listing_price in listings:
-            if listing_world_id == world_id and listing_hq == hq:
-                return listing_price
-        return 0
+        book = self.order_books.get((world_id, hq))
+        return book.min_price() if book is not None else 0
 
 
 def parse_market_board_current_data(obj: dict) -> MarketBoardCurrentData:
@@ -183,62 +469,106 @@ def parse_market_board_current_data(obj: dict) -> MarketBoardCurrentData:
     )
 
 
+def merge_market_board_current_data(items: List[MarketBoardCurrentData]) -> MarketBoardCurrentData:
+    """Combine the data of one item from several scopes, the averages are weighted by the sale velocity."""
+    def weighted_average(prices: List[float], velocities: List[float]) -> float:
+        total_velocity = sum(velocities)
+        if total_velocity > 0:
+            return sum(price * velocity for price, velocity in zip(prices, velocities)) / total_velocity
+        prices = [price for price in prices if price]
+        return sum(prices) / len(prices) if prices else 0
+    nq_velocities = [item.nq_average_sale_velocity for item in items]
+    hq_velocities = [item.hq_average_sale_velocity for item in items]
+    return MarketBoardCurrentData(
+        items[0].item_id,
+        weighted_average([item.nq_average_price for item in items], nq_velocities),
+        weighted_average([item.hq_average_price for item in items], hq_velocities),
+        sum(nq_velocities),
+        sum(hq_velocities),
+        [listing for item in items for listing in item.listings],
+        sorted((history for item in items for history in item.recent_history), key=lambda history: history.timestamp, reverse=True),
+        max(item.last_update for item in items)
+    )
+
+
 def get_market_board_current_data(item_ids: List[int]) -> List[MarketBoardCurrentData]:
     assert 0 <= len(item_ids) <= 100
     comma_seperated_item_ids = ",".join(map(str, item_ids))
-    rate_limiter.increase()
-    address = f"https://universalis.app/api/v2/europe/{comma_seperated_item_ids}"
-    http_status_ok = 200
-    attempts_left = 7
-    retry_after_seconds = 2
-    response = requests.get(address)
-    try:
-        while response.status_code != http_status_ok and attempts_left:
-            time.sleep(retry_after_seconds)
-            response = requests.get(address)
-            retry_after_seconds *= 2
-            attempts_left -= 1
-        obj = response.json()
-        rate_limiter.increase()
+    items_per_scope = []
+    for scope in market_scopes:
+        obj = http_get(f"{api_address}/{quote(scope)}/{comma_seperated_item_ids}", endpoint="current").json()
         assert obj
         if "items" in obj:
-            return [parse_market_board_current_data(item) for _, item in obj["items"].items()]
+            items_per_scope.append([parse_market_board_current_data(item) for _, item in obj["items"].items()])
         elif "hasData" in obj:
-            return [parse_market_board_current_data(obj)]
-        return []
-    except Exception as err:
-        print(response.status_code)
-        print(response.raw)
-        raise err
-
-
-def get_market_board(stop_event, max_age_in_hours) -> dict[int, MarketBoardCurrentData]:
-    # check if there is an up-to-date version (age < 24h old)
-    filename = 'market_board.pkl'
-    if os.path.exists(filename):
-        last_modified = os.path.getmtime(filename)
-        if time.time() - last_modified < (max_age_in_hours * 60 * 60):
-            with open(filename, 'rb') as f:
-                market_board = pickle.load(f)
-                return market_board
-    # load market board from Universalis
-    print("Market board is out of date and needs to be updated, this takes up to 15 minutes.")
+            items_per_scope.append([parse_market_board_current_data(obj)])
+    if len(items_per_scope) == 1:
+        return items_per_scope[0]
+    items_by_id: Dict[int, List[MarketBoardCurrentData]] = {}
+    for items in items_per_scope:
+        for item in items:
+            items_by_id.setdefault(item.item_id, []).append(item)
+    return [merge_market_board_current_data(items) if len(items) > 1 else items[0] for items in items_by_id.values()]
+
+
+def get_aggregated_prices(item_ids: List[int], scope: str = None) -> dict:
+    """The `/aggregated` prices of up to 100 items in `scope`, the first market scope by default, as returned by Universalis."""
+    assert 0 <= len(item_ids) <= 100
+    scope = scope or market_scopes[0]
+    return http_get(f"{api_address}/aggregated/{quote(scope)}/{','.join(map(str, item_ids))}", endpoint="aggregated").json()
+
+
+class MarketBoardIndexer:
+    """
+    Fetches the current market board data for `item_ids` in batches of 100, using a bounded pool of `workers`
+    threads. All workers share the keep-alive session and the token bucket, so the combined request rate stays
+    within the Universalis limits no matter how many workers are used. Items passed to `prioritize` are fetched in
+    the next batch, ahead of the remaining items.
+    """
+    def __init__(self, item_ids: List[int], workers: int = 8, batch_size: int = 100):
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.pending = deque(item_ids)
+        self.prioritized = deque()
+        self.requested = set()
+        self.lock = threading.Lock()
+    def prioritize(self, item_id: int):
+        with self.lock:
+            if item_id not in self.requested:
+                self.prioritized.append(item_id)
+    def next_batch(self) -> Optional[List[int]]:
+        with self.lock:
+            batch = []
+            for item_ids in (self.prioritized, self.pending):
+                while item_ids and len(batch) < self.batch_size:
+                    item_id = item_ids.popleft()
+                    if item_id not in self.requested:
+                        self.requested.add(item_id)
+                        batch.append(item_id)
+            return batch or None
+    def run(self, stop_event, on_batch: Callable[[List[int], List[MarketBoardCurrentData]], None]):
+        def work():
+            while not stop_event.is_set():
+                item_ids = self.next_batch()
+                if item_ids is None:
+                    return
+                on_batch(item_ids, get_market_board_current_data(item_ids))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(work) for _ in range(self.workers)]
+            for future in futures:
+                future.result()
+
+
+def index_market_board(stop_event, item_ids: List[int], workers: int = 1) -> dict[int, MarketBoardCurrentData]:
     market_board = {}
-    marketable_items = get_marketable_items()
-    current_batch = 0
-    batch_size = 100
-    total_batches = len(marketable_items) // batch_size + 1
+    lock = threading.Lock()
     from tqdm import tqdm
-    with tqdm(total=len(marketable_items)) as progress:
-        for item_ids in batcher(marketable_items, 100):
-            if stop_event.is_set():
-                return {}
-            market_board_current_data = get_market_board_current_data(item_ids)
-            for item in market_board_current_data:
-                market_board[item.item_id] = item
-            current_batch += 1
-            progress.update(len(item_ids))
-    # cache results
-    with open(filename, 'wb') as f:
-        pickle.dump(market_board, f)
-    return market_board
\ No newline at end of file
+    with tqdm(total=len(item_ids)) as progress:
+        def on_batch(batch_item_ids, items):
+            with lock:
+                for item in items:
+                    market_board[item.item_id] = item
+                progress.update(len(batch_item_ids))
+        MarketBoardIndexer(item_ids, workers).run(stop_event, on_batch)
+    return market_board
+
@@ -0,0 +1,102 @@
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+import queue
+import threading
+import time
+from arbitrage.events import Event, events_shed
+from arbitrage.log import get_logger
+from arbitrage.metrics import Counter
+from arbitrage.universalis import MarketBoardCurrentData, MarketBoardIndexer
+
+
+# Listings of a single item that are kept while it is not indexed, older ones are dropped first.
+MAX_PARKED_EVENTS_PER_ITEM = 100
+
+log = get_logger("market_board")
+parked_events = Counter("warm_start_parked_events_total", "Listing events of items that were not indexed yet, kept until the item is indexed.", ["event"])
+
+
+class WarmStart:
+    """
+    Indexes the market board in the background while the arbitrager already handles events. The indexed batches are
+    queued until the arbitrager applies them with `apply_batches`, so the market board is only changed by the
+    arbitrager thread. Listing events of items that are not indexed yet are parked per item, and the item is moved
+    to the front of the indexing order. When its batch is applied the parked events are handed back in order of
+    arrival, events that waited longer than `max_age_seconds` are marked as stale.
+    """
+    def __init__(self, item_ids: List[int], workers: int = 8, max_age_seconds: float = 10.0, on_complete: Callable[[], Any] = None):
+        self.item_ids = set(item_ids)
+        self.item_count = len(self.item_ids)
+        self.indexer = MarketBoardIndexer(item_ids, workers)
+        self.max_age_seconds = max_age_seconds
+        self.on_complete = on_complete
+        self.indexed = queue.Queue()
+        self.parked: Dict[int, Deque[Event]] = {}
+        self.indexer_done = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.complete = False
+        self.applied = 0
+        self.started_at = time.perf_counter()
+
+    def start(self, stop_event):
+        threading.Thread(target=self.run, args=(stop_event,), daemon=True).start()
+        return self
+
+    def run(self, stop_event):
+        try:
+            self.indexer.run(stop_event, lambda item_ids, items: self.indexed.put((item_ids, items)))
+        except Exception as err:
+            self.error = err
+            return
+        # An interrupted index is not complete, it is started over the next time.
+        if not stop_event.is_set():
+            self.indexer_done.set()
+
+    def park(self, event: Event) -> bool:
+        """Keep a listing event until its item is indexed, returns `False` when the item is not being indexed."""
+        item_id = event.args.item_code
+        if item_id not in self.item_ids:
+            return False
+        events = self.parked.get(item_id)
+        if events is None:
+            events = self.parked[item_id] = deque(maxlen=MAX_PARKED_EVENTS_PER_ITEM)
+            self.indexer.prioritize(item_id)
+        elif len(events) == events.maxlen:
+            events_shed.inc(events[0].type, "parked_overflow")
+        events.append(event)
+        parked_events.inc(event.type)
+        return True
+
+    def apply_batches(self, on_batch: Callable[[List[MarketBoardCurrentData]], Any], on_event: Callable[[Event], Any]):
+        """
+        Apply the batches that were indexed so far with `on_batch`, followed by the events that were parked for
+        their items with `on_event`. Raises the error of the indexer, if it failed.
+        """
+        if self.complete:
+            return
+        while True:
+            try:
+                item_ids, items = self.indexed.get_nowait()
+            except queue.Empty:
+                break
+            on_batch(items)
+            # Progress is logged every 10% of the items.
+            if (self.applied + len(item_ids)) * 10 // max(1, self.item_count) > self.applied * 10 // max(1, self.item_count):
+                log.info("Indexed {:,} of {:,} items, {:,} items have parked listings.", self.applied + len(item_ids), self.item_count, len(self.parked))
+            self.applied += len(item_ids)
+            now = time.perf_counter()
+            for item_id in item_ids:
+                # Items without market data are not on the market board, their listings are not parked again.
+                self.item_ids.discard(item_id)
+                for event in self.parked.pop(item_id, ()):
+                    if event.type == Event.Listing and now - event.received_at > self.max_age_seconds:
+                        event.stale = True
+                        events_shed.inc(event.type, "stale")
+                    on_event(event)
+        if self.error is not None:
+            raise self.error
+        if self.indexer_done.is_set() and self.indexed.empty():
+            self.complete = True
+            log.info("Indexed {:,} items in {:.0f}s.", self.item_count, time.perf_counter() - self.started_at)
+            if self.on_complete is not None:
+                self.on_complete()
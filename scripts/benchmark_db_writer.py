@@ -0,0 +1,79 @@
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+import psycopg2
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from arbitrage.db import ROLLUPS, TABLE_NAME, DbParameters, DbWriter, create_rollups, initialize_database, rollup_name
+
+
+BENCHMARK_TABLE_NAME = f"{TABLE_NAME}_benchmark"
+
+
+def random_rows(count: int):
+    rng = random.Random(0)
+    now = int(time.time())
+    return [(now - rng.randint(0, 86_400), rng.choice([33, 36, 42]), rng.randint(1, 40_000), rng.randint(1, 1_000_000), rng.randint(1, 99), rng.random() < 0.4) for _ in range(count)]
+
+
+def insert_executemany(db_params: DbParameters, rows, buffer_size=100):
+    # The previous implementation: a new connection and an `executemany` for every 100 rows.
+    query = f"INSERT INTO {BENCHMARK_TABLE_NAME} (time, world_id, item_id, price, quantity, hq) VALUES (%s, %s, %s, %s, %s, %s);"
+    for i in range(0, len(rows), buffer_size):
+        batch = [(datetime.fromtimestamp(t, tz=timezone.utc), *rest) for t, *rest in rows[i:i + buffer_size]]
+        with psycopg2.connect(**db_params.as_dict()) as conn:
+            with conn.cursor() as cur:
+                cur.executemany(query, batch)
+
+
+def insert_db_writer(db_params: DbParameters, rows, update_rollups: bool):
+    writer = DbWriter(db_params, table_name=BENCHMARK_TABLE_NAME, flush_rows=5_000, flush_interval=0.5, put_timeout=1.0, update_rollups=update_rollups).start()
+    blocked = 0.0
+    for row in rows:
+        started_at = time.perf_counter()
+        writer.insert_row(*row)
+        blocked += time.perf_counter() - started_at
+    writer.stop()
+    return blocked
+
+
+def main():
+    load_dotenv()
+    db_params = DbParameters(
+        os.getenv("DB_HOST", ""),
+        int(os.getenv("DB_PORT", 5432)),
+        os.getenv("DB_USER", ""),
+        os.getenv("DB_PASSWORD", ""),
+        os.getenv("DB_NAME", "")
+    )
+    initialize_database(db_params)
+    with psycopg2.connect(**db_params.as_dict()) as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {BENCHMARK_TABLE_NAME}; CREATE TABLE {BENCHMARK_TABLE_NAME} (LIKE {TABLE_NAME} INCLUDING ALL);")
+            cur.execute(f"DROP TABLE IF EXISTS {', '.join(rollup_name(BENCHMARK_TABLE_NAME, resolution) for resolution in ROLLUPS)};")
+            create_rollups(cur, BENCHMARK_TABLE_NAME)
+    try:
+        rows = random_rows(20_000)
+        started_at = time.perf_counter()
+        insert_executemany(db_params, rows)
+        elapsed = time.perf_counter() - started_at
+        print(f"{'executemany':>21}: {len(rows):,} rows in {elapsed:.2f}s ({len(rows) / elapsed:,.0f} rows/s), all of it on the calling thread.")
+
+        rows = random_rows(200_000)
+        for name, update_rollups in [("DbWriter", False), ("DbWriter with rollups", True)]:
+            started_at = time.perf_counter()
+            blocked = insert_db_writer(db_params, rows, update_rollups)
+            elapsed = time.perf_counter() - started_at
+            print(f"{name:>21}: {len(rows):,} rows in {elapsed:.2f}s ({len(rows) / elapsed:,.0f} rows/s), calling thread blocked for {blocked:.2f}s.")
+    finally:
+        with psycopg2.connect(**db_params.as_dict()) as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {BENCHMARK_TABLE_NAME}, {', '.join(rollup_name(BENCHMARK_TABLE_NAME, resolution) for resolution in ROLLUPS)};")
+
+
+if __name__ == "__main__":
+    main()
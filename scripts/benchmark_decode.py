@@ -0,0 +1,85 @@
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("HOME_WORLD", "33")
+os.environ.setdefault("UNIVERSALIS_WEBSOCKET_ADDR", "ws://127.0.0.1")
+
+import bson
+import app
+from arbitrage.events import Event
+from arbitrage.replay import read_frames
+from arbitrage.store import MarketBoardStore
+from arbitrage.universalis import parse_listing_event, parse_market_board_current_data, parse_sale_event
+from scripts.fake_market_board import fake_market_board_current_data, fake_websocket_frames
+
+
+class NullQueue:
+    def put(self, event):
+        pass
+
+
+# The previous implementation of `app.handle_websocket_message`, kept here as the baseline.
+def decode_every_frame(encoded_message: bytes, arbitrager_queue):
+    received_at = time.perf_counter()
+    message = bson.decode(encoded_message)
+    if message["event"] == "sales/add":
+        event = Event.sale(parse_sale_event(message))
+    elif message["event"] == "listings/add":
+        event = Event.listing(parse_listing_event(message))
+    elif message["event"] == "listings/remove":
+        event = Event.listing_removed(parse_listing_event(message))
+    else:
+        return
+    event.received_at = received_at
+    app.websocket_decode_seconds.observe(time.perf_counter() - received_at)
+    app.websocket_events.inc(message["event"], event.args.world_id)
+    arbitrager_queue.put(event)
+
+
+def benchmark(name, handle, frames, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in frames:
+            handle(frame)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:>16}: {len(frames):,} frames in {best:.3f}s ({len(frames) / best:,.0f} frames/s)")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decoding websocket frames, with and without filtering on the message header.")
+    parser.add_argument("--recording", help="recording made with WEBSOCKET_RECORD_FILE, synthetic traffic is used when left out")
+    parser.add_argument("--items", type=int, default=2_000, help="number of items in the synthetic traffic")
+    parser.add_argument("--frames", type=int, default=50_000, help="number of synthetic frames")
+    parser.add_argument("--known", type=float, default=0.5, help="fraction of the items that is on the market board")
+    args = parser.parse_args()
+
+    if args.recording:
+        frames = [frame for _, frame in read_frames(args.recording)]
+    else:
+        frames = [frame for _, frame in fake_websocket_frames(args.items, args.frames)]
+
+    item_ids = sorted({bson.decode(frame)["item"] for frame in frames})
+    known_item_ids = random.Random(1).sample(item_ids, int(len(item_ids) * args.known))
+    rng = random.Random(1)
+    market_board = MarketBoardStore({item_id: parse_market_board_current_data(fake_market_board_current_data(item_id, rng, 1)) for item_id in known_item_ids})
+    market_board_ready = threading.Event()
+    market_board_ready.set()
+    frame_filter = app.FrameFilter(market_board, market_board_ready, keep_sales=False)
+    arbitrager_queue = NullQueue()
+
+    baseline = benchmark("decode all", lambda frame: decode_every_frame(frame, arbitrager_queue), frames)
+    benchmark("no filter", lambda frame: app.handle_websocket_message(frame, arbitrager_queue), frames)
+    filtered = benchmark("peek and filter", lambda frame: app.handle_websocket_message(frame, arbitrager_queue, frame_filter), frames)
+    print(f"Speedup with {args.known:.0%} of the items on the market board: {baseline / filtered:,.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from arbitrage import universalis
+from scripts.universalis_stub import UniversalisStub
+
+
+def main():
+    item_count = 5_000
+    latency = 0.25
+    stub = UniversalisStub(item_count, latency=latency, throttle_ratio=0.01).start()
+    universalis.api_address = stub.address
+    item_ids = universalis.get_marketable_items()
+    print(f"Indexing {len(item_ids):,} items from a local stub with {latency * 1000:.0f}ms latency per request.")
+
+    results = {}
+    for workers in [1, 4, 8, 16]:
+        start = time.perf_counter()
+        market_board = universalis.index_market_board(threading.Event(), item_ids, workers)
+        elapsed = time.perf_counter() - start
+        assert len(market_board) == item_count
+        results[workers] = elapsed
+        print(f"{workers:>2} worker(s): {elapsed:.2f}s ({results[1] / elapsed:.1f}x)")
+    print(f"Stub served {stub.request_count:,} requests, {stub.throttled_count:,} of them were throttled.")
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import random
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from arbitrage.naming import worlds
+from scripts.fake_market_board import fake_market_board
+
+
+# The previous implementation of `MarketBoardCurrentData.min_listing_on_world`, kept here as the baseline.
+def pandas_min_listings(item):
+    listings = [
+        {
+            "world_id": listing.world_id,
+            "price_per_unit": listing.price_per_unit,
+            "hq": listing.hq
+        }
+        for listing
+        in item.listings
+    ]
+    if not listings:
+        return []
+    df = pd.DataFrame(listings)
+    df = df[["world_id", "price_per_unit", "hq"]].groupby(["world_id", "hq"]).min().sort_values("price_per_unit")
+    tuples = list(df.itertuples(index=True, name=None))
+    return [(world_id, hq, price_per_unit) for (world_id, hq), price_per_unit in tuples]
+
+
+def pandas_min_listing_on_world(item, world_id, hq):
+    for listing_world_id, listing_hq, listing_price in pandas_min_listings(item):
+        if listing_world_id == world_id and listing_hq == hq:
+            return listing_price
+    return 0
+
+
+def benchmark(name, lookup, lookups):
+    start = time.perf_counter()
+    for item, world_id, hq in lookups:
+        lookup(item, world_id, hq)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>8}: {len(lookups):,} lookups in {elapsed:.3f}s ({len(lookups) / elapsed:,.0f} lookups/s)")
+    return elapsed
+
+
+def main():
+    rng = random.Random(1)
+    market_board = fake_market_board(200)
+    items = list(market_board.values())
+    lookups = [(rng.choice(items), rng.choice(list(worlds.keys())), rng.random() < 0.5) for _ in range(2_000)]
+
+    for item, world_id, hq in lookups[:200]:
+        assert item.min_listing_on_world(world_id, hq) == pandas_min_listing_on_world(item, world_id, hq)
+
+    pandas_elapsed = benchmark("pandas", pandas_min_listing_on_world, lookups)
+    index_elapsed = benchmark("index", lambda item, world_id, hq: item.min_listing_on_world(world_id, hq), lookups)
+    print(f"Speedup: {pandas_elapsed / index_elapsed:,.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import contextlib
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("HOME_WORLD", "33")
+os.environ.setdefault("UNIVERSALIS_WEBSOCKET_ADDR", "ws://127.0.0.1")
+
+import app
+from arbitrage import universalis
+from arbitrage.events import Event, EventQueue
+from arbitrage.notifications import DiscordDispatcher
+from arbitrage.replay import FrameRecorder, replay_frames
+from arbitrage.snapshot import MarketBoardSnapshot
+from arbitrage.store import MarketBoardStore
+from scripts.fake_market_board import fake_market_board, fake_websocket_frames
+from scripts.universalis_stub import UniversalisStub
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def run(recording: str, item_count: int, speed: float):
+    """Replay `recording` through the threaded pipeline, with the Universalis API and Discord replaced by a local stub."""
+    stub = UniversalisStub(item_count, latency=0.05).start()
+    universalis.api_address = stub.address
+    stop_event = threading.Event()
+    arbitrager_queue = EventQueue(app.ARBITRAGER_QUEUE_SIZE, app.ARBITRAGER_MAX_EVENT_AGE_SECONDS)
+    http_scraper_queue = queue.Queue()
+    discord_dispatcher = DiscordDispatcher(stub.webhook_address, batch_seconds=0.2).start()
+    market_board = MarketBoardStore()
+    snapshot = MarketBoardSnapshot()
+    snapshot.load(market_board)
+
+    handled = []
+    def on_handled(event: Event):
+        handled.append((event.type, time.perf_counter() - event.received_at))
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        threads = [
+            threading.Thread(target=app.run_arbitrager, args=(market_board, snapshot, arbitrager_queue, http_scraper_queue, None, discord_dispatcher.notify, stop_event, on_handled)),
+            threading.Thread(target=app.http_scraper, args=(http_scraper_queue, arbitrager_queue, stop_event)),
+        ]
+        for t in threads:
+            t.start()
+        started_at = time.perf_counter()
+        frame_count = replay_frames(recording, lambda frame: app.handle_websocket_message(frame, arbitrager_queue), stop_event, speed)
+        while len(handled) < frame_count:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - started_at
+        stop_event.set()
+        for t in threads:
+            t.join()
+        discord_dispatcher.stop()
+    stub.shutdown()
+    snapshot.close()
+
+    listing_latencies = [latency * 1000 for event_type, latency in handled if event_type == Event.Listing]
+    print(f"{speed if speed else 'max':>5} speed: {frame_count / elapsed:,.0f} events/s, listing-to-decision latency p50 {percentile(listing_latencies, 50):.3f}ms, p99 {percentile(listing_latencies, 99):.3f}ms, {len(stub.webhook_messages)} webhook posts.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the event pipeline by replaying recorded websocket traffic.")
+    parser.add_argument("--recording", help="recording made with WEBSOCKET_RECORD_FILE, synthetic traffic is used when left out")
+    parser.add_argument("--items", type=int, default=2_000, help="number of items on the synthetic market board")
+    parser.add_argument("--frames", type=int, default=20_000, help="number of synthetic frames")
+    parser.add_argument("--speed", type=float, action="append", help="replay speed, 0 replays as fast as possible (default: 0 and 1)")
+    args = parser.parse_args()
+
+    recording = os.path.abspath(args.recording) if args.recording else None
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        snapshot = MarketBoardSnapshot()
+        snapshot.save(MarketBoardStore(fake_market_board(args.items, listings_per_item=30)))
+        snapshot.close()
+        if recording is None:
+            recording = os.path.join(directory, "frames.bin.gz")
+            recorder = FrameRecorder(recording)
+            for received_at, frame in fake_websocket_frames(args.items, args.frames, frames_per_second=2_000):
+                recorder.record(frame, received_at)
+            recorder.close()
+            print(f"Recorded {args.frames:,} synthetic frames at 2,000 frames/s ({os.path.getsize(recording) / 1e6:.1f}MB).")
+        for speed in args.speed or [0, 1]:
+            run(recording, args.items, speed)
+
+
+if __name__ == "__main__":
+    main()
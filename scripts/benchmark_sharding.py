@@ -0,0 +1,105 @@
+import contextlib
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("HOME_WORLD", "33")
+os.environ.setdefault("UNIVERSALIS_WEBSOCKET_ADDR", "ws://127.0.0.1")
+
+import app
+from arbitrage.events import Event, ShardedQueue
+from arbitrage.naming import worlds
+from arbitrage.snapshot import SNAPSHOT_FILENAME, MarketBoardSnapshot
+from arbitrage.store import MarketBoardStore
+from arbitrage.universalis import ListingEvent, ListingEventLine
+from scripts.fake_market_board import fake_market_board
+
+
+def listing_events(item_count: int, event_count: int):
+    rng = random.Random(0)
+    world_ids = list(worlds.keys())
+    events = []
+    for i in range(event_count):
+        price = rng.randint(100_000, 200_000)
+        line = ListingEventLine(price, 1, rng.random() < 0.4, f"Retainer{i}", price, 0, f"listing-{i}", int(time.time()))
+        events.append(Event.listing(ListingEvent(rng.randint(1, item_count), rng.choice(world_ids), [line])))
+    return events
+
+
+def cpu_seconds(pid: int) -> float:
+    """User and system CPU time of a running process, from `/proc` (Linux only)."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def run(shard_count: int, events, snapshot_filename: str) -> Tuple[float, float, List[float]]:
+    """
+    Returns the wall clock time to handle `events`, the CPU time of the main process spent routing them, and the CPU
+    time every shard spent on them.
+    """
+    shutil.copy(snapshot_filename, SNAPSHOT_FILENAME)
+    stop_event = multiprocessing.Event()
+    http_scraper_queue = multiprocessing.Queue()
+    notification_queue = multiprocessing.Queue()
+    arbitrager_queue = ShardedQueue([multiprocessing.Queue() for _ in range(shard_count)])
+    shard_ready = [multiprocessing.Event() for _ in range(shard_count)]
+    handled_events = multiprocessing.Value("q", 0)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        processes = [
+            multiprocessing.Process(target=app.arbitrager_shard, args=(shard_index, shard_count, shard_ready[shard_index], arbitrager_queue.queues[shard_index], http_scraper_queue, notification_queue, stop_event, handled_events))
+            for shard_index in range(shard_count)
+        ]
+        for p in processes:
+            p.start()
+    for ready in shard_ready:
+        ready.wait()
+    cpu_started = [cpu_seconds(p.pid) for p in processes]
+    router_started = time.process_time()
+    started_at = time.perf_counter()
+    for event in events:
+        arbitrager_queue.put(event)
+    while handled_events.value < len(events):
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started_at
+    router_cpu = time.process_time() - router_started
+    cpu = [cpu_seconds(p.pid) - started for p, started in zip(processes, cpu_started)]
+    stop_event.set()
+    for p in processes:
+        p.join()
+    return elapsed, router_cpu, cpu
+
+
+def main():
+    item_count = 5_000
+    event_count = 40_000
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        base_snapshot_filename = os.path.join(directory, "base.sqlite")
+        snapshot = MarketBoardSnapshot(base_snapshot_filename)
+        snapshot.save(MarketBoardStore(fake_market_board(item_count, listings_per_item=30)))
+        snapshot.close()
+        events = listing_events(item_count, event_count)
+        cpu_count = os.cpu_count()
+        print(f"Routing {event_count:,} listing events over {item_count:,} items, on {cpu_count} CPU(s).")
+        # The wall clock throughput only scales while every shard, and the main process that routes the events, has a
+        # core of its own. On a machine with enough cores they run in parallel, so handling the events takes as long
+        # as the busiest of them: that bounds the speedup over handling all events in one process.
+        baseline = None
+        for shard_count in [1, 2, 4, 8]:
+            elapsed, router_cpu, cpu = run(shard_count, events, base_snapshot_filename)
+            baseline = baseline or elapsed
+            bound = sum(cpu) / max(max(cpu), router_cpu, 1e-9)
+            note = "" if shard_count < cpu_count else ", fewer CPUs than shards and router"
+            print(f"{shard_count} shard(s): {event_count / elapsed:,.0f} events/s ({baseline / elapsed:.1f}x), routing {router_cpu:.2f}s CPU, busiest shard {max(cpu):.2f}s CPU, at most {bound:.1f}x with {shard_count + 1} cores{note}")
+
+
+if __name__ == "__main__":
+    main()
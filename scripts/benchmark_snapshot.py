@@ -0,0 +1,52 @@
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from arbitrage.snapshot import MarketBoardSnapshot, migrate_pickle
+from arbitrage.store import MarketBoardStore
+from scripts.fake_market_board import fake_market_board
+
+
+def timed(name, f):
+    start = time.perf_counter()
+    result = f()
+    print(f"{name:>28}: {(time.perf_counter() - start) * 1000:,.1f}ms")
+    return result
+
+
+def main():
+    item_count = 20_000
+    print(f"Generating a market board with {item_count:,} items.")
+    market_board = fake_market_board(item_count, listings_per_item=30)
+    with tempfile.TemporaryDirectory() as directory:
+        pickle_filename = os.path.join(directory, "market_board.pkl")
+        snapshot_filename = os.path.join(directory, "market_board.sqlite")
+        with open(pickle_filename, "wb") as f:
+            pickle.dump(market_board, f)
+        snapshot = MarketBoardSnapshot(snapshot_filename)
+        timed("migrate pickle", lambda: migrate_pickle(snapshot, pickle_filename))
+        snapshot.close()
+        print(f"{'pickle size':>28}: {os.path.getsize(pickle_filename) / 1e6:,.1f}MB")
+        print(f"{'snapshot size':>28}: {os.path.getsize(snapshot_filename) / 1e6:,.1f}MB")
+
+        def load_pickle():
+            with open(pickle_filename, "rb") as f:
+                return MarketBoardStore(pickle.load(f))
+        timed("load pickle into store", load_pickle)
+
+        snapshot = MarketBoardSnapshot(snapshot_filename)
+        store = MarketBoardStore()
+        timed("load snapshot into store", lambda: snapshot.load(store))
+        timed("first access of one item", lambda: store[item_count // 2])
+        item = market_board[item_count // 3]
+        timed("rewrite one item", lambda: snapshot.write_items([item]))
+        assert store[item_count // 3] == item
+        assert len(store) == item_count
+
+
+if __name__ == "__main__":
+    main()
@@ -1,121 +1,212 @@
+import argparse
+import glob
+import os
+import sys
 import time
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
 import pandas as pd
 
-start_at_item_id = 0
-max_requests_per_second = 25
-max_item_ids_per_request = 100
-is_test_run = False
-endpoint = "https://universalis.app/api/v2/aggregated/europe/{{comma_seperated_items_ids}}"
-item_names = items = requests.get("https://raw.githubusercontent.com/ffxiv-teamcraft/ffxiv-teamcraft/master/libs/data/src/lib/json/items.json").json()
-
-item_ids = [item_id for item_id, item_name_translations in item_names.items() if item_name_translations["en"] and int(item_id) >= start_at_item_id]
-print(f"There are {len(item_ids)} items.")
-
-# 54869 items / 100 per request * 25 per second = 54896 items / 2500 per second = 21.9 seconds to load all data.
-current_item_price_data = []
-
-
-world_names = {}
-def get_world_name(world_id):
-    global world_names
-    if not world_id:
-        return ""
-    if not world_names:
-        world_names = {item["id"]: item["name"] for item in requests.get("https://universalis.app/api/v2/worlds").json()}
-    return world_names[world_id]
-
-
-def get_property(page, path):
-    current = page
-    for direction in path[:-1]:
-        if direction in current:
-            current = current[direction]
-        else:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from arbitrage import universalis
+from arbitrage.catalog import catalog, world_catalog
+from arbitrage.helpers import TokenBucket, batcher
+
+
+# Output column -> (aggregated metric, field), prefixed with `nq_` and `hq_`.
+FIELDS = {
+    "min_listing_price": ("minListing", "price"),
+    "min_listing_world_id": ("minListing", "worldId"),
+    "recent_purchase_price": ("recentPurchase", "price"),
+    "recent_purchase_world_id": ("recentPurchase", "worldId"),
+    "average_sale_price": ("averageSalePrice", "price"),
+    "average_sale_velocity": ("dailySaleVelocity", "quantity"),
+}
+# The aggregated prices are given per world, data center and region, the widest one that is available is used.
+SCOPE_LEVELS = ["region", "dc", "world"]
+COLUMNS = ["item_id", "item_name"] + [f"{quality}_{field}" for quality in ("nq", "hq") for field in FIELDS] + [
+    "nq_volume_gil",
+    "nq_min_listing_sales_price_profit",
+    "hq_volume_gil",
+    "hq_min_listing_sales_price_profit",
+]
+
+
+def scoped_value(prices: dict, metric: str, field: str) -> float:
+    scopes = prices.get(metric)
+    if scopes:
+        for level in SCOPE_LEVELS:
+            scope = scopes.get(level)
+            if scope is not None and scope.get(field) is not None:
+                return scope[field]
+    return np.nan
+
+
+def to_frame(results: List[dict], item_names: Dict[int, str], world_names: Dict[int, str]) -> pd.DataFrame:
+    """Flatten the `results` of an `/aggregated` response into one row per item, ordered by item ID."""
+    results = sorted(results, key=lambda result: result["itemId"])
+    item_ids = np.array([result["itemId"] for result in results], dtype=np.int64)
+    columns = {
+        "item_id": item_ids,
+        "item_name": [item_names.get(item_id) or f"Undefined ({item_id})" for item_id in item_ids.tolist()],
+    }
+    for quality in ("nq", "hq"):
+        prices = [result.get(quality) or {} for result in results]
+        for column, (metric, field) in FIELDS.items():
+            columns[f"{quality}_{column}"] = np.array([scoped_value(p, metric, field) for p in prices], dtype=np.float64)
+        columns[f"{quality}_recent_purchase_world_id"] = [world_names.get(world_id, "") for world_id in columns[f"{quality}_recent_purchase_world_id"].tolist()]
+    for quality in ("nq", "hq"):
+        columns[f"{quality}_volume_gil"] = columns[f"{quality}_average_sale_price"] * columns[f"{quality}_average_sale_velocity"]
+        columns[f"{quality}_min_listing_sales_price_profit"] = columns[f"{quality}_average_sale_price"] - columns[f"{quality}_min_listing_price"]
+    return pd.DataFrame(columns, columns=COLUMNS)
+
+
+class CsvOutput:
+    """Appends rows to a CSV file, the last line is always a complete row of the highest item ID written so far."""
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.file = None
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def last_item_id(self) -> Optional[int]:
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, "rb+") as f:
+            start = max(0, f.seek(0, os.SEEK_END) - 64 * 1024)
+            f.seek(start)
+            tail = f.read()
+            # A row that was cut off by an interrupted run is removed, so it is written again.
+            end = tail.rfind(b"\n") + 1
+            f.truncate(start + end)
+        lines = tail[:end].splitlines()
+        if not lines or not lines[-1][:1].isdigit():
             return None
-    return current[path[-1]]
-
-
-def parse_item_data(obj):
-    if not "results" in obj:
-        return
-    for item_data in obj["results"]:
-        item_id = item_data["itemId"]
-        item_name = item_names[str(item_id)]["en"]
-        print(f"parsing item {item_id}")
-        nq_min_listing_price = get_property(item_data, ["nq", "minListing", "region", "price"])
-        nq_min_listing_world_id = get_property(item_data, ["nq", "minListing", "region", "worldId"])
-        nq_recent_purchase_price = get_property(item_data, ["nq", "recentPurchase", "region", "price"])
-        nq_recent_purchase_world_id = get_world_name(get_property(item_data, ["nq", "recentPurchase", "region", "worldId"]))
-        nq_average_sale_price = get_property(item_data, ["nq", "averageSalePrice", "region", "price"])
-        nq_average_sale_velocity = get_property(item_data, ["nq", "dailySaleVelocity", "region", "quantity"])
-        hq_min_listing_price = get_property(item_data, ["hq", "minListing", "region", "price"])
-        hq_min_listing_world_id = get_property(item_data, ["hq", "minListing", "region", "worldId"])
-        hq_recent_purchase_price = get_property(item_data, ["hq", "recentPurchase", "region", "price"])
-        hq_recent_purchase_world_id = get_world_name(get_property(item_data, ["hq", "recentPurchase", "region", "worldId"]))
-        hq_average_sale_price = get_property(item_data, ["hq", "averageSalePrice", "region", "price"])
-        hq_average_sale_velocity = get_property(item_data, ["hq", "dailySaleVelocity", "region", "quantity"])
-        current_item_price_data.append([
-            item_id, item_name,
-            nq_min_listing_price, nq_min_listing_world_id, nq_recent_purchase_price, 
-            nq_recent_purchase_world_id, nq_average_sale_price, nq_average_sale_velocity,
-            hq_min_listing_price, hq_min_listing_world_id, hq_recent_purchase_price, 
-            hq_recent_purchase_world_id, hq_average_sale_price, hq_average_sale_velocity
-        ])
-
-
-def batcher(list, n):
-    batch = []
-    for item in list:
-        batch.append(item)
-        if len(batch) >= n:
-            yield batch
-            batch = []
-    if batch:
-        yield batch
-
-
-rate_limit_counter = 0
-def rate_limit():
-    global rate_limit_counter
-    rate_limit_counter += 1
-    if rate_limit_counter >= max_requests_per_second:
-        time.sleep(1)
-        rate_limit_counter = 0
-
-
-for item_ids in batcher(item_ids, max_item_ids_per_request):
-    comma_seperated_items_ids = ",".join(item_ids)
-    address = endpoint.replace("{{comma_seperated_items_ids}}", comma_seperated_items_ids)
-    print(f"GET {address}")
-    data = requests.get(address).json()
-    parse_item_data(data)
-    if is_test_run:
-        break
-    rate_limit()
-    
-
-df = pd.DataFrame(current_item_price_data, columns=[
-    "item_id", 
-    "item_name",
-    "nq_min_listing_price",
-    "nq_min_listing_world_id",
-    "nq_recent_purchase_price",
-    "nq_recent_purchase_world_id",
-    "nq_average_sale_price",
-    "nq_average_sale_velocity",
-    "hq_min_listing_price",
-    "hq_min_listing_world_id",
-    "hq_recent_purchase_price",
-    "hq_recent_purchase_world_id",
-    "hq_average_sale_price",
-    "hq_average_sale_velocity",
-])
-
-df['nq_volume_gil'] = df['nq_average_sale_price'] * df['nq_average_sale_velocity']
-df['nq_min_listing_sales_price_profit'] = df['nq_average_sale_price'] - df['nq_min_listing_price']
-
-df['hq_volume_gil'] = df['hq_average_sale_price'] * df['hq_average_sale_velocity']
-df['hq_min_listing_sales_price_profit'] = df['hq_average_sale_price'] - df['hq_min_listing_price']
-
-df.to_excel("current_item_price.xlsx")
\ No newline at end of file
+        return int(lines[-1].split(b",", 1)[0])
+
+    def write(self, df: pd.DataFrame):
+        if self.file is None:
+            write_header = not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0
+            self.file = open(self.filename, "a", newline="", encoding="utf-8")
+            if write_header:
+                self.file.write(",".join(COLUMNS) + "\n")
+        df.to_csv(self.file, header=False, index=False)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class ParquetOutput:
+    """
+    Writes a directory of Parquet files, one per run with one row group per batch. Files that were not closed by an
+    interrupted run can't be read and are removed when resuming.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.writer = None
+
+    def parts(self) -> List[str]:
+        return glob.glob(os.path.join(self.directory, "part-*.parquet"))
+
+    def clear(self):
+        for filename in self.parts():
+            os.remove(filename)
+
+    def last_item_id(self) -> Optional[int]:
+        import pyarrow.parquet as pq
+        last_item_id = None
+        for filename in self.parts():
+            try:
+                item_ids = pq.read_table(filename, columns=["item_id"])["item_id"].to_numpy()
+            except Exception:
+                os.remove(filename)
+                continue
+            if len(item_ids):
+                last_item_id = max(last_item_id or 0, int(item_ids.max()))
+        return last_item_id
+
+    def write(self, df: pd.DataFrame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            os.makedirs(self.directory, exist_ok=True)
+            filename = os.path.join(self.directory, f"part-{int(time.time() * 1000)}.parquet")
+            self.writer = pq.ParquetWriter(filename, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def fetch_batches(item_ids: List[int], scope: str, workers: int, batch_size: int) -> Iterator[Tuple[List[int], List[dict]]]:
+    """Fetch the batches concurrently, they are yielded with their results in the order of `item_ids`."""
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    batches = list(batcher(item_ids, batch_size))
+    try:
+        for batch, response in zip(batches, executor.map(lambda batch: universalis.get_aggregated_prices(batch, scope), batches)):
+            yield batch, response.get("results", [])
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the aggregated Universalis prices of every marketable item to CSV or Parquet.")
+    parser.add_argument("--output", default="current_item_price.csv", help="CSV file, or a directory of Parquet files when it ends with .parquet")
+    parser.add_argument("--format", choices=["csv", "parquet"], help="output format, derived from --output when left out")
+    parser.add_argument("--scope", default="europe", help="region, data center or world to export the prices of")
+    parser.add_argument("--workers", type=int, default=8, help="number of concurrent requests")
+    parser.add_argument("--rate", type=float, default=25, help="maximum number of requests per second")
+    parser.add_argument("--batch-size", type=int, default=100, help="items per request, at most 100")
+    parser.add_argument("--start-at", type=int, default=0, help="first item ID to export")
+    parser.add_argument("--resume", action="store_true", help="append to the output, after the last item ID that was written")
+    parser.add_argument("--limit", type=int, help="only export this many items, e.g. for a test run")
+    parser.add_argument("--api", default=os.getenv("UNIVERSALIS_API_ADDR") or universalis.api_address, help="address of the Universalis API")
+    args = parser.parse_args()
+
+    universalis.api_address = args.api
+    universalis.rate_limiter = TokenBucket(args.rate)
+    output_format = args.format or ("parquet" if args.output.endswith(".parquet") else "csv")
+    output = ParquetOutput(args.output) if output_format == "parquet" else CsvOutput(args.output)
+    if not args.resume:
+        output.clear()
+
+    start_at = args.start_at
+    if args.resume:
+        last_item_id = output.last_item_id()
+        if last_item_id is not None:
+            start_at = max(start_at, last_item_id + 1)
+            print(f"Resuming after item {last_item_id}.")
+    catalog.load()
+    world_catalog.load()
+    # Items are exported in order of their ID, so that a resumed export continues after the last written item.
+    item_ids = [item_id for item_id in sorted(universalis.get_marketable_items()) if item_id >= start_at]
+    if args.limit is not None:
+        item_ids = item_ids[:args.limit]
+    print(f"Exporting {len(item_ids):,} items to {args.output}.")
+
+    from tqdm import tqdm
+    started_at = time.perf_counter()
+    rows = 0
+    try:
+        with tqdm(total=len(item_ids)) as progress:
+            for batch, results in fetch_batches(item_ids, args.scope, args.workers, min(args.batch_size, 100)):
+                if results:
+                    df = to_frame(results, catalog.names, world_catalog.names)
+                    output.write(df)
+                    rows += len(df)
+                progress.update(len(batch))
+    finally:
+        output.close()
+    print(f"Exported {rows:,} items in {time.perf_counter() - started_at:.1f}s ({time.process_time():.1f}s CPU).")
+
+
+if __name__ == "__main__":
+    main()
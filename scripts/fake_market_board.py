@@ -0,0 +1,104 @@
+import os
+import random
+import sys
+import time
+import bson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from arbitrage.naming import worlds
+from arbitrage.universalis import parse_market_board_current_data
+
+
+def fake_listing(rng: random.Random, world_id: int, base_price: int) -> dict:
+    quantity = rng.randint(1, 99)
+    price_per_unit = max(1, int(base_price * rng.uniform(0.7, 1.6)))
+    return {
+        "lastReviewTime": int(time.time()) - rng.randint(0, 86_400),
+        "retainerName": f"Retainer{rng.randint(0, 9999)}",
+        "pricePerUnit": price_per_unit,
+        "quantity": quantity,
+        "worldID": world_id,
+        "total": price_per_unit * quantity,
+        "tax": int(price_per_unit * quantity * 0.05),
+        "hq": rng.random() < 0.4,
+    }
+
+
+def fake_recent_history(rng: random.Random, world_id: int, base_price: int) -> dict:
+    quantity = rng.randint(1, 20)
+    price_per_unit = max(1, int(base_price * rng.uniform(0.8, 1.3)))
+    return {
+        "hq": rng.random() < 0.4,
+        "pricePerUnit": price_per_unit,
+        "quantity": quantity,
+        "worldID": world_id,
+        "buyerName": f"Buyer{rng.randint(0, 9999)}",
+        "total": price_per_unit * quantity,
+        "timestamp": int(time.time()) - rng.randint(0, 7 * 86_400),
+    }
+
+
+def fake_market_board_current_data(item_id: int, rng: random.Random, listings_per_item: int = 50, history_per_item: int = 20) -> dict:
+    """Build a Universalis `/api/v2/{region}/{item_id}` response with random listings on every known world."""
+    world_ids = list(worlds.keys())
+    base_price = rng.choice([100, 1_000, 10_000, 100_000])
+    return {
+        "itemID": item_id,
+        "averagePriceNQ": base_price,
+        "averagePriceHQ": base_price * 1.5,
+        "nqSaleVelocity": rng.uniform(0, 50),
+        "hqSaleVelocity": rng.uniform(0, 20),
+        "listings": [fake_listing(rng, rng.choice(world_ids), base_price) for _ in range(listings_per_item)],
+        "recentHistory": [fake_recent_history(rng, rng.choice(world_ids), base_price) for _ in range(history_per_item)],
+        "hasData": True,
+    }
+
+
+def fake_aggregated_prices(item_id: int, rng: random.Random) -> dict:
+    """Build one entry of the `results` of a Universalis `/api/v2/aggregated/{region}/{item_ids}` response."""
+    world_ids = list(worlds.keys())
+    base_price = rng.choice([100, 1_000, 10_000, 100_000])
+    def quality(factor: float) -> dict:
+        return {
+            "minListing": {"region": {"price": int(base_price * factor * rng.uniform(0.7, 1.0)), "worldId": rng.choice(world_ids)}},
+            "recentPurchase": {"region": {"price": int(base_price * factor * rng.uniform(0.8, 1.3)), "timestamp": int(time.time() * 1000), "worldId": rng.choice(world_ids)}},
+            "averageSalePrice": {"region": {"price": base_price * factor}},
+            "dailySaleVelocity": {"region": {"quantity": rng.uniform(0, 50)}},
+        }
+    result = {"itemId": item_id, "nq": quality(1.0), "hq": quality(1.5), "worldUploadTimes": []}
+    if rng.random() < 0.3:
+        # Items that can't be high quality have no HQ prices.
+        result["hq"] = {}
+    return result
+
+
+def fake_market_board(item_count: int, seed: int = 0, listings_per_item: int = 50):
+    rng = random.Random(seed)
+    return {
+        item_id: parse_market_board_current_data(fake_market_board_current_data(item_id, rng, listings_per_item))
+        for item_id in range(1, item_count + 1)
+    }
+
+
+def fake_websocket_frames(item_count: int, frame_count: int, frames_per_second: float = 1_000, seed: int = 0):
+    """Build `(received_at, frame)` pairs of BSON encoded `sales/add`, `listings/add` and `listings/remove` events."""
+    rng = random.Random(seed)
+    world_ids = list(worlds.keys())
+    started_at = time.time()
+    frames = []
+    for i in range(frame_count):
+        item_id = rng.randint(1, item_count)
+        world_id = rng.choice(world_ids)
+        base_price = rng.choice([100, 1_000, 10_000, 100_000])
+        kind = rng.random()
+        if kind < 0.3:
+            sales = [fake_recent_history(rng, world_id, base_price) for _ in range(rng.randint(1, 3))]
+            message = {"event": "sales/add", "item": item_id, "world": world_id, "sales": sales}
+        else:
+            listings = [fake_listing(rng, world_id, base_price) for _ in range(rng.randint(1, 5))]
+            for listing in listings:
+                listing["listingID"] = f"{i}-{rng.getrandbits(32)}"
+            message = {"event": "listings/add" if kind < 0.8 else "listings/remove", "item": item_id, "world": world_id, "listings": listings}
+        frames.append((started_at + i / frames_per_second, bson.encode(message)))
+    return frames
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from scripts.fake_market_board import fake_aggregated_prices, fake_market_board_current_data
+
+
+DATA_CENTERS = [
+    {"name": "Chaos", "region": "Europe", "worlds": [39, 71, 80, 83, 85, 97, 400, 401]},
+    {"name": "Light", "region": "Europe", "worlds": [33, 36, 42, 56, 66, 67, 402, 403]},
+    {"name": "Aether", "region": "North-America", "worlds": [40, 54, 57, 63, 65, 73, 79, 99]},
+]
+WORLDS = [
+    {"id": 39, "name": "Omega"}, {"id": 71, "name": "Moogle"}, {"id": 80, "name": "Cerberus"}, {"id": 83, "name": "Louisoix"},
+    {"id": 85, "name": "Spriggan"}, {"id": 97, "name": "Ragnarok"}, {"id": 400, "name": "Sagittarius"}, {"id": 401, "name": "Phantom"},
+    {"id": 33, "name": "Twintania"}, {"id": 36, "name": "Lich"}, {"id": 42, "name": "Zodiark"}, {"id": 56, "name": "Phoenix"},
+    {"id": 66, "name": "Odin"}, {"id": 67, "name": "Shiva"}, {"id": 402, "name": "Alpha"}, {"id": 403, "name": "Raiden"},
+    {"id": 40, "name": "Jenova"}, {"id": 54, "name": "Faerie"}, {"id": 57, "name": "Siren"}, {"id": 63, "name": "Gilgamesh"},
+    {"id": 65, "name": "Midgardsormr"}, {"id": 73, "name": "Adamantoise"}, {"id": 79, "name": "Cactuar"}, {"id": 99, "name": "Sargatanas"},
+]
+
+
+class UniversalisStub(ThreadingHTTPServer):
+    """
+    Local stand-in for the Universalis API that serves `/api/v2/marketable`, `/api/v2/worlds`, `/api/v2/data-centers`,
+    `/api/v2/{scope}/{item_ids}` and `/api/v2/aggregated/{scope}/{item_ids}` with random data. Every request takes
+    `latency` seconds, and a fraction `throttle_ratio` of the requests is answered
+    with `429 Too Many Requests` and a `Retry-After` header. Responses carry an `ETag` for conditional requests. `POST /webhook` stands in for a Discord webhook.
+    """
+    daemon_threads = True
+
+    def __init__(self, item_count: int, latency: float = 0.1, throttle_ratio: float = 0.0, port: int = 0):
+        super().__init__(("127.0.0.1", port), UniversalisStubHandler)
+        self.item_ids = list(range(1, item_count + 1))
+        self.latency = latency
+        self.throttle_ratio = throttle_ratio
+        self.request_count = 0
+        self.throttled_count = 0
+        self.webhook_messages = []
+        self.lock = threading.Lock()
+
+    @property
+    def address(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/api/v2"
+
+    @property
+    def webhook_address(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/webhook"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class UniversalisStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server: UniversalisStub = self.server
+        with server.lock:
+            server.request_count += 1
+        time.sleep(server.latency)
+        if random.random() < server.throttle_ratio:
+            with server.lock:
+                server.throttled_count += 1
+            self.send_json({"error": "Too Many Requests"}, status=429, headers={"Retry-After": "1"})
+            return
+        if self.path == "/api/v2/marketable":
+            self.send_json(server.item_ids)
+            return
+        if self.path == "/api/v2/worlds":
+            self.send_json(WORLDS)
+            return
+        if self.path == "/api/v2/data-centers":
+            self.send_json(DATA_CENTERS)
+            return
+        match = re.fullmatch(r"/api/v2/aggregated/[^/]+/([0-9,]+)", self.path)
+        if match:
+            item_ids = [int(item_id) for item_id in match.group(1).split(",")]
+            rng = random.Random(item_ids[0])
+            known_item_ids = set(server.item_ids)
+            self.send_json({
+                "results": [fake_aggregated_prices(item_id, rng) for item_id in item_ids if item_id in known_item_ids],
+                "failedItems": [item_id for item_id in item_ids if item_id not in known_item_ids],
+            })
+            return
+        match = re.fullmatch(r"/api/v2/[^/]+/([0-9,]+)", self.path)
+        if not match:
+            self.send_json({"error": "Not Found"}, status=404)
+            return
+        item_ids = [int(item_id) for item_id in match.group(1).split(",")]
+        rng = random.Random(item_ids[0])
+        items = {str(item_id): fake_market_board_current_data(item_id, rng, 20, 10) for item_id in item_ids}
+        self.send_json(items[str(item_ids[0])] if len(item_ids) == 1 else {"itemIDs": item_ids, "items": items})
+
+    def do_POST(self):
+        server: UniversalisStub = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.webhook_messages.append(body["content"])
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.send_header("X-RateLimit-Limit", "5")
+        self.send_header("X-RateLimit-Remaining", "4")
+        self.send_header("X-RateLimit-Reset-After", "0.4")
+        self.end_headers()
+
+    def send_json(self, obj, status=200, headers=None):
+        body = json.dumps(obj).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status, body = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    stub = UniversalisStub(item_count=int(sys.argv[1]) if len(sys.argv) > 1 else 5_000, port=8765)
+    print(f"Serving Universalis stub on {stub.address}")
+    stub.serve_forever()